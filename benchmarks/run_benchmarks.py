@@ -0,0 +1,264 @@
+'''
+Offline benchmark suite for the extraction, R1 and projection functions.
+
+Every case runs in a fresh process so that its peak RSS is its own. Inputs are
+synthetic (see synthetic.py) and generated once per parameter set under the work
+directory. Results are written as JSON tagged with the current git commit; compare
+two runs with --compare.
+
+    python benchmarks/run_benchmarks.py --quick
+    python benchmarks/run_benchmarks.py --compare results/old.json results/new.json
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+for path in (REPO, HERE):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import synthetic  # noqa: E402
+
+
+def _volumes(workdir, shape, n_regions, n_volumes=1):
+    out_dir = os.path.join(workdir, f'vol_{"x".join(map(str, shape))}_r{n_regions}_v{n_volumes}')
+    manifest = os.path.join(out_dir, 'paths.json')
+    if not os.path.exists(manifest):
+        paths = synthetic.make_volumes(out_dir, tuple(shape), n_regions, n_volumes=n_volumes)
+        with open(manifest, 'w') as f:
+            json.dump(paths, f)
+    with open(manifest) as f:
+        return json.load(f)
+
+
+def _subject(workdir, name, subdivisions):
+    subjects_dir = os.path.join(workdir, f'subjects_ico{subdivisions}')
+    sub_dir = os.path.join(subjects_dir, name) + '/'
+    if not os.path.exists(os.path.join(sub_dir, 'mri', 'ribbon.mgz')):
+        synthetic.make_freesurfer_subject(subjects_dir, name, subdivisions,
+                                          seed=0 if name == 'fsaverage' else 1)
+    return subjects_dir + '/', sub_dir
+
+
+# Each case builds its inputs in the parent (setup) and returns the call to time (run)
+def _extract_case(params, workdir):
+    paths = _volumes(workdir, params['shape'], params['regions'], params.get('volumes', 1))
+
+    def run():
+        import extract_roi_metrics as erm
+        erm.extract_metrics_from_roi(paths['atlas'], paths['metrics'],
+                                     [f'm{i}' for i in range(len(paths['metrics']))], 'bench',
+                                     stats=params['stats'], max_memory=params.get('max_memory'))
+    return run
+
+
+def _r1_case(params, workdir):
+    paths = _volumes(workdir, params['shape'], 10)
+    output = os.path.join(workdir, f'sr1_{os.getpid()}.nii.gz')
+
+    def run():
+        import compute_r1_map
+        compute_r1_map.compute_approx_r1(paths['t1'], paths['t2'], paths['mask'], output,
+                                         max_memory=params.get('max_memory'))
+    return run
+
+
+def _surf_to_vol_case(params, workdir):
+    fs_dir, _ = _subject(workdir, 'sub01', params['subdivisions'])
+    labels = 'roi0' if params['labels'] == 1 else [f'roi{i}' for i in range(params['labels'])]
+
+    def run():
+        import project_label_utilities as pl
+        pl.surf_label_2_vol('sub01', labels, fs_dir)
+    return run
+
+
+def _vol_to_surf_case(params, workdir):
+    import nibabel as nib
+    import numpy as np
+    fs_dir, sub_dir = _subject(workdir, 'sub01', params['subdivisions'])
+    ribbon = nib.load(os.path.join(sub_dir, 'mri', 'ribbon.mgz'))
+    data = np.asarray(ribbon.dataobj)
+    # Cut the cortical ribbon into anterior-posterior slabs, one label per slab
+    cortex = (data == 3) | (data == 42)
+    slab = np.indices(data.shape)[2] * params['labels'] // data.shape[2]
+    img = nib.Nifti1Image((cortex * (slab + 1)).astype(np.int16), ribbon.affine)
+
+    def run():
+        import project_label_utilities as pl
+        pl.vol_label_2_surf('sub01', img, fs_dir.rstrip('/'), 'bench', atlas=params['labels'] > 1)
+    return run
+
+
+def _fs_interp_case(params, workdir):
+    import label_io
+    _, native = _subject(workdir, 'sub01', params['subdivisions'])
+    _, average = _subject(workdir, 'fsaverage', params['subdivisions'] + 1)
+    src, trg = (native, average) if params['direction'] == 'fsnative->fsaverage' else (average, native)
+    label = label_io.read_label(os.path.join(src, 'label', 'lh.roi0.label'), use_cache=False).vertices
+
+    def run():
+        import project_label_utilities as pl
+        fn = (pl.fsnative_label_2_fsaverage if params['direction'] == 'fsnative->fsaverage'
+              else pl.fsaverage_label_2_fsnative)
+        fn(src, trg, label, 'lh', 'bench')
+    return run
+
+
+CASE_BUILDERS = {
+    'extract_metrics_from_roi': _extract_case,
+    'compute_approx_r1': _r1_case,
+    'surf_label_2_vol': _surf_to_vol_case,
+    'vol_label_2_surf': _vol_to_surf_case,
+    'fsaverage_interpolation': _fs_interp_case,
+}
+
+
+def cases(quick=False):
+    '''
+    The (name, params) pairs to benchmark; quick keeps only the small sizes.
+    '''
+    shapes = [[64, 64, 64]] if quick else [[64, 64, 64], [96, 114, 96], [182, 218, 182]]
+    regions = [100] if quick else [100, 300, 1000]
+    stats = ['mean', 'std', 'count', 'min', 'max']
+    out = []
+    for shape in shapes:
+        for n in regions:
+            out.append(('extract_metrics_from_roi', {'shape': shape, 'regions': n, 'stats': stats}))
+        out.append(('extract_metrics_from_roi', {'shape': shape, 'regions': regions[-1],
+                                                 'stats': stats, 'max_memory': 32 * 1024 ** 2}))
+        out.append(('extract_metrics_from_roi', {'shape': shape, 'regions': regions[0],
+                                                 'stats': stats + ['median']}))
+        out.append(('compute_approx_r1', {'shape': shape}))
+        out.append(('compute_approx_r1', {'shape': shape, 'max_memory': 32 * 1024 ** 2}))
+    out.append(('extract_metrics_from_roi', {'shape': shapes[0], 'regions': regions[0],
+                                             'volumes': 20, 'stats': ['mean'],
+                                             'max_memory': 32 * 1024 ** 2}))
+    for subdivisions in ([4] if quick else [4, 5]):
+        for n in (1, 8):
+            out.append(('surf_label_2_vol', {'subdivisions': subdivisions, 'labels': n}))
+            out.append(('vol_label_2_surf', {'subdivisions': subdivisions, 'labels': n}))
+        for direction in ('fsnative->fsaverage', 'fsaverage->fsnative'):
+            out.append(('fsaverage_interpolation', {'subdivisions': subdivisions, 'direction': direction}))
+    return out
+
+
+def _run_case(name, params, workdir, repeats):
+    # Executed in a fresh worker process
+    try:
+        run = CASE_BUILDERS[name](params, workdir)
+    except ImportError as err:
+        return {'status': 'skipped', 'reason': f'missing dependency: {err.name}'}
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times, cpu = [], []
+    try:
+        for _ in range(repeats):
+            t0, c0 = time.perf_counter(), time.process_time()
+            run()
+            times.append(time.perf_counter() - t0)
+            cpu.append(time.process_time() - c0)
+    except ImportError as err:
+        return {'status': 'skipped', 'reason': f'missing dependency: {err.name}'}
+    except Exception:
+        return {'status': 'error', 'reason': traceback.format_exc(limit=3)}
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'status': 'ok', 'wall_s': times, 'cpu_s': cpu,
+            'wall_s_min': min(times), 'wall_s_median': sorted(times)[len(times) // 2],
+            'peak_rss_mb': peak * scale / 1024 ** 2, 'baseline_rss_mb': baseline * scale / 1024 ** 2}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(workdir, quick=False, repeats=3, only=None):
+    '''
+    Run every benchmark case and return the JSON-serialisable results.
+    '''
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for name, params in cases(quick):
+        if only and name not in only:
+            continue
+        # The parent builds inputs first so data generation never counts towards a case
+        try:
+            CASE_BUILDERS[name](params, workdir)
+        except ImportError:
+            pass
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(_run_case, name, params, workdir, repeats).result()
+        result.update(name=name, params=params)
+        results.append(result)
+        timing = f"{result['wall_s_min']:.3f}s, {result['peak_rss_mb']:.0f} MB" \
+            if result['status'] == 'ok' else result['status']
+        print(f'{name} {json.dumps(params)}: {timing}')
+    return {'commit': _git_commit(), 'timestamp': time.time(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'repeats': repeats, 'results': results}
+
+
+def compare(old_fname, new_fname):
+    '''
+    Print the wall time and peak RSS ratios (new / old) of the cases both runs share.
+    '''
+    with open(old_fname) as f:
+        old = json.load(f)
+    with open(new_fname) as f:
+        new = json.load(f)
+    key = lambda r: (r['name'], json.dumps(r['params'], sort_keys=True))
+    old_results = {key(r): r for r in old['results'] if r['status'] == 'ok'}
+    print(f"{(old['commit'] or '?')[:10]} -> {(new['commit'] or '?')[:10]}")
+    for r in new['results']:
+        base = old_results.get(key(r))
+        if r['status'] != 'ok' or base is None:
+            continue
+        print(f"{r['name']:<28} {json.dumps(r['params']):<70} "
+              f"time x{r['wall_s_min'] / base['wall_s_min']:.2f}  "
+              f"rss x{r['peak_rss_mb'] / base['peak_rss_mb']:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workdir', default=os.path.join(HERE, 'data'),
+                        help="Where synthetic inputs are generated and kept")
+    parser.add_argument('--output', default=None,
+                        help="Result JSON (default: benchmarks/results/<commit>.json)")
+    parser.add_argument('--quick', action='store_true', help="Only the smallest sizes")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=sorted(CASE_BUILDERS), default=None)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    report = run_benchmarks(args.workdir, args.quick, args.repeats, args.only)
+    output = args.output or os.path.join(HERE, 'results', f"{report['commit'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'Results written to {output}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
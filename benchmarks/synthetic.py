@@ -0,0 +1,183 @@
+'''
+Synthetic FreeSurfer subjects and NIfTI volumes for offline benchmarks.
+
+Subjects are two icospheres (one per hemisphere) with a spherical registration, a
+ribbon volume rasterised from the sphere shells, labels and an annotation. Volumes
+are random T1/T2/metric maps with a NAGM mask and a Voronoi-style integer atlas.
+Everything is generated from a seed, so runs are reproducible.
+'''
+import os
+
+import numpy as np
+import nibabel as nib
+from scipy.spatial import cKDTree
+
+# Hemisphere centres (tkr RAS, mm) and shell radii
+_HEMI_CENTERS = {'lh': np.array([-25.0, 0.0, 0.0]), 'rh': np.array([25.0, 0.0, 0.0])}
+_WHITE_RADIUS = 20.0
+_PIAL_RADIUS = 23.0
+# FreeSurfer aseg/ribbon values for (white matter, cortex)
+_RIBBON_VALUES = {'lh': (2, 3), 'rh': (41, 42)}
+
+
+def icosphere(subdivisions):
+    '''
+    Unit icosphere with 10 * 4**subdivisions + 2 vertices.
+
+    Returns:
+    (coords, faces): (n, 3) float vertex coordinates and (m, 3) int triangles.
+    '''
+    t = (1 + 5 ** 0.5) / 2
+    coords = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                       [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                       [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=float)
+    faces = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+                      [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                      [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+                      [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]])
+    for _ in range(subdivisions):
+        # One new vertex per unique edge, shared between its two triangles
+        edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+        unique, inverse = np.unique(edges, axis=0, return_inverse=True)
+        midpoints = coords[unique].mean(axis=1)
+        mid = inverse.ravel().reshape(3, -1).T + len(coords)
+        a, b, c = faces.T
+        ab, bc, ca = mid.T
+        faces = np.concatenate([np.stack([a, ab, ca], 1), np.stack([b, bc, ab], 1),
+                                np.stack([c, ca, bc], 1), np.stack([ab, bc, ca], 1)])
+        coords = np.concatenate([coords, midpoints])
+    coords /= np.linalg.norm(coords, axis=1, keepdims=True)
+    return coords, faces.astype(np.int32)
+
+
+def _conformed_affine(n):
+    # LIA 1 mm grid centred on the origin, so scanner RAS equals tkr RAS
+    return np.array([[-1, 0, 0, n / 2], [0, 0, 1, -n / 2], [0, -1, 0, n / 2], [0, 0, 0, 1]], dtype=float)
+
+
+def make_freesurfer_subject(subjects_dir, name, subdivisions=5, size=96, n_labels=8, seed=0):
+    '''
+    Write a synthetic FreeSurfer subject.
+
+    Parameters:
+    subjects_dir (str): Directory to create the subject in.
+    name (str): Subject name.
+    subdivisions (int): Icosphere subdivisions per hemisphere (5 gives 10242 vertices).
+    size (int): Edge length in voxels of the cubic 1 mm volumes.
+    n_labels (int): Number of label files (label/<hemi>.roi<i>.label) and annotation
+                    entries (label/<hemi>.synth.annot) per hemisphere.
+    seed (int): Random seed.
+
+    Returns:
+    str: Path of the subject directory (with a trailing slash).
+    '''
+    rng = np.random.default_rng(seed)
+    sub_dir = os.path.join(subjects_dir, name)
+    for d in ('surf', 'mri', 'label'):
+        os.makedirs(os.path.join(sub_dir, d), exist_ok=True)
+
+    unit, faces = icosphere(subdivisions)
+    n_vertices = len(unit)
+    for hemi, center in _HEMI_CENTERS.items():
+        # A small random rotation makes sphere.reg differ from the native sphere
+        angle = rng.normal(scale=0.05, size=3)
+        rot, _ = np.linalg.qr(np.eye(3) + np.array([[0, -angle[2], angle[1]],
+                                                     [angle[2], 0, -angle[0]],
+                                                     [-angle[1], angle[0], 0]]))
+        surfaces = {'white': center + _WHITE_RADIUS * unit,
+                    'pial': center + _PIAL_RADIUS * unit,
+                    'sphere': 100 * unit,
+                    'sphere.reg': 100 * unit @ rot.T}
+        surfaces['orig'] = surfaces['smoothwm'] = surfaces['white']
+        surfaces['inflated'] = center + 30 * unit
+        for surf, coords in surfaces.items():
+            nib.freesurfer.write_geometry(os.path.join(sub_dir, 'surf', f'{hemi}.{surf}'),
+                                          coords.astype(np.float32), faces)
+        for morph in ('thickness', 'curv', 'sulc', 'area'):
+            nib.freesurfer.write_morph_data(os.path.join(sub_dir, 'surf', f'{hemi}.{morph}'),
+                                            rng.random(n_vertices).astype(np.float32))
+
+        # Labels and annotation from a Voronoi parcellation of the sphere
+        seeds = unit[rng.choice(n_vertices, n_labels, replace=False)]
+        parcel = cKDTree(seeds).query(unit)[1]
+        for i in range(n_labels):
+            vertices = np.flatnonzero(parcel == i)
+            rows = np.column_stack([vertices, surfaces['white'][vertices], np.zeros(len(vertices))])
+            with open(os.path.join(sub_dir, 'label', f'{hemi}.roi{i}.label'), 'w') as f:
+                f.write(f'#!ascii label, from subject {name} vox2ras=TkReg\n{len(vertices)}\n')
+                f.write(('%d %f %f %f %f\n' * len(vertices)) % tuple(rows.ravel().tolist()))
+        ctab = np.zeros((n_labels, 5), dtype=np.int32)
+        ctab[:, :3] = rng.integers(0, 256, size=(n_labels, 3))
+        nib.freesurfer.write_annot(os.path.join(sub_dir, 'label', f'{hemi}.synth.annot'),
+                                   parcel.astype(np.int32), ctab,
+                                   [f'roi{i}' for i in range(n_labels)], fill_ctab=True)
+
+    # Ribbon: white matter inside the white shell, cortex between white and pial
+    affine = _conformed_affine(size)
+    ijk = np.indices((size,) * 3).reshape(3, -1).T
+    ras = nib.affines.apply_affine(affine, ijk)
+    ribbon = np.zeros(len(ras), dtype=np.int32)
+    for hemi, center in _HEMI_CENTERS.items():
+        r = np.linalg.norm(ras - center, axis=1)
+        wm_value, ctx_value = _RIBBON_VALUES[hemi]
+        ribbon[r <= _WHITE_RADIUS] = wm_value
+        ribbon[(r > _WHITE_RADIUS) & (r <= _PIAL_RADIUS)] = ctx_value
+    ribbon = ribbon.reshape((size,) * 3)
+    nib.save(nib.MGHImage(ribbon, affine), os.path.join(sub_dir, 'mri', 'ribbon.mgz'))
+    t1 = (ribbon > 0) * 110.0 + rng.normal(scale=5, size=ribbon.shape)
+    for vol in ('T1', 'brain', 'orig', 'norm'):
+        nib.save(nib.MGHImage(np.clip(t1, 0, 255).astype(np.uint8), affine),
+                 os.path.join(sub_dir, 'mri', f'{vol}.mgz'))
+    return sub_dir + '/'
+
+
+def make_volumes(out_dir, shape=(96, 96, 96), n_regions=300, n_metrics=3, n_volumes=1, seed=0):
+    '''
+    Write synthetic T1/T2 images, a NAGM mask, metric maps and an integer atlas.
+
+    Parameters:
+    out_dir (str): Output directory.
+    shape (tuple): Volume shape in voxels (2 mm isotropic, centred on the origin).
+    n_regions (int): Number of atlas regions.
+    n_metrics (int): Number of metric maps (metric<i>.nii.gz).
+    n_volumes (int): Volumes per metric map; above 1 the maps are 4D.
+    seed (int): Random seed.
+
+    Returns:
+    dict: Paths of 't1', 't2', 'mask', 'atlas' and the list of 'metrics'.
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = -np.array(shape) + 1
+
+    # Brain: an ellipsoid filling most of the field of view
+    grid = np.indices(shape, dtype=np.float32)
+    radii = np.array(shape, dtype=np.float32).reshape(3, 1, 1, 1) * 0.45
+    centre = (np.array(shape, dtype=np.float32).reshape(3, 1, 1, 1) - 1) / 2
+    brain = (((grid - centre) / radii) ** 2).sum(axis=0) <= 1
+    del grid
+
+    paths = {'metrics': []}
+    t1 = (brain * rng.normal(800, 60, shape)).astype(np.int16)
+    t2 = (brain * rng.normal(400, 40, shape)).astype(np.int16)
+    mask = (brain & (rng.random(shape) < 0.2)).astype(np.uint8)
+    for key, data in (('t1', t1), ('t2', t2), ('mask', mask)):
+        paths[key] = os.path.join(out_dir, f'{key}.nii.gz')
+        nib.save(nib.Nifti1Image(data, affine), paths[key])
+
+    # Atlas: every brain voxel takes the label of its nearest random seed
+    brain_ijk = np.argwhere(brain)
+    seeds = brain_ijk[rng.choice(len(brain_ijk), n_regions, replace=False)]
+    atlas = np.zeros(shape, dtype=np.int16)
+    atlas[tuple(brain_ijk.T)] = cKDTree(seeds).query(brain_ijk)[1] + 1
+    paths['atlas'] = os.path.join(out_dir, 'atlas.nii.gz')
+    nib.save(nib.Nifti1Image(atlas, affine), paths['atlas'])
+
+    metric_shape = shape if n_volumes == 1 else shape + (n_volumes,)
+    for i in range(n_metrics):
+        metric = rng.random(metric_shape, dtype=np.float32)
+        metric[~brain] = 0
+        paths['metrics'].append(os.path.join(out_dir, f'metric{i}.nii.gz'))
+        nib.save(nib.Nifti1Image(metric, affine), paths['metrics'][-1])
+    return paths
@@ -1,47 +1,260 @@
+import argparse
+import csv
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
 import nibabel as nib
+from nibabel.openers import ImageOpener
+
+import nifti_io as nio
+
+
+def _histogram_median(values_by_slab, lo, hi, bins):
+    # Median from a fixed-range histogram, interpolated within the median bin
+    counts = np.zeros(bins, dtype=np.int64)
+    for values in values_by_slab():
+        counts += np.histogram(values, bins=bins, range=(lo, hi))[0]
+    cumulative = np.cumsum(counts)
+    half = cumulative[-1] / 2
+    b = int(np.searchsorted(cumulative, half))
+    below = cumulative[b - 1] if b > 0 else 0
+    width = (hi - lo) / bins
+    return lo + width * (b + (half - below) / max(counts[b], 1))
+
+
+def nagm_medians(t1_img, t2_img, mask_img, bounds, approximate=False, bins=4096):
+    """
+    Median T1 and T2 intensity inside the NAGM mask, read slab by slab.
+
+    Args:
+        t1_img: Loaded T1-weighted image
+        t2_img: Loaded T2-weighted image
+        mask_img: Loaded NAGM mask image
+        bounds: (start, stop) slabs along the third axis, see nifti_io.slab_bounds
+        approximate: Use a fixed-memory histogram estimate instead of gathering every
+            masked voxel (costs one extra pass for the value range)
+        bins: Number of histogram bins for the approximate median
+
+    Returns:
+        (t1_median, t2_median)
+    """
+    def masked(img):
+        for start, stop in bounds:
+            mask = nio.read_slab(mask_img, start, stop).astype(bool)
+            # Only the masked voxels are converted, never a copy of the whole slab
+            yield np.asarray(nio.read_slab(img, start, stop)[mask], dtype=np.float32)
+
+    medians = []
+    for img in (t1_img, t2_img):
+        if not approximate:
+            # Exact: only the masked voxels are ever held in memory
+            medians.append(float(np.median(np.concatenate(list(masked(img))))))
+            continue
+        lo, hi = np.inf, -np.inf
+        for values in masked(img):
+            if values.size:
+                lo, hi = min(lo, float(values.min())), max(hi, float(values.max()))
+        if not np.isfinite(lo):
+            raise ValueError("NAGM mask is empty, cannot compute scaling factor.")
+        medians.append(lo if hi == lo else _histogram_median(lambda: masked(img), lo, hi, bins))
+    return tuple(medians)
+
+
+def compute_sr1(t1, t2, scale_factor):
+    """
+    sR1 = (T1 - sT2) / (T1 + sT2) computed in place on float32 arrays.
+
+    t1 and t2 are overwritten; the result is returned in t1's buffer.
+    Non-finite ratios (e.g. 0/0 outside the head) are set to 0.
+    """
+    t2 *= np.float32(scale_factor)   # sT2
+    denominator = t1 + t2            # the only extra buffer
+    t1 -= t2                         # numerator, in place
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(t1, denominator, out=t1)
+    t1[~np.isfinite(t1)] = 0
+    return t1
+
+
+def _output_header(t1_img):
+    hdr = t1_img.header.copy()
+    hdr.set_data_dtype(np.float32)
+    hdr.set_slope_inter(1, 0)
+    return hdr
 
 
-def compute_approx_r1(t1_path: str, t2_path: str, nagm_mask_path: str, output_path: str) -> str:
+def compute_approx_r1(t1_path: str, t2_path: str, nagm_mask_path: str, output_path: str,
+                      max_memory: int = None, approximate_median: bool = False,
+                      compresslevel: int = nio.DEFAULT_COMPRESSLEVEL, writer=None) -> str:
     """
     Compute the standardized R1 (sT1w/T2w) ratio image using the formula:
         sR1 = (T1 - sT2) / (T1 + sT2), where sT2 = T2 * scale_factor
     The scale factor is the median(T1[NAGM]) / median(T2[NAGM])
 
+    Without max_memory every image is decompressed once, and the NAGM medians and the
+    ratio are computed from the same in-memory arrays. With max_memory set, the images
+    are processed slab by slab through proxies that keep their file open (so a .nii.gz
+    is not decompressed again for every slab) and the output is written incrementally,
+    so peak memory stays around max_memory bytes regardless of the image size. The
+    ratio is computed in place in float32.
+
     Args:
-        t1_path: Path to the T1-weighted NIfTI file
-        t2_path: Path to the T2-weighted NIfTI file
-        nagm_mask_path: Path to the NAGM mask NIfTI file
+        t1_path: Path to the T1-weighted NIfTI file (or the loaded image)
+        t2_path: Path to the T2-weighted NIfTI file (or the loaded image)
+        nagm_mask_path: Path to the NAGM mask NIfTI file (or the loaded image)
         output_path: Path to save the output sT1w/T2w ratio NIfTI file
+        max_memory: If given, stream the computation with roughly this many bytes in memory
+        approximate_median: Estimate the NAGM medians from a histogram in constant memory
+        compresslevel: gzip level of a .nii.gz output, 0 for no compression
+        writer: nifti_io.AsyncWriter to queue the output on instead of writing it before
+            returning (not used when streaming)
 
     Returns:
         Path to the output NIfTI file
     """
-    t1_img = nib.load(t1_path)
-    t2_img = nib.load(t2_path)
-    mask_img = nib.load(nagm_mask_path)
+    if max_memory is None:
+        # Decompressed once, in parallel; images passed in loaded are used as they are
+        t1_img, t2_img, mask_img = nio.load_niftis([t1_path, t2_path, nagm_mask_path])
+    else:
+        t1_img, t2_img, mask_img = [nio.as_image(path, keep_file_open=True)
+                                    for path in (t1_path, t2_path, nagm_mask_path)]
+
+    if not (t1_img.shape == t2_img.shape == mask_img.shape):
+        raise ValueError("T1, T2 and NAGM mask images must have the same shape.")
 
-    t1 = t1_img.get_fdata().astype(np.float32)
-    t2 = t2_img.get_fdata().astype(np.float32)
-    nagm_mask = mask_img.get_fdata().astype(bool)
+    # T1, T2 and mask slabs plus the float32 working buffers
+    bytes_per_voxel = (t1_img.get_data_dtype().itemsize + t2_img.get_data_dtype().itemsize
+                       + mask_img.get_data_dtype().itemsize + 3 * 4)
+    full = [(0, t1_img.shape[2])]
+    bounds = full if max_memory is None else nio.slab_bounds(t1_img.shape, bytes_per_voxel, max_memory)
 
-    t1_nagm_median = np.median(t1[nagm_mask])
-    t2_nagm_median = np.median(t2[nagm_mask])
+    t1_nagm_median, t2_nagm_median = nagm_medians(t1_img, t2_img, mask_img, bounds,
+                                                  approximate_median)
 
     if t2_nagm_median == 0:
         raise ValueError("Median T2 intensity in NAGM is zero, cannot compute scaling factor.")
 
     scale_factor = t1_nagm_median / t2_nagm_median
-    scaled_t2 = t2 * scale_factor
 
-    numerator = t1 - scaled_t2
-    denominator = t1 + scaled_t2
+    if bounds == full:
+        sr1 = compute_sr1(nio.read_slab(t1_img, 0, t1_img.shape[2], dtype=np.float32),
+                          nio.read_slab(t2_img, 0, t2_img.shape[2], dtype=np.float32), scale_factor)
+        sr1_img = nib.Nifti1Image(sr1, affine=t1_img.affine, header=_output_header(t1_img))
+        if writer is not None:
+            writer.submit(sr1_img, output_path)
+        else:
+            nio.write_nifti(sr1_img, output_path, compresslevel)
+        return output_path
 
-    with np.errstate(divide='ignore', invalid='ignore'):
-        sr1 = np.true_divide(numerator, denominator)
-        sr1[~np.isfinite(sr1)] = 0  
+    # Stream: write the header, then each slab's Fortran-ordered bytes in turn
+    hdr = nib.Nifti1Header.from_header(_output_header(t1_img))
+    offset = 352
+    hdr.set_data_offset(offset)
+    opener_kwargs = {'compresslevel': compresslevel} if output_path.endswith('.gz') else {}
+    with ImageOpener(output_path, 'wb', **opener_kwargs) as f:
+        hdr.write_to(f)
+        f.write(b'\x00' * (offset - f.tell()))
+        for start, stop in bounds:
+            sr1 = compute_sr1(nio.read_slab(t1_img, start, stop, dtype=np.float32),
+                              nio.read_slab(t2_img, start, stop, dtype=np.float32), scale_factor)
+            f.write(sr1.astype(hdr.get_data_dtype(), copy=False).tobytes(order='F'))
+
+    return output_path
+
+
+def _load_job(job):
+    # Decompress a job's inputs once, on parallel threads
+    return nio.load_niftis([job['t1'], job['t2'], job['mask']])
+
+
+def _compute_chunk(jobs, kwargs):
+    # While one job computes, the next job's inputs are read and the previous outputs
+    # are compressed and written on background threads
+    streamed = kwargs.get('max_memory') is not None
+    load = (lambda job: [job['t1'], job['t2'], job['mask']]) if streamed else _load_job
+    errors = {}
+    writer = nio.AsyncWriter(compresslevel=kwargs.get('compresslevel', nio.DEFAULT_COMPRESSLEVEL))
+    try:
+        for job, inputs in nio.prefetch(jobs, load):
+            try:
+                compute_approx_r1(*inputs.result(), job['output'], writer=writer, **kwargs)
+            except Exception as err:
+                errors[job['output']] = err
+    finally:
+        written = writer.close()
+    return [(job.get('subject', job['output']), job['output'],
+             errors.get(job['output']) or written.get(job['output'])) for job in jobs]
+
+
+def compute_approx_r1_batch(jobs, max_workers=None, chunk_size=None, **kwargs):
+    """
+    Run compute_approx_r1 for many subjects on a process pool.
+
+    Jobs are handed to the workers in chunks of chunk_size. Within a chunk the inputs
+    of the next job are read, and the outputs of the previous ones compressed and
+    written, on background threads while the current job computes (see nifti_io).
+    By default every worker gets one chunk, so all I/O but the first read overlaps.
+
+    Args:
+        jobs: Iterable of dicts with 't1', 't2', 'mask' and 'output' paths
+            (plus an optional 'subject' used in messages)
+        max_workers: Number of worker processes (default: os.cpu_count())
+        chunk_size: Number of consecutive jobs run by one worker task
+            (default: the jobs split evenly over the workers)
+        **kwargs: Passed to compute_approx_r1 (e.g. max_memory, approximate_median, compresslevel)
+
+    Returns:
+        (outputs, failures): lists of written paths and of (subject, error) pairs
+    """
+    jobs = list(jobs)
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_size = max(1, chunk_size or math.ceil(len(jobs) / max_workers))
+    outputs, failures = [], []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_compute_chunk, jobs[i:i + chunk_size], kwargs): jobs[i:i + chunk_size]
+                   for i in range(0, len(jobs), chunk_size)}
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as err:
+                results = [(job.get('subject', job['output']), job['output'], err)
+                           for job in futures[future]]
+            for subject, output, err in results:
+                if err is None:
+                    outputs.append(output)
+                else:
+                    print(f'{subject} failed: {err!r}')
+                    failures.append((subject, repr(err)))
+    return outputs, failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute sT1w/T2w (sR1) maps for many subjects.")
+    parser.add_argument('manifest', help="CSV with columns subject,t1,t2,mask,output")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes")
+    parser.add_argument('--max-memory', type=int, default=None,
+                        help="Stream each subject with roughly this many bytes in memory")
+    parser.add_argument('--approximate-median', action='store_true',
+                        help="Histogram-based NAGM medians in constant memory")
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help="Jobs per worker task (default: split evenly over the workers); the "
+                             "next job's inputs are prefetched and outputs written in the background "
+                             "within a task")
+    parser.add_argument('--compresslevel', type=int, default=nio.DEFAULT_COMPRESSLEVEL,
+                        choices=range(10), metavar='0-9', help="gzip level of .nii.gz outputs (0: none)")
+    args = parser.parse_args(argv)
+
+    with open(args.manifest, newline='') as f:
+        jobs = list(csv.DictReader(f))
+
+    _, failures = compute_approx_r1_batch(jobs, args.workers, args.chunk_size,
+                                          max_memory=args.max_memory,
+                                          approximate_median=args.approximate_median,
+                                          compresslevel=args.compresslevel)
+    return 1 if failures else 0
 
-    sr1_img = nib.Nifti1Image(sr1, affine=t1_img.affine, header=t1_img.header)
-    nib.save(sr1_img, output_path)
 
-    return output_path
\ No newline at end of file
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,8 +1,18 @@
+import argparse
+import math
+import os
+import shutil
 import nibabel as nib
 import numpy as np
 import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import List, Union, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import nifti_io as nio
+
+SUPPORTED_STATS = ('mean', 'std', 'count', 'nan_count', 'min', 'max', 'median')
 
 def load_nifti(path: Union[str, Path]) -> Tuple[np.ndarray, nib.Nifti1Image]:
     img = nib.load(str(path))
@@ -15,48 +25,480 @@ def check_affines(ref_img: nib.Nifti1Image, other_imgs: List[nib.Nifti1Image]):
         if not np.allclose(ref_affine, img.affine):
             raise ValueError("Affine mismatch: all images must be in the same space.")
 
+def check_stats(stats: Sequence[str]) -> Tuple[str, ...]:
+    stats = tuple(stats)
+    unknown = [s for s in stats if s not in SUPPORTED_STATS]
+    if unknown:
+        raise ValueError(f"Unsupported statistics {unknown}; choose from {SUPPORTED_STATS}.")
+    return stats
+
+def init_accumulators(n_channels: int, n_regions: int) -> Dict[str, np.ndarray]:
+    """
+    Allocate the running per-region sums used by update_accumulators.
+
+    Every array has shape (n_channels, n_regions), one row per metric channel. Sums are
+    taken around a per-region shift (the first value seen), so the variance does not
+    cancel out for values with a large offset, e.g. BOLD intensities.
+    """
+    shape = (n_channels, n_regions)
+    return {
+        'shift': np.full(shape, np.nan),
+        'sum': np.zeros(shape),
+        'sumsq': np.zeros(shape),
+        'count': np.zeros(shape, dtype=np.int64),
+        'nan_count': np.zeros(shape, dtype=np.int64),
+        'min': np.full(shape, np.inf),
+        'max': np.full(shape, -np.inf),
+    }
+
+def update_accumulators(acc: Dict[str, np.ndarray], region_index: np.ndarray,
+                        values: np.ndarray, channels: Optional[Sequence[int]] = None):
+    """
+    Fold a block of voxels into the running per-region sums.
+
+    Parameters:
+    acc (dict): Accumulators from init_accumulators.
+    region_index (np.ndarray): Region position (0..n_regions-1) of each voxel, shape (n_voxels,).
+    values (np.ndarray): Metric values of each voxel, shape (n_voxels, n_values).
+    channels (sequence of int or None): Accumulator channel of every column of values.
+        Defaults to columns 0..n_values-1 being channels 0..n_values-1.
+    """
+    n_regions = acc['sum'].shape[1]
+    if channels is None:
+        channels = range(values.shape[1])
+    for column, channel in enumerate(channels):
+        vals = values[:, column].astype(np.float64, copy=False)
+        nan = np.isnan(vals)
+        valid = ~nan
+        idx = region_index[valid]
+        vals = vals[valid]
+        shift = acc['shift'][channel]
+        unset = np.isnan(shift)
+        if unset.any():
+            # Reversed so that the first value of every region is the one assigned last
+            first = np.full(n_regions, np.nan)
+            first[idx[::-1]] = vals[::-1]
+            shift[unset] = first[unset]
+        shifted = vals - shift[idx]
+        acc['sum'][channel] += np.bincount(idx, weights=shifted, minlength=n_regions)
+        acc['sumsq'][channel] += np.bincount(idx, weights=shifted * shifted, minlength=n_regions)
+        acc['count'][channel] += np.bincount(idx, minlength=n_regions)
+        acc['nan_count'][channel] += np.bincount(region_index[nan], minlength=n_regions)
+        np.minimum.at(acc['min'][channel], idx, vals)
+        np.maximum.at(acc['max'][channel], idx, vals)
+
+def finalize_accumulators(acc: Dict[str, np.ndarray], stats: Sequence[str]) -> Dict[str, np.ndarray]:
+    """
+    Turn the running sums into the requested statistics (median excluded).
+
+    Regions with no finite value get NaN for mean, std, min and max, matching np.nanmean.
+    """
+    count = acc['count']
+    empty = count == 0
+    results = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shifted_mean = acc['sum'] / count
+        if 'mean' in stats:
+            results['mean'] = acc['shift'] + shifted_mean
+        if 'std' in stats:
+            var = acc['sumsq'] / count - shifted_mean * shifted_mean
+            results['std'] = np.sqrt(np.clip(var, 0, None))
+    if 'count' in stats:
+        results['count'] = count.copy()
+    if 'nan_count' in stats:
+        results['nan_count'] = acc['nan_count'].copy()
+    for stat in ('min', 'max'):
+        if stat in stats:
+            results[stat] = np.where(empty, np.nan, acc[stat])
+    return results
+
+def grouped_median(region_index: np.ndarray, values: np.ndarray, n_regions: int) -> np.ndarray:
+    """
+    Median of every region for every channel from one lexicographic sort per channel.
+
+    Returns an array of shape (n_channels, n_regions); all-NaN regions give NaN.
+    """
+    medians = np.full((values.shape[1], n_regions), np.nan)
+    for channel in range(values.shape[1]):
+        vals = values[:, channel]
+        valid = ~np.isnan(vals)
+        idx = region_index[valid]
+        vals = vals[valid]
+        sorted_vals = vals[np.lexsort((vals, idx))]
+        counts = np.bincount(idx, minlength=n_regions)
+        starts = np.cumsum(counts) - counts
+        has = counts > 0
+        lo = sorted_vals[(starts + (counts - 1) // 2)[has]]
+        hi = sorted_vals[(starts + counts // 2)[has]]
+        medians[channel, has] = (lo + hi) / 2
+    return medians
+
+def reduce_by_label(
+    label_data: np.ndarray,
+    metric_data_list: List[np.ndarray],
+    stats: Sequence[str] = ('mean',)
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Compute per-region statistics for all metrics in a single pass over the label volume.
+
+    Parameters:
+        label_data: Array of integer labels per voxel; 0 is background
+        metric_data_list: Arrays with the same spatial shape as label_data
+        stats: Statistics to compute, any of SUPPORTED_STATS
+
+    Returns:
+        region_ids: Sorted non-zero label values
+        results: Dict mapping each statistic to an array of shape (n_metrics, n_regions)
+    """
+    stats = check_stats(stats)
+    foreground = label_data != 0
+    region_ids, region_index = np.unique(label_data[foreground], return_inverse=True)
+    region_index = region_index.ravel()
+    values = np.column_stack([m[foreground] for m in metric_data_list]) if metric_data_list \
+        else np.empty((region_index.size, 0))
+
+    acc = init_accumulators(values.shape[1], region_ids.size)
+    update_accumulators(acc, region_index, values)
+    results = finalize_accumulators(acc, stats)
+    if 'median' in stats:
+        results['median'] = grouped_median(region_index, values, region_ids.size)
+    return region_ids, results
+
+def results_to_frame(subject_id: str, region_ids: np.ndarray, results: Dict[str, np.ndarray],
+                     metric_names: List[str], stats: Sequence[str]) -> pd.DataFrame:
+    """
+    Assemble the per-region statistics into the extract_metrics_from_roi DataFrame.
+
+    The mean keeps the bare metric name as its column; every other statistic is
+    suffixed, e.g. 'FA_std'.
+    """
+    columns = {
+        'subject': [subject_id] * len(region_ids),
+        'region': [f"region_{int(region_id)}" for region_id in region_ids],
+    }
+    for i, name in enumerate(metric_names):
+        for stat in stats:
+            column = name if stat == 'mean' else f"{name}_{stat}"
+            columns[column] = results[stat][i]
+    return pd.DataFrame(columns)
+
+def channel_names(metric_names: List[str], metric_imgs: List[nib.Nifti1Image]) -> List[str]:
+    """
+    Column base names for every metric channel; 4D metrics get one channel per volume.
+    """
+    names = []
+    for name, img in zip(metric_names, metric_imgs):
+        if len(img.shape) > 3:
+            names.extend(f"{name}_vol{t}" for t in range(int(np.prod(img.shape[3:]))))
+        else:
+            names.append(name)
+    return names
+
+def reduce_by_label_streamed(
+    label_img: nib.Nifti1Image,
+    metric_imgs: List[nib.Nifti1Image],
+    stats: Sequence[str] = ('mean',),
+    max_memory: int = 256 * 1024 ** 2
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Slab-streamed counterpart of reduce_by_label that never holds a full volume in memory.
+
+    The label image is read once to collect the region ids and then alongside every
+    volume of the metric slabs; every file is read front to back. Medians need every
+    value of a region: with 'median', the labelled voxels of one volume of every metric
+    are gathered across slabs, which can exceed max_memory.
+
+    Parameters:
+        label_img: Loaded (ideally memory-mapped) label image
+        metric_imgs: Loaded metric images, 3D or 4D, sharing the label grid
+        stats: Statistics to compute, any of SUPPORTED_STATS
+        max_memory: Approximate ceiling in bytes for the data read per slab
+
+    Returns:
+        region_ids: Sorted non-zero label values
+        results: Dict mapping each statistic to an array of shape (n_channels, n_regions)
+    """
+    stats = check_stats(stats)
+
+    shape = label_img.shape[:3]
+    for img in metric_imgs:
+        if img.shape[:3] != shape:
+            raise ValueError("Shape mismatch: all images must share the label image grid.")
+
+    n_volumes = [int(np.prod(img.shape[3:])) for img in metric_imgs]
+    first_channel = np.cumsum([0] + n_volumes[:-1])
+    # On-disk bytes per voxel of one volume of every image plus the float64 working copies
+    bytes_per_voxel = label_img.get_data_dtype().itemsize + 16 * len(metric_imgs)
+    bytes_per_voxel += sum(img.get_data_dtype().itemsize for img in metric_imgs)
+    bounds = nio.slab_bounds(shape, bytes_per_voxel, max_memory)
+
+    region_ids = np.unique(np.concatenate([np.unique(nio.read_slab(label_img, start, stop))
+                                           for start, stop in bounds]))
+    region_ids = region_ids[region_ids != 0]
+
+    acc = init_accumulators(sum(n_volumes), region_ids.size)
+    medians = np.full((sum(n_volumes), region_ids.size), np.nan)
+    # Volumes are the outer loop so that every file is read front to back; a 4D metric
+    # read slab by slab with all its volumes would seek back (and re-decompress) per slab
+    for volume in range(max(n_volumes, default=1)):
+        imgs = [i for i, n in enumerate(n_volumes) if volume < n]
+        channels = first_channel[imgs] + volume
+        gathered = []
+        for start, stop in bounds:
+            labels = nio.read_slab(label_img, start, stop)
+            foreground = labels != 0
+            region_index = np.searchsorted(region_ids, labels[foreground])
+            values = np.column_stack([nio.read_slab(metric_imgs[i], start, stop, volume)[foreground]
+                                      for i in imgs]) if imgs else np.empty((region_index.size, 0))
+            update_accumulators(acc, region_index, values, channels)
+            if 'median' in stats:
+                gathered.append((region_index, values))
+        if gathered and imgs:
+            medians[channels] = grouped_median(np.concatenate([g[0] for g in gathered]),
+                                               np.concatenate([g[1] for g in gathered]), region_ids.size)
+
+    results = finalize_accumulators(acc, stats)
+    if 'median' in stats:
+        results['median'] = medians
+    return region_ids, results
+
 def extract_metrics_from_roi(
     label_img_path: Union[str, Path],
     metric_img_paths: List[Union[str, Path]],
     metric_names: List[str],
-    subject_id: str
+    subject_id: str,
+    stats: Sequence[str] = ('mean',),
+    max_memory: Optional[int] = None
 ) -> pd.DataFrame:
     """
-    Extract mean scalar metrics for each labeled region from volumetric ROIs.
+    Extract scalar metric summaries for each labeled region from volumetric ROIs.
 
     Parameters:
-        label_img_path: NIfTI image with integer labels per voxel (atlas or ROI)
-        metric_img_paths: List of paths to scalar images (e.g., T1, qT1, FA)
+        label_img_path: NIfTI image with integer labels per voxel (atlas or ROI), or the loaded image
+        metric_img_paths: List of paths to (or loaded) scalar images (e.g., T1, qT1, FA).
+            4D images (e.g., fMRI, multi-shell DWI) are summarised per volume.
         metric_names: Names of the scalar variables to assign to columns
         subject_id: Subject identifier
+        stats: Statistics to report per region, any of SUPPORTED_STATS.
+            All statistics are computed from the same pass over the data.
+        max_memory: If given, stream the images slab by slab in their native dtype,
+            keeping roughly this many bytes of image data in memory at a time.
 
     Returns:
-        pd.DataFrame with columns: ['subject', 'region'] + metric_names
+        pd.DataFrame with columns: ['subject', 'region'] + metric_names for the mean,
+        plus '<metric>_<stat>' for every other requested statistic. 4D metrics
+        contribute one '<metric>_vol<t>' column per volume.
     """
-    label_data, label_img = load_nifti(label_img_path)
-    metric_data_list = [load_nifti(p)[0] for p in metric_img_paths]
-    metric_imgs = [nib.load(str(p)) for p in metric_img_paths]
+    stats = check_stats(stats)
+    if max_memory is None:
+        # Every image is decompressed once, all of them in parallel on threads
+        label_img, *metric_imgs = nio.load_niftis([label_img_path] + list(metric_img_paths))
+    else:
+        # Headers are read once; the data stays behind (memory-mapped) proxies until needed,
+        # each read through one open handle so compressed files are not re-decompressed per slab
+        label_img = nio.as_image(label_img_path, keep_file_open=True)
+        metric_imgs = [nio.as_image(p, keep_file_open=True) for p in metric_img_paths]
     
     # Ensure all images are in the same space
     check_affines(label_img, metric_imgs)
 
-    df_rows = []
-    region_ids = np.unique(label_data)
-    region_ids = region_ids[region_ids != 0]  # Exclude background (0)
+    if max_memory is None:
+        label_data = label_img.get_fdata()
+        metric_data_list = [img.get_fdata() for img in metric_imgs]
+        region_ids, results = reduce_by_label(label_data, metric_data_list, stats)
+    else:
+        region_ids, results = reduce_by_label_streamed(label_img, metric_imgs, stats, max_memory)
+
+    return results_to_frame(subject_id, region_ids, results,
+                            channel_names(metric_names, metric_imgs), stats)
+
+def read_manifest(manifest_path: Union[str, Path]) -> pd.DataFrame:
+    """
+    Read a batch manifest with one row per subject.
+
+    The manifest is a CSV (or TSV, by extension) with a 'subject' column, a 'label'
+    column holding the label image path, and one column per metric whose header is
+    the metric name and whose cells are the metric image paths.
+    """
+    manifest_path = Path(manifest_path)
+    sep = '\t' if manifest_path.suffix in ('.tsv', '.txt') else ','
+    manifest = pd.read_csv(manifest_path, sep=sep, dtype=str)
+    missing = {'subject', 'label'} - set(manifest.columns)
+    if missing:
+        raise ValueError(f"Manifest is missing required columns: {sorted(missing)}")
+    if len(manifest.columns) < 3:
+        raise ValueError("Manifest needs at least one metric column besides 'subject' and 'label'.")
+    return manifest
+
+def _load_manifest_row(row: Dict[str, str], metric_names: List[str],
+                       max_memory: Optional[int]) -> List[nib.Nifti1Image]:
+    paths = [row['label']] + [row[name] for name in metric_names]
+    if max_memory is None:
+        return nio.load_niftis(paths)
+    # Streamed subjects are read slab by slab later; only their headers are read ahead
+    return [nio.as_image(path, keep_file_open=True) for path in paths]
+
+def _write_partition(df: pd.DataFrame, out_dir: Path, subject_id: str):
+    # The subject stays a string column of the file: a hive-style subject=<id> directory
+    # would have its ids type-inferred on read (e.g. '01' -> 1)
+    part_dir = out_dir / str(subject_id)
+    part_dir.mkdir(parents=True, exist_ok=True)
+    df.astype({'subject': str}).to_parquet(part_dir / 'part-0.parquet', index=False)
+
+def _extract_chunk(rows: List[Dict[str, str]], metric_names: List[str], stats: Sequence[str],
+                   max_memory: Optional[int], out_dir: Path) -> List[Tuple[str, Optional[Exception]]]:
+    # While one subject is reduced, the next subject's images are read on background threads
+    results = []
+    for row, images in nio.prefetch(rows, lambda row: _load_manifest_row(row, metric_names, max_memory)):
+        try:
+            label_img, *metric_imgs = images.result()
+            df = extract_metrics_from_roi(label_img, metric_imgs, metric_names, row['subject'],
+                                          stats, max_memory)
+            _write_partition(df, out_dir, row['subject'])
+            results.append((row['subject'], None))
+        except Exception as err:
+            results.append((row['subject'], err))
+    return results
+
+def extract_metrics_batch(
+    manifest: Union[str, Path, pd.DataFrame],
+    out_dir: Union[str, Path],
+    max_workers: Optional[int] = None,
+    stats: Sequence[str] = ('mean',),
+    max_memory: Optional[int] = None,
+    max_pending: Optional[int] = None,
+    chunk_size: Optional[int] = None
+) -> pd.DataFrame:
+    """
+    Run extract_metrics_from_roi for every subject of a manifest on a process pool.
+
+    Subjects are handed to the workers in chunks of chunk_size; within a chunk the
+    images of the next subject are read on background threads while the current one
+    is reduced (see nifti_io.prefetch). Each finished subject is written straight away
+    by its worker as its own partition of a Parquet dataset under out_dir
+    (out_dir/<id>/part-0.parquet, replacing the partition of an earlier run), so
+    results stream to disk while other subjects are still running; read them back
+    with pd.read_parquet(out_dir). A subject that fails is recorded and the run
+    continues; if a worker process dies, the unwritten subjects queued on the pool are
+    recorded as failed and the remaining ones run on a new pool.
+
+    Parameters:
+        manifest: Manifest path or DataFrame, see read_manifest
+        out_dir: Root directory of the Parquet dataset
+        max_workers: Number of worker processes (default: os.cpu_count())
+        stats: Statistics to report per region, any of SUPPORTED_STATS
+        max_memory: Per-subject streaming memory ceiling, see extract_metrics_from_roi
+        max_pending: Maximum number of chunks queued on the pool at once
+            (default: twice the number of workers)
+        chunk_size: Number of consecutive subjects run by one worker task
+            (default: the subjects split evenly over the workers). A dead worker
+            loses the unwritten subjects of its chunk; 1 isolates every subject.
+
+    Returns:
+        pd.DataFrame with columns ['subject', 'error'] listing the failed subjects,
+        also written to out_dir/_failures.csv (ignored by Parquet readers)
+    """
+    stats = check_stats(stats)
+    if not isinstance(manifest, pd.DataFrame):
+        manifest = read_manifest(manifest)
+    metric_names = [c for c in manifest.columns if c not in ('subject', 'label')]
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    records = manifest.to_dict(orient='records')
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_size = max(1, chunk_size or math.ceil(len(records) / max_workers))
+    chunks = iter([records[i:i + chunk_size] for i in range(0, len(records), chunk_size)])
+    limit = max_pending or 2 * max_workers
+    failures = []
+    pool = ProcessPoolExecutor(max_workers=max_workers)
+    pending = {}
+
+    def fail(subject_id, err):
+        print(f'{subject_id} failed: {err!r}')
+        failures.append([subject_id, repr(err)])
+
+    def restart(err):
+        # A worker died (e.g. killed for running out of memory), which breaks the whole
+        # pool: every subject queued on it that has not been written is lost, and the
+        # rest go to a fresh pool
+        nonlocal pool
+        for subject_ids in pending.values():
+            for subject_id in subject_ids:
+                if not (out_dir / str(subject_id) / 'part-0.parquet').exists():
+                    fail(subject_id, err)
+        pending.clear()
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+
+    def submit(chunk):
+        return pool.submit(_extract_chunk, chunk, metric_names, stats, max_memory, out_dir)
 
-    for region_id in region_ids:
-        mask = label_data == region_id
-        region_label = f"region_{int(region_id)}"
+    def fill():
+        while len(pending) < limit:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            # A partition left by an earlier run would pass for this run's result
+            for row in chunk:
+                shutil.rmtree(out_dir / str(row['subject']), ignore_errors=True)
+            try:
+                future = submit(chunk)
+            except BrokenProcessPool as err:
+                restart(err)
+                future = submit(chunk)
+            pending[future] = [row['subject'] for row in chunk]
 
-        metrics = []
-        for metric_data in metric_data_list:
-            masked_values = metric_data[mask]
-            mean_val = np.nanmean(masked_values)
-            metrics.append(mean_val)
+    try:
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            broken = None
+            for future in done:
+                subject_ids = pending.pop(future)
+                try:
+                    results = future.result()
+                except BrokenProcessPool as err:
+                    pending[future] = subject_ids
+                    broken = err
+                    continue
+                except Exception as err:
+                    results = [(subject_id, err) for subject_id in subject_ids]
+                for subject_id, err in results:
+                    if err is not None:
+                        fail(subject_id, err)
+            if broken is not None:
+                restart(broken)
+            fill()
+    finally:
+        pool.shutdown(cancel_futures=True)
+        # Written even if the run is interrupted, together with the subjects never finished
+        failures.extend([subject_id, 'not finished'] for subject_ids in pending.values()
+                        for subject_id in subject_ids)
+        failures = pd.DataFrame(failures, columns=['subject', 'error'])
+        failures.to_csv(out_dir / '_failures.csv', index=False)
+    return failures
 
-        row = [subject_id, region_label] + metrics
-        df_rows.append(row)
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Extract per-region metrics for every subject of a manifest into a Parquet dataset.")
+    parser.add_argument('manifest', help="CSV/TSV with 'subject', 'label' and one column per metric")
+    parser.add_argument('out_dir', help="Output Parquet dataset directory")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes")
+    parser.add_argument('--stats', nargs='+', default=['mean'], choices=SUPPORTED_STATS)
+    parser.add_argument('--max-memory', type=int, default=None,
+                        help="Stream images with roughly this many bytes in memory per subject")
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help="Subjects per worker task (default: split evenly over the workers); "
+                             "the next subject's images are read while the current one is reduced")
+    args = parser.parse_args(argv)
 
-    columns = ['subject', 'region'] + metric_names
-    return pd.DataFrame(df_rows, columns=columns)
+    failures = extract_metrics_batch(args.manifest, args.out_dir, args.workers,
+                                     args.stats, args.max_memory, chunk_size=args.chunk_size)
+    if len(failures):
+        print(f'{len(failures)} subject(s) failed, see {Path(args.out_dir) / "_failures.csv"}')
+        return 1
+    return 0
 
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import scipy.sparse as sp
+
+import extract_roi_metrics as erm
+import project_label_utilities as pl
+import subject_cache as sc
+import surface_interpolation as si
+
+def _surface_stamp(subject_path: str, hemi: str) -> List:
+    # The sampled surfaces derive from white and pial; a re-run recon-all invalidates the operator
+    stamp = []
+    for surf in ('white', 'pial'):
+        fname = os.path.join(subject_path, 'surf', f'{hemi}.{surf}')
+        stamp.append(os.stat(fname).st_mtime_ns if os.path.exists(fname) else None)
+    return stamp
+
+def sampling_key(subject_path: str, hemi: str, img: nib.spatialimages.SpatialImage,
+                 method: str, surface: str) -> str:
+    """
+    Key identifying the volume -> cortex sampling operator of a hemisphere and image grid.
+    """
+    subject_path = os.path.abspath(os.fspath(subject_path))
+    parts = [subject_path, hemi, surface, method, list(img.shape[:3]),
+             np.round(img.affine, 6).tolist(), _surface_stamp(subject_path, hemi)]
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+def build_sampling_operator(vertex_voxels: np.ndarray, shape: Tuple[int, ...],
+                            method: str = 'nearest') -> sp.csr_matrix:
+    """
+    Build the sparse matrix that samples a volume at surface vertices.
+
+    Row i holds the weights of the voxels contributing to vertex i, so that
+    vertex_data = operator @ voxel_data with the voxels in C order. Rows of
+    vertices outside the volume are empty; 'linear' rows are renormalised over the
+    voxels inside the volume.
+
+    Parameters:
+        vertex_voxels: Fractional voxel coordinates of every vertex, shape (n_vertices, 3)
+        shape: Spatial shape of the volume
+        method: 'nearest' (nearest voxel, as image_to_cortex uses for labels) or 'linear' (trilinear)
+
+    Returns:
+        scipy.sparse.csr_matrix of shape (n_vertices, n_voxels)
+    """
+    n_vertices = len(vertex_voxels)
+    n_voxels = int(np.prod(shape))
+    if method == 'nearest':
+        corners = np.round(vertex_voxels).astype(np.int64)[:, None, :]
+        weights = np.ones((n_vertices, 1))
+    elif method == 'linear':
+        base = np.floor(vertex_voxels)
+        frac = vertex_voxels - base
+        offsets = np.array(np.meshgrid([0, 1], [0, 1], [0, 1], indexing='ij')).reshape(3, -1).T
+        corners = base.astype(np.int64)[:, None, :] + offsets[None, :, :]
+        weights = np.prod(np.where(offsets[None, :, :] == 1, frac[:, None, :], 1 - frac[:, None, :]), axis=-1)
+    else:
+        raise ValueError("method needs to be 'nearest' or 'linear'.")
+
+    inside = np.all((corners >= 0) & (corners < shape), axis=-1) & (weights > 0)
+    rows = np.nonzero(inside)[0]
+    cols = np.ravel_multi_index(tuple(corners[inside].T), shape)
+    operator = sp.csr_matrix((weights[inside], (rows, cols)), shape=(n_vertices, n_voxels))
+    if method == 'linear':
+        totals = np.asarray(operator.sum(axis=1)).ravel()
+        operator = sp.diags(np.divide(1, totals, out=np.zeros_like(totals), where=totals > 0)) @ operator
+    return operator.tocsr()
+
+def sampling_operator(subject_path: str, hemi: str, img: nib.spatialimages.SpatialImage,
+                      method: str = 'nearest', surface: str = 'midgray',
+                      cache_dir: Optional[str] = None) -> sp.csr_matrix:
+    """
+    Load (or build once and save) the volume -> cortex sampling operator of a subject's hemisphere.
+
+    The vertices of the given surface are mapped to voxels the way image_to_cortex
+    does (vertex -> native RAS -> voxel), so one operator serves every image on the
+    same grid.
+
+    Parameters:
+        subject_path: Path to the FreeSurfer subject
+        hemi: 'lh' or 'rh'
+        img: Any image on the grid to sample (only its header is used)
+        method: 'nearest' or 'linear', see build_sampling_operator
+        surface: Surface whose vertices are sampled. Default is 'midgray'.
+        cache_dir: Directory to persist operators in as .npz files, see
+            surface_interpolation.cached_operator. If None, operators are only kept
+            for the lifetime of the process.
+
+    Returns:
+        scipy.sparse.csr_matrix of shape (vertex count, voxel count)
+    """
+    if hemi not in ('lh', 'rh'):
+        raise ValueError("Hemisphere needs to be specified as 'lh' or 'rh'.")
+
+    key = sampling_key(subject_path, hemi, img, method, surface)
+
+    def build():
+        sub = sc.load_subject(subject_path)
+        vertex_to_voxel = np.linalg.inv(img.affine) @ np.linalg.inv(sub.native_to_vertex_matrix)
+        coordinates = np.asarray(getattr(sub, hemi).surfaces[surface].coordinates).T
+        return build_sampling_operator(nib.affines.apply_affine(vertex_to_voxel, coordinates),
+                                       img.shape[:3], method)
+
+    return si.cached_operator(key, build, cache_dir, f'{hemi}.sample.{method}')
+
+def sample_metrics(operator: sp.csr_matrix, metric_imgs: List[nib.spatialimages.SpatialImage]) -> np.ndarray:
+    """
+    Sample every channel of every metric image at the vertices with one sparse product.
+
+    Returns:
+        Array of shape (n_vertices, n_channels); vertices outside the volume are NaN.
+    """
+    n_voxels = operator.shape[1]
+    data = np.column_stack([np.asanyarray(img.dataobj).reshape(n_voxels, -1) for img in metric_imgs]) \
+        if metric_imgs else np.empty((n_voxels, 0))
+    values = operator @ data.astype(np.float64, copy=False)
+    values[np.diff(operator.indptr) == 0] = np.nan
+    return values
+
+def extract_surface_metrics(
+    sub_id: str,
+    fs_dir: str,
+    metric_img_paths: List[Union[str, Path]],
+    metric_names: List[str],
+    labels: Optional[list] = None,
+    annot: Optional[str] = None,
+    hemi: str = 'both',
+    stats: Sequence[str] = ('mean',),
+    method: str = 'nearest',
+    surface: str = 'midgray',
+    cache_dir: Optional[str] = None
+) -> pd.DataFrame:
+    """
+    Extract scalar metric summaries for each surface label, without projecting labels to the volume.
+
+    The metric volumes are sampled at the vertices of both hemispheres with a cached
+    sparse operator (see sampling_operator), all channels in one product, and reduced
+    per label with the grouped bincounts of extract_roi_metrics. Labels may overlap;
+    a vertex counts towards every label it is in.
+
+    Parameters:
+        sub_id: A single subject ID
+        fs_dir: Directory containing FreeSurfer subjects
+        metric_img_paths: List of paths to scalar images sharing one grid (e.g., T1, qT1, FA).
+            4D images are summarised per volume.
+        metric_names: Names of the scalar variables to assign to columns
+        labels: Label names (label/<hemi>.<name>.label) or in-memory SparseLabels;
+            ignored if annot is given
+        annot: Annotation name (label/<hemi>.<annot>.annot) to use instead of label files
+        hemi: 'lh', 'rh' or 'both'
+        stats: Statistics to report per label, any of SUPPORTED_STATS
+        method: Volume sampling method, 'nearest' or 'linear'
+        surface: Surface whose vertices are sampled. Default is 'midgray'.
+        cache_dir: Directory of the cached sampling operators
+
+    Returns:
+        pd.DataFrame with the columns of extract_metrics_from_roi; 'region' holds
+        '<hemi>.<label name>'. Vertices outside the metric volume count as NaN.
+    """
+    stats = erm.check_stats(stats)
+    sub_dir = f'{fs_dir}{sub_id}/'
+    metric_imgs = [nib.load(str(p)) for p in metric_img_paths]
+    erm.check_affines(metric_imgs[0], metric_imgs[1:])
+    hemis = ['lh', 'rh'] if hemi == 'both' else [hemi]
+
+    per_hemi, _ = pl.read_atlas_vertices(sub_dir, labels, annot, hemis)
+
+    # One (region, vertex) pair per labelled vertex of every hemisphere
+    region_names, region_index, values = [], [], []
+    for h in hemis:
+        hemi_labels = per_hemi[h]
+        if not hemi_labels:
+            continue
+        operator = sampling_operator(sub_dir, h, metric_imgs[0], method, surface, cache_dir)
+        vertices = [np.asarray(v, dtype=np.int64) for v in hemi_labels.values()]
+        region_index.append(len(region_names) + np.repeat(np.arange(len(vertices)),
+                                                          [len(v) for v in vertices]))
+        # Only the rows of labelled vertices take part in the product
+        labelled, inverse = np.unique(np.concatenate(vertices), return_inverse=True)
+        values.append(sample_metrics(operator[labelled], metric_imgs)[inverse.ravel()])
+        region_names.extend(f'{h}.{name}' for name in hemi_labels)
+
+    n_channels = len(erm.channel_names(metric_names, metric_imgs))
+    region_index = np.concatenate(region_index) if region_index else np.empty(0, dtype=np.int64)
+    values = np.concatenate(values) if values else np.empty((0, n_channels))
+
+    acc = erm.init_accumulators(n_channels, len(region_names))
+    erm.update_accumulators(acc, region_index, values)
+    results = erm.finalize_accumulators(acc, stats)
+    if 'median' in stats:
+        results['median'] = erm.grouped_median(region_index, values, len(region_names))
+
+    df = erm.results_to_frame(sub_id, np.arange(len(region_names)), results,
+                              erm.channel_names(metric_names, metric_imgs), stats)
+    df['region'] = region_names
+    return df
@@ -0,0 +1,184 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+
+# Set to a JSON-lines path to trace every process that imports this module
+TRACE_ENV_VAR = 'PROJECT_LABEL_TRACE'
+
+# ru_maxrss is in KiB on Linux and bytes on macOS
+_RSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+# Events kept in memory for summary(); older ones are only in the sink
+MAX_EVENTS = 10_000
+
+_enabled = False
+_sink = None
+_run_id = None
+_events = deque(maxlen=MAX_EVENTS)
+_lock = threading.Lock()
+_local = threading.local()
+_disabled_span = nullcontext()
+
+
+def enable(sink=None, run_id=None):
+    '''
+    Start recording spans.
+
+    Parameters:
+    sink (str, callable or None): JSON-lines file every event is appended to, or a
+        callable receiving each event dict. The last MAX_EVENTS events are also
+        kept for summary().
+    run_id (str or None): Identifier stored on every event. Defaults to '<pid>-<start time>'.
+    '''
+    global _enabled, _sink, _run_id
+    _sink = sink
+    _run_id = run_id or f'{os.getpid()}-{int(time.time())}'
+    _enabled = True
+
+
+def disable():
+    '''Stop recording spans; recorded events are kept until reset().'''
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    '''Drop the recorded events.'''
+    with _lock:
+        _events.clear()
+
+
+def is_enabled():
+    return _enabled
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_SCALE
+
+
+def _emit(event):
+    with _lock:
+        _events.append(event)
+    if _sink is None:
+        return
+    if callable(_sink):
+        _sink(event)
+        return
+    # One O_APPEND write per event so concurrent workers can share a trace file
+    fd = os.open(_sink, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(event, default=str) + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def _span(name, attrs):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    stack.append(name)
+
+    peak_before = _peak_rss()
+    start = time.time()
+    wall, cpu = time.perf_counter(), time.process_time()
+    status = 'ok'
+    try:
+        yield attrs
+    except BaseException as err:
+        status = type(err).__name__
+        raise
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        peak_after = _peak_rss()
+        stack.pop()
+        _emit({'event': 'span', 'name': name, 'parent': parent, 'run': _run_id,
+               'pid': os.getpid(), 'start': start, 'wall_s': wall, 'cpu_s': cpu,
+               'peak_rss_bytes': peak_after, 'peak_rss_growth_bytes': peak_after - peak_before,
+               'status': status, 'attrs': attrs})
+
+
+def span(name, **attrs):
+    '''
+    Context manager timing one named pipeline stage.
+
+    When instrumentation is enabled the span records its wall and CPU time, the
+    process peak RSS at its end and how much the span raised it, its parent span
+    and its attributes, and emits them as one event. The yielded dict can be used
+    to add attributes from inside the span. When disabled a shared no-op context
+    is returned, so instrumented code pays one function call per stage.
+
+    Parameters:
+    name (str): Stage name, e.g. 'syn_registration'.
+    **attrs: JSON-serialisable attributes stored on the event (subject, file, ...).
+    '''
+    if not _enabled:
+        return _disabled_span
+    return _span(name, attrs)
+
+
+def events():
+    '''A copy of the events recorded so far.'''
+    with _lock:
+        return list(_events)
+
+
+def summary(recorded=None):
+    '''
+    Aggregate span events per stage name.
+
+    Parameters:
+    recorded (list or None): Events to aggregate, e.g. read back from a trace file
+        with read_trace. Defaults to the events recorded in this process.
+
+    Returns:
+    dict: name -> count, total/max wall time, total CPU time and the largest peak
+    RSS and peak RSS growth seen, in order of total wall time.
+    '''
+    totals = defaultdict(lambda: {'count': 0, 'wall_s': 0.0, 'max_wall_s': 0.0, 'cpu_s': 0.0,
+                                  'peak_rss_bytes': 0, 'peak_rss_growth_bytes': 0})
+    for event in (events() if recorded is None else recorded):
+        if event.get('event') != 'span':
+            continue
+        stage = totals[event['name']]
+        stage['count'] += 1
+        stage['wall_s'] += event['wall_s']
+        stage['max_wall_s'] = max(stage['max_wall_s'], event['wall_s'])
+        stage['cpu_s'] += event['cpu_s']
+        stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], event['peak_rss_bytes'])
+        stage['peak_rss_growth_bytes'] = max(stage['peak_rss_growth_bytes'],
+                                             event['peak_rss_growth_bytes'])
+    return dict(sorted(totals.items(), key=lambda item: -item[1]['wall_s']))
+
+
+def format_summary(totals=None):
+    '''Render summary() as a text table.'''
+    totals = summary() if totals is None else totals
+    lines = [f"{'stage':<24} {'count':>6} {'wall s':>10} {'max s':>9} {'cpu s':>10} {'peak MB':>9} {'+MB':>8}"]
+    for name, s in totals.items():
+        lines.append(f"{name:<24} {s['count']:>6} {s['wall_s']:>10.3f} {s['max_wall_s']:>9.3f} "
+                     f"{s['cpu_s']:>10.3f} {s['peak_rss_bytes'] / 1024 ** 2:>9.0f} "
+                     f"{s['peak_rss_growth_bytes'] / 1024 ** 2:>8.0f}")
+    return '\n'.join(lines)
+
+
+def read_trace(trace_fname):
+    '''Read the events of a JSON-lines trace file.'''
+    with open(trace_fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if os.environ.get(TRACE_ENV_VAR):
+    enable(os.environ[TRACE_ENV_VAR])
+
+
+if __name__ == '__main__':
+    # python instrumentation.py trace.jsonl -> per-stage summary of a trace file
+    print(format_summary(summary(read_trace(sys.argv[1]))))
@@ -0,0 +1,175 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import nifti_io as nio
+
+# vertices (n,) int, coords (n, 3) in mm, values (n,), comment str
+FreeSurferLabel = namedtuple('FreeSurferLabel', ['vertices', 'coords', 'values', 'comment'])
+
+# Set to 1 to keep binary sidecars next to the labels read, or to a directory to keep them there
+CACHE_ENV_VAR = 'PROJECT_LABEL_LABEL_CACHE'
+
+# Row format written by mne.Label.save, kept so outputs stay byte-compatible
+_ROW_FORMAT = '%d %f %f %f %f\n'
+
+
+def _sidecar_path(fname, cache_dir=None):
+    head, name = os.path.split(os.path.abspath(fname))
+    return os.path.join(cache_dir or head, f'.{name}.npz')
+
+
+def _read_sidecar(sidecar, stat):
+    try:
+        with np.load(sidecar) as cached:
+            if int(cached['mtime_ns']) != stat.st_mtime_ns or int(cached['size']) != stat.st_size:
+                return None
+            return FreeSurferLabel(cached['vertices'], cached['coords'], cached['values'],
+                                   str(cached['comment']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _write_sidecar(sidecar, stat, label):
+    # A sidecar is only an optimisation; an unwritable directory is not an error
+    try:
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        with nio.atomic_output(sidecar, suffix='.npz') as tmp:
+            np.savez(tmp, vertices=label.vertices, coords=label.coords, values=label.values,
+                     comment=np.array(label.comment), mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+    except OSError:
+        pass
+
+
+def parse_label(text):
+    '''
+    Parse the contents of a FreeSurfer ASCII .label file in bulk.
+
+    Parameters:
+    text (str): The file contents.
+
+    Returns:
+    FreeSurferLabel: vertices, coords, values and comment of the label.
+    '''
+    comment = ''
+    if text.startswith('#'):
+        comment, _, text = text.partition('\n')
+        comment = comment[1:]
+    count, _, body = text.lstrip().partition('\n')
+    n_vertices = int(count)
+
+    # One C-level parse of every number instead of a Python loop over lines
+    data = np.fromstring(body, sep=' ') if n_vertices else np.empty(0)
+    if data.size != 5 * n_vertices:
+        raise ValueError(f'Label file declares {n_vertices} vertices but holds {data.size / 5:g} rows.')
+    data = data.reshape(n_vertices, 5)
+    return FreeSurferLabel(data[:, 0].astype(np.int64), data[:, 1:4], data[:, 4], comment)
+
+
+def read_label(fname, use_cache=None, cache_dir=None):
+    '''
+    Read a FreeSurfer .label file into NumPy arrays.
+
+    Optionally a compact binary copy is kept as .<name>.npz, tagged with the label's
+    mtime and size, so later reads of an unchanged label skip text parsing entirely.
+    The sidecar is opt-in, so that nothing is written into FreeSurfer label/
+    directories or shared atlas trees unless asked for. Callers that do not pass
+    use_cache follow the PROJECT_LABEL_LABEL_CACHE environment variable: 1 keeps
+    the sidecars next to the labels, a path keeps them in that directory.
+
+    Parameters:
+    fname (str): Path to the .label file.
+    use_cache (bool or None): Read and write the sidecar next to the label (or in cache_dir).
+        None follows PROJECT_LABEL_LABEL_CACHE, which is off when unset.
+    cache_dir (str or None): Directory for the sidecar files; giving one enables the sidecar.
+
+    Returns:
+    FreeSurferLabel: vertices, coords, values and comment of the label.
+    '''
+    if use_cache is None and cache_dir is None:
+        setting = os.environ.get(CACHE_ENV_VAR, '')
+        use_cache = bool(setting) and setting != '0'
+        cache_dir = setting if use_cache and setting != '1' else None
+    fname = os.fspath(fname)
+    stat = os.stat(fname)
+    sidecar = _sidecar_path(fname, cache_dir) if use_cache or cache_dir is not None else None
+
+    if sidecar is not None and os.path.exists(sidecar):
+        label = _read_sidecar(sidecar, stat)
+        if label is not None:
+            return label
+
+    with open(fname) as f:
+        label = parse_label(f.read())
+
+    if sidecar is not None:
+        _write_sidecar(sidecar, stat, label)
+    return label
+
+
+def format_label(vertices, coords=None, values=None, comment=''):
+    '''
+    Format a label as FreeSurfer ASCII text with a single string-formatting call.
+    '''
+    vertices = np.asarray(vertices)
+    n_vertices = len(vertices)
+    coords = np.zeros((n_vertices, 3)) if coords is None else np.asarray(coords, dtype=float)
+    values = np.zeros(n_vertices) if values is None else np.asarray(values, dtype=float)
+    data = np.column_stack([vertices, coords, values])
+    return f'#{comment}\n{n_vertices}\n' + (_ROW_FORMAT * n_vertices) % tuple(data.ravel().tolist())
+
+
+def write_label(fname, vertices, coords=None, values=None, comment=''):
+    '''
+    Write a FreeSurfer .label file from arrays in one buffered write.
+
+    Parameters:
+    fname (str): Output path.
+    vertices (array): Vertex indices.
+    coords (array or None): (n, 3) vertex coordinates in mm. Zeros if None.
+    values (array or None): Per-vertex values. Zeros if None.
+    comment (str): Text of the header comment line.
+    '''
+    with open(os.fspath(fname), 'w') as f:
+        f.write(format_label(vertices, coords, values, comment))
+
+
+def label_fname(fname, hemi):
+    '''
+    The path mne.Label.save writes to for fname: '.label' is appended and the
+    hemisphere is added as '-<hemi>' unless the name already starts or ends with it.
+    '''
+    head, name = os.path.split(os.fspath(fname))
+    if name.endswith('.label'):
+        name = name[:-6]
+    if not (name.startswith(hemi) or name.endswith(hemi)):
+        name += '-' + hemi
+    return os.path.join(head, name) + '.label'
+
+
+def read_mne_label(fname, hemi, name=None):
+    '''
+    Read a .label file (through read_label) into an mne.Label of hemisphere hemi.
+    '''
+    import mne
+    label = read_label(fname)
+    return mne.Label(label.vertices, pos=label.coords / 1e3, values=label.values, hemi=hemi,
+                     comment=label.comment, name=name)
+
+
+def save_mne_label(label, fname):
+    '''
+    Save an mne.Label (or SparseLabel) like mne.Label.save does, but through write_label.
+
+    The filename gets the same treatment as in mne, see label_fname.
+
+    Returns:
+    str: The path written.
+    '''
+    fname = label_fname(fname, label.hemi)
+
+    # mne keeps positions in metres; label files store millimetres
+    write_label(fname, label.vertices, np.asarray(label.pos) * 1e3, label.values,
+                label.comment or '')
+    return fname
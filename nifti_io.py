@@ -0,0 +1,332 @@
+import contextlib
+import itertools
+import os
+import shutil
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+import nibabel as nib
+
+# nibabel's own default; level 1 is several times faster than 6 for a few % larger files
+DEFAULT_COMPRESSLEVEL = 1
+# Uncompressed bytes per independently compressed gzip block
+BLOCK_SIZE = 4 * 1024 ** 2
+
+# LPS (ITK) <-> RAS (NIfTI)
+_LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def as_image(img, keep_file_open=None):
+    '''
+    Load img with nibabel if it is a path; loaded images are returned as they are.
+
+    With keep_file_open=True the proxy reads every slice through one open file
+    handle, so reading a .nii.gz slab by slab decompresses it once (front to back)
+    instead of from the first byte for every slab; indexed_gzip, when installed,
+    also makes backward seeks cheap.
+    '''
+    if isinstance(img, nib.spatialimages.SpatialImage):
+        return img
+    return nib.load(str(img), keep_file_open=keep_file_open)
+
+
+def load_nifti(fname):
+    '''
+    Read an image fully into memory, decompressing it once.
+
+    The returned image holds the (scaled) data as an in-memory array, so later
+    reads of the data, or of parts of it, cost nothing. zlib releases the GIL
+    while decompressing, so several images can be read in parallel on threads.
+    '''
+    img = as_image(fname)
+    return img.__class__(np.asanyarray(img.dataobj), img.affine, img.header)
+
+
+def load_niftis(fnames, max_workers=None):
+    '''Read several images fully into memory on parallel threads, see load_nifti.'''
+    fnames = list(fnames)
+    if len(fnames) < 2:
+        return [load_nifti(fname) for fname in fnames]
+    with ThreadPoolExecutor(max_workers=max_workers or len(fnames)) as pool:
+        return list(pool.map(load_nifti, fnames))
+
+
+def prefetch(items, load, depth=1, max_workers=None):
+    '''
+    Iterate over items while loading the following ones on background threads.
+
+    Parameters:
+    items (iterable): Work items, e.g. the jobs of a batch.
+    load (callable): Function reading the inputs of one item.
+    depth (int): Number of items loaded ahead of the one being processed.
+    max_workers (int or None): Loader threads. Defaults to depth + 1.
+
+    Yields:
+    (item, future): The item and the future of load(item); calling future.result()
+    returns the loaded inputs or raises the error of that item only.
+    '''
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers or depth + 1) as pool:
+        pending = deque((item, pool.submit(load, item)) for item in itertools.islice(items, depth + 1))
+        while pending:
+            item, future = pending.popleft()
+            for following in itertools.islice(items, 1):
+                pending.append((following, pool.submit(load, following)))
+            yield item, future
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+@contextlib.contextmanager
+def atomic_output(fname, suffix='.tmp'):
+    '''
+    Write a file or directory under a temporary name and rename it to fname on success.
+
+    The temporary name is hidden, next to fname and unique to the process and thread,
+    so concurrent readers never see a partial output and concurrent writers do not
+    collide. If the block raises, or the rename fails (e.g. fname is a directory that
+    is not empty), the temporary output is removed and the error propagates.
+
+    Parameters:
+    fname (str or Path): Final path.
+    suffix (str): Suffix of the temporary name, for writers that pick the format by
+                  extension (e.g. '.npz').
+
+    Yields:
+    str: The temporary path to write to.
+    '''
+    fname = os.fspath(fname)
+    tmp = os.path.join(os.path.dirname(fname),
+                       f'.{os.path.basename(fname)}.{os.getpid()}-{threading.get_ident()}{suffix}')
+    _remove(tmp)
+    try:
+        yield tmp
+        os.replace(tmp, fname)
+    finally:
+        # A no-op after a successful rename
+        _remove(tmp)
+
+
+def slab_bounds(shape, bytes_per_voxel, max_memory):
+    '''
+    Split the third axis into (start, stop) slabs that each fit in max_memory bytes.
+
+    Slabs run along the third axis because NIfTI data is stored in Fortran order,
+    so every slab is a contiguous run of the file (per volume).
+
+    Parameters:
+    shape (tuple): Image shape; only the three spatial axes are used.
+    bytes_per_voxel (int): Bytes held per voxel of a slab, working copies included.
+    max_memory (int): Approximate ceiling in bytes per slab.
+
+    Returns:
+    list of (int, int): Slab bounds; at least one slice each.
+    '''
+    slice_bytes = max(1, shape[0] * shape[1] * bytes_per_voxel)
+    step = max(1, int(max_memory // slice_bytes))
+    return [(start, min(start + step, shape[2])) for start in range(0, shape[2], step)]
+
+
+def read_slab(img, start, stop, volume=None, dtype=None):
+    '''
+    Read voxels [:, :, start:stop] through the image proxy; only these voxels are read from disk.
+
+    Parameters:
+    img (nibabel image): Image to read, ideally a proxy opened with keep_file_open=True.
+    start, stop (int): Slab bounds along the third axis, see slab_bounds.
+    volume (int or None): Position of a single volume of a 4D image; all volumes by default.
+    dtype (dtype or None): Convert to this dtype; the result is then always a fresh,
+                           writable array the caller may modify in place. By default the
+                           on-disk (scaled) dtype is kept.
+
+    Returns:
+    np.ndarray: The slab.
+    '''
+    if volume is None or len(img.shape) < 4:
+        data = np.asanyarray(img.dataobj[:, :, start:stop, ...])
+    else:
+        data = np.asanyarray(img.dataobj[(slice(None), slice(None), slice(start, stop))
+                                         + np.unravel_index(volume, img.shape[3:])])
+    if dtype is None:
+        return data
+    # Read-only (memory-mapped) or shared (in-memory image) buffers are copied
+    return data.astype(dtype, copy=not (data.flags.writeable and data.base is None))
+
+
+def _compress_block(block, compresslevel, last):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A sync flush ends every block on a byte boundary so the raw streams can be concatenated
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_compress(data, compresslevel=DEFAULT_COMPRESSLEVEL, max_workers=None, block_size=BLOCK_SIZE):
+    '''
+    Compress bytes into a single-member gzip stream, compressing blocks on parallel threads.
+
+    Blocks are deflated independently (as pigz does), so the result is slightly
+    larger than a serial gzip of the same level but decompresses with any gzip reader.
+
+    Parameters:
+    data (bytes-like): Data to compress.
+    compresslevel (int): zlib level, 0 (stored, no compression) to 9.
+    max_workers (int or None): Compression threads. Defaults to os.cpu_count().
+    block_size (int): Uncompressed bytes per block.
+
+    Returns:
+    bytes: The gzip file contents.
+    '''
+    view = memoryview(data).cast('B')
+    starts = range(0, max(len(view), 1), block_size)
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as pool:
+        blocks = [pool.submit(_compress_block, view[start:start + block_size], compresslevel,
+                              start + block_size >= len(view)) for start in starts]
+        # The checksum of the whole stream is computed while the blocks compress
+        crc = zlib.crc32(view)
+        body = b''.join(block.result() for block in blocks)
+    xfl = b'\x02' if compresslevel == 9 else b'\x04' if compresslevel == 1 else b'\x00'
+    header = b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + xfl + b'\xff'
+    return header + body + struct.pack('<II', crc & 0xffffffff, len(view) & 0xffffffff)
+
+
+def write_nifti(img, fname, compresslevel=DEFAULT_COMPRESSLEVEL, max_workers=None):
+    '''
+    Save a NIfTI image, compressing .nii.gz outputs on parallel threads.
+
+    The file is written under a temporary name and renamed, so readers never see a
+    partial file. Images that are not single-file NIfTI are saved with to_filename.
+
+    Parameters:
+    img (nibabel image): Image to save.
+    fname (str): Output path; a .gz suffix selects gzip compression.
+    compresslevel (int): zlib level of .nii.gz outputs; 0 stores the data uncompressed.
+    max_workers (int or None): Compression threads, see gzip_compress.
+
+    Returns:
+    str: fname.
+    '''
+    fname = os.fspath(fname)
+    if not isinstance(img, (nib.Nifti1Image, nib.Nifti2Image)):
+        img.to_filename(fname)
+        return fname
+    data = img.to_bytes()
+    if fname.endswith('.gz'):
+        data = gzip_compress(data, compresslevel, max_workers)
+    with atomic_output(fname) as tmp, open(tmp, 'wb') as f:
+        f.write(data)
+    return fname
+
+
+class AsyncWriter:
+    '''
+    Background writer of NIfTI outputs with a bounded queue.
+
+    submit hands an image to the writer threads and returns immediately, so the
+    caller can go on computing while the previous outputs are compressed and
+    written; it blocks once max_pending images are waiting, which bounds the
+    memory held by queued outputs.
+
+    Parameters:
+    max_pending (int): Images queued or being written before submit blocks.
+    writers (int): Images written concurrently.
+    compresslevel (int): zlib level of .nii.gz outputs; 0 stores the data uncompressed.
+    compress_workers (int or None): Compression threads per image, see gzip_compress.
+    '''
+
+    def __init__(self, max_pending=2, writers=1, compresslevel=DEFAULT_COMPRESSLEVEL,
+                 compress_workers=None):
+        self.compresslevel = compresslevel
+        self.compress_workers = compress_workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=writers)
+        self._futures = {}
+
+    def submit(self, img, fname):
+        '''Queue img to be written to fname; returns the future of the write.'''
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(write_nifti, img, fname, self.compresslevel, self.compress_workers)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures[os.fspath(fname)] = future
+        return future
+
+    def wait(self):
+        '''
+        Wait for every queued write.
+
+        Returns:
+        dict: Output path -> the exception of its write, or None if it was written.
+        '''
+        futures = dict(self._futures)
+        wait(futures.values())
+        return {fname: future.exception() for fname, future in futures.items()}
+
+    def close(self):
+        '''
+        Wait for every queued write and stop the writer threads.
+
+        Returns:
+        dict: Output path -> the exception of its write, or None, see wait.
+        '''
+        written = self.wait()
+        self._pool.shutdown()
+        return written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        errors = [error for error in self.close().values() if error is not None]
+        # A write error is raised unless the caller's own error is already propagating
+        if errors and exc_type is None:
+            raise errors[0]
+
+
+def ants_to_nifti(img):
+    '''Convert an ANTsImage to a nibabel image in memory, without a temporary file.'''
+    # 4D label stacks carry a unit 4th axis; the spatial part is the upper-left 3x3
+    affine = np.eye(4)
+    affine[:3, :3] = np.asarray(img.direction)[:3, :3] * np.asarray(img.spacing)[:3]
+    affine[:3, 3] = np.asarray(img.origin)[:3]
+    nii = nib.Nifti1Image(img.numpy(), _LPS @ affine)
+    # Scanner coordinates in both forms, as ITK writes them
+    nii.set_qform(nii.affine, code=1)
+    nii.set_sform(nii.affine, code=1)
+    return nii
+
+
+def write_ants(img, fname, compresslevel=DEFAULT_COMPRESSLEVEL, writer=None):
+    '''
+    Save an ANTsImage. NIfTI outputs go through write_nifti (block-parallel gzip,
+    atomic rename), or onto writer's queue if an AsyncWriter is given; other
+    formats are written by ITK.
+    '''
+    fname = os.fspath(fname)
+    if not fname.endswith(('.nii', '.nii.gz')):
+        img.image_write(filename=fname)
+    elif writer is not None:
+        writer.submit(ants_to_nifti(img), fname)
+    else:
+        write_nifti(ants_to_nifti(img), fname, compresslevel)
+    return fname
+
+
+def nifti_to_ants(img):
+    '''Convert a nibabel image to an ANTsImage in memory, without a temporary file.'''
+    import ants
+    affine = _LPS @ img.affine
+    spacing = np.linalg.norm(affine[:3, :3], axis=0)
+    return ants.from_numpy(np.asarray(img.dataobj, dtype=np.float32),
+                           origin=tuple(affine[:3, 3]), spacing=tuple(spacing),
+                           direction=affine[:3, :3] / spacing)
@@ -0,0 +1,243 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import instrumentation as ins
+
+# Thread pools that ANTs/ITK, OpenMP and the BLAS libraries size from the environment
+THREAD_ENV_VARS = ('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS',
+                   'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+# Routes whose registration is shared by every ROI of a subject
+_VOLUME_ROUTES = {('MNI', 'native'): 'mni2native', ('native', 'MNI'): 'native2mni'}
+
+
+def job_id(job):
+    '''
+    Stable identifier of a job, used to record and skip completed work.
+    '''
+    blob = json.dumps(job, sort_keys=True, default=str).encode()
+    return hashlib.sha1(blob).hexdigest()
+
+
+def read_jobs(manifest_fname):
+    '''
+    Read a job manifest with one JSON object per line.
+
+    Every job has 'sub_id', 'label', 'from_space' and 'to_space', plus an optional
+    'options' dict with the remaining project_label keyword arguments
+    (fs_dir, out_dir, t1_fname, roi_fname, ...).
+    '''
+    jobs = []
+    with open(manifest_fname) as f:
+        for line in f:
+            if line.strip():
+                job = json.loads(line)
+                missing = {'sub_id', 'from_space', 'to_space'} - set(job)
+                if missing:
+                    raise ValueError(f"Job is missing required fields {sorted(missing)}: {line.strip()}")
+                jobs.append(job)
+    return jobs
+
+
+def read_state(state_fname):
+    '''
+    Return the ids of the jobs recorded as done in a state file.
+    '''
+    done = set()
+    if state_fname is None or not os.path.exists(state_fname):
+        return done
+    with open(state_fname) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if record.get('status') == 'done':
+                done.add(record['job_id'])
+    return done
+
+
+def _record(state_fname, job, status, error=None):
+    if state_fname is None:
+        return
+    line = json.dumps({'job_id': job_id(job), 'sub_id': job['sub_id'], 'status': status,
+                       'error': error, 'time': time.time()}) + '\n'
+    # One small O_APPEND write per record keeps concurrent workers from interleaving
+    fd = os.open(state_fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def _init_worker(threads, trace_fname=None):
+    # Runs in each fresh (spawned) worker before any numerical library is imported
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    if trace_fname is not None:
+        ins.enable(trace_fname)
+
+
+def group_jobs(jobs):
+    '''
+    Group jobs by subject, keeping the manifest order within each group.
+    '''
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(job['sub_id'], []).append(job)
+    return list(groups.values())
+
+
+def run_subject_jobs(jobs, state_fname=None, transform_cache_dir=None):
+    '''
+    Run all jobs of one subject in the current process.
+
+    MNI <-> native jobs that share a T1, brain-mask setting, direction and warp/save
+    options are batched into a single registration; the other routes run one by one
+    and share the process-wide subject cache.
+
+    Returns:
+    list: (job_id, error) pairs for the failed jobs.
+    '''
+    # Imported here so the thread budget set by _init_worker is in place first
+    import project_label
+    import project_label_utilities as pl
+    import transform_cache as tc
+
+    cache = tc.TransformCache(transform_cache_dir) if transform_cache_dir else None
+    failures = []
+
+    batches = OrderedDict()
+    others = []
+    for job in jobs:
+        opts = job.get('options', {})
+        direction = _VOLUME_ROUTES.get((job['from_space'], job['to_space']))
+        if direction and opts.get('t1_fname') and opts.get('roi_fname'):
+            # Saving is set per batch, so jobs that save their output are not batched with
+            # jobs that do not (which have no output filename)
+            key = (direction, opts['t1_fname'], bool(opts.get('calc_brain_mask', False)),
+                   bool(opts.get('restrict_to_roi', False)), bool(opts.get('save_coreg', False)))
+            batches.setdefault(key, []).append(job)
+        else:
+            others.append(job)
+
+    for (direction, t1_fname, calc_brain_mask, restrict_to_roi, save_coreg), batch in batches.items():
+        warp = pl.MNI_label_2_native if direction == 'mni2native' else pl.native_label_2_mni
+        try:
+            warp(t1_fname, batch[0]['sub_id'], calc_brain_mask,
+                 [job['options']['roi_fname'] for job in batch], save_coreg,
+                 [job['options'].get('out_dir') for job in batch], cache,
+                 restrict_to_roi=restrict_to_roi)
+        except Exception as err:
+            for job in batch:
+                _record(state_fname, job, 'failed', repr(err))
+                failures.append((job_id(job), repr(err)))
+            continue
+        for job in batch:
+            _record(state_fname, job, 'done')
+
+    for job in others:
+        opts = dict(job.get('options', {}))
+        opts.setdefault('transform_cache', cache)
+        try:
+            project_label.project_label(job['sub_id'], job.get('label'), opts.pop('fs_dir', None),
+                                        opts.pop('out_dir', None), from_space=job['from_space'],
+                                        to_space=job['to_space'], **opts)
+        except Exception as err:
+            _record(state_fname, job, 'failed', repr(err))
+            failures.append((job_id(job), repr(err)))
+            continue
+        _record(state_fname, job, 'done')
+
+    return failures
+
+
+def run_pipeline(jobs, state_fname=None, max_workers=None, threads_per_worker=None,
+                 transform_cache_dir=None, trace_fname=None):
+    '''
+    Run project_label jobs for many subjects on a process pool.
+
+    Jobs are grouped per subject so that each subject's FreeSurfer data and
+    registration are loaded or computed once, and the groups run in parallel. Every
+    worker is given an explicit ITK/OpenMP/BLAS thread budget so that concurrent
+    ANTs registrations do not oversubscribe the machine. Finished jobs are appended
+    to the state file; re-running with the same state file skips them, so an
+    interrupted run resumes where it stopped.
+
+    Parameters:
+    jobs (list of dict): Jobs as returned by read_jobs.
+    state_fname (str or None): JSON-lines file recording finished and failed jobs.
+    max_workers (int or None): Number of worker processes. Default is os.cpu_count().
+    threads_per_worker (int or None): Threads each worker may use. Default splits the cores evenly.
+    transform_cache_dir (str or None): Directory of a TransformCache shared by all workers.
+    trace_fname (str or None): JSON-lines file the workers append per-stage timing events to.
+
+    Returns:
+    dict: Counts of 'done', 'skipped' and 'failed' jobs and the (job_id, error) 'failures'.
+    '''
+    cpus = os.cpu_count() or 1
+    max_workers = max_workers or cpus
+    threads_per_worker = threads_per_worker or max(1, cpus // max_workers)
+
+    done = read_state(state_fname)
+    pending = [job for job in jobs if job_id(job) not in done]
+    skipped = len(jobs) - len(pending)
+    groups = group_jobs(pending)
+    if skipped:
+        print(f'Skipping {skipped} job(s) already done according to {state_fname}')
+
+    failures = []
+    finished = 0
+    # Spawned workers start clean, so the thread budget applies before any import
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                             initializer=_init_worker, initargs=(threads_per_worker, trace_fname)) as pool:
+        futures = {pool.submit(run_subject_jobs, group, state_fname, transform_cache_dir): group
+                   for group in groups}
+        for future in as_completed(futures):
+            group = futures[future]
+            try:
+                group_failures = future.result()
+            except Exception as err:
+                # The worker itself died; every job of the subject counts as failed
+                group_failures = [(job_id(job), repr(err)) for job in group]
+            failures.extend(group_failures)
+            finished += len(group)
+            print(f'[{finished}/{len(pending)}] {group[0]["sub_id"]}: '
+                  f'{len(group) - len(group_failures)} done, {len(group_failures)} failed')
+
+    return {'done': len(pending) - len(failures), 'skipped': skipped,
+            'failed': len(failures), 'failures': failures}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run project_label jobs for many subjects in parallel.")
+    parser.add_argument('manifest', help="JSON-lines job manifest")
+    parser.add_argument('--state', default=None,
+                        help="JSON-lines state file used to resume an interrupted run")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes")
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help="ITK/BLAS threads per worker")
+    parser.add_argument('--transform-cache', default=None,
+                        help="Directory caching the MNI <-> native registrations")
+    parser.add_argument('--trace', default=None,
+                        help="JSON-lines file for per-stage timing and memory events")
+    args = parser.parse_args(argv)
+
+    summary = run_pipeline(read_jobs(args.manifest), args.state, args.workers,
+                           args.threads_per_worker, args.transform_cache, args.trace)
+    print(f"{summary['done']} done, {summary['skipped']} skipped, {summary['failed']} failed")
+    if args.trace and os.path.exists(args.trace):
+        print(ins.format_summary(ins.summary(ins.read_trace(args.trace))))
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,48 +1,91 @@
-import neuropythy as ny
+import os
+
 import numpy as np
-from nilearn import surface
-import mne
 import nibabel as nib
+import ants
+import label_io as lio
+import nifti_io as nio
 import project_label_utilities as pl
+import space_router as sr
+import sparse_label as sl
+import subject_cache as sc
+
+
+def _stored(result_store, route, inputs, params, outputs, compute, load):
+    # Runs compute directly unless a result store is given and the route writes files
+    if result_store is None or not outputs or None in outputs:
+        return compute()
+    return result_store.cached(route, inputs, params, outputs, compute, load)
+
+
+def _surface_inputs(subject_path, hemi):
+    # Files the fsnative <-> fsaverage operator is built from
+    return [f for f in sc.subject_files(subject_path) if f.endswith(f'{hemi}.sphere.reg')]
 
 
 def project_label(sub_id, label, fs_dir, out_dir, 
                    from_space='surface', to_space='volumetric', 
                    fsnative_path=None, fsaverage_path=None, 
-                   t1_fname=None, roi_fname=None, calc_brain_mask=False, save_coreg=False):
+                   t1_fname=None, roi_fname=None, calc_brain_mask=False, save_coreg=False,
+                   transform_cache=None, result_store=None, restrict_to_roi=False):
     """
     Project labels from one space to another (surface to volumetric or vice versa).
 
     Parameters:
     -----------
     sub_id (str): The subject ID.
-    label (str or numpy.ndarray): The label(s) to project.
+    label (str, list or numpy.ndarray): The label(s) to project; a list of surface labels
+        is rasterized into a single atlas volume.
     fs_dir (str): Directory containing FreeSurfer subjects.
     out_dir (str): Directory to save output labels.
     from_space (str): The space of the input label ('surface', 'volumetric', 'fsnative', 'fsaverage', 'MNI', 'native').
     to_space (str): The space to which to convert ('surface', 'volumetric', 'fsnative', 'fsaverage', 'MNI', 'native').
+        Pairs without a dedicated route (e.g. MNI -> fsnative) are chained in memory by space_router.
     fsnative_path (str): Path to the native FreeSurfer subject or mesh.
     fsaverage_path (str): Path to the fsaverage surface.
     t1_fname (str): Path to the T1 file for MNI to Native conversion.
-    roi_fname (str): Path to the ROI file for label conversion.
+    roi_fname (str or list): Path to the ROI file for label conversion; MNI <-> native
+        routes also accept a list of ROI files warped with a single registration.
     calc_brain_mask (bool): Whether to calculate a brain mask.
     save_coreg (bool): Whether to save the coregistration to file.
+    transform_cache (TransformCache): Optional on-disk cache of the MNI <-> native registrations.
+    result_store (ResultStore): Optional content-addressed store of the written outputs. Routes
+        whose inputs and parameters were seen before restore their files from it instead of recomputing.
+    restrict_to_roi (bool): MNI <-> native only; resample just the region of the output grid each
+        ROI maps to, which is much faster for small ROIs.
 
     Returns:
     --------
-    dict or mne.Label or ants.ANTsImage: The projected label(s) in the new space.
+    dict or SparseLabel or ants.ANTsImage: The projected label(s) in the new space.
     """
     
     if from_space == 'surface' and to_space == 'volumetric':
         # Convert surface label to volumetric
-        vol_output = pl.surf_label_2_vol(sub_id, label, fs_dir, roi_fname, out_dir=out_dir)
+        sub_dir = f'{fs_dir}{sub_id}/'
+        single = isinstance(label, str) and out_dir is not None
+        vol_output = _stored(
+            result_store, 'surface->volumetric',
+            sc.subject_files(sub_dir) + [f'{sub_dir}label/{h}.{label}.label' for h in ('lh', 'rh')] if single else [],
+            {}, [f'{out_dir}{sub_id}_{label}_vol.nii.gz'] if single else [],
+            lambda: pl.surf_label_2_vol(sub_id, label, fs_dir, out_dir=out_dir),
+            lambda paths: nib.load(paths[0]))
         return vol_output
     
     elif from_space == 'volumetric' and to_space == 'surface':
         print(out_dir)
         # Convert volumetric label to surface
-        vol_label = nib.load(label)  # Assuming `label` is a filename for a volumetric NIfTI image.
-        surf_output = pl.vol_label_2_surf(sub_id, vol_label, fs_dir, roi_fname, out_dir)
+        def load_labels(paths):
+            return {f'{h}_label': sl.SparseLabel.read(p, h, roi_fname)
+                    for h, p in zip(('lh', 'rh'), paths) if p is not None}
+
+        surf_output = _stored(
+            result_store, 'volumetric->surface',
+            sc.subject_files(f'{fs_dir}/{sub_id}/') + [label], {'roi_fname': roi_fname},
+            [lio.label_fname(f'{out_dir}{h}_{sub_id}_{roi_fname}', h) for h in ('lh', 'rh')]
+            if out_dir is not None else [],
+            # Assuming `label` is a filename for a volumetric NIfTI image.
+            lambda: pl.vol_label_2_surf(sub_id, nib.load(label), fs_dir, roi_fname, out_dir),
+            load_labels)
         return surf_output  # Now returns a dictionary with 'lh_label' or 'rh_label'
 
     elif from_space == 'fsnative' and to_space == 'fsaverage':
@@ -50,7 +93,15 @@ def project_label(sub_id, label, fs_dir, out_dir,
             raise ValueError("Paths for fsnative and fsaverage must be provided.")
         
         native_label_indices = label  # Assuming `label` is an array of vertex indices.
-        surf_output = pl.fsnative_label_2_fsaverage(fsnative_path, fsaverage_path, native_label_indices, 'lh', out_dir)
+        output_filename = f'{out_dir}lh_{sub_id}_{roi_fname}' if out_dir and roi_fname else None
+        surf_output = _stored(
+            result_store, 'fsnative->fsaverage',
+            _surface_inputs(fsnative_path, 'lh') + _surface_inputs(fsaverage_path, 'lh'),
+            {'label': np.asarray(native_label_indices).tolist(), 'hemi': 'lh'},
+            [lio.label_fname(output_filename, 'lh')] if output_filename else [],
+            lambda: pl.fsnative_label_2_fsaverage(fsnative_path, fsaverage_path, native_label_indices,
+                                                  'lh', roi_fname, output_filename),
+            lambda paths: sl.SparseLabel.read(paths[0], 'lh', roi_fname))
         return surf_output
     
     elif from_space == 'fsaverage' and to_space == 'fsnative':
@@ -58,22 +109,76 @@ def project_label(sub_id, label, fs_dir, out_dir,
             raise ValueError("Paths for fsnative and fsaverage must be provided.")
         
         average_label_indices = label  # Assuming `label` is an array of vertex indices.
-        native_output = pl.fsaverage_label_2_fsnative(fsaverage_path, fsnative_path, average_label_indices, 'lh', out_dir)
+        output_filename = f'{out_dir}lh_{sub_id}_{roi_fname}' if out_dir and roi_fname else None
+        native_output = _stored(
+            result_store, 'fsaverage->fsnative',
+            _surface_inputs(fsaverage_path, 'lh') + _surface_inputs(fsnative_path, 'lh'),
+            {'label': np.asarray(average_label_indices).tolist(), 'hemi': 'lh'},
+            [lio.label_fname(output_filename, 'lh')] if output_filename else [],
+            lambda: pl.fsaverage_label_2_fsnative(fsaverage_path, fsnative_path, average_label_indices,
+                                                  'lh', roi_fname, output_filename),
+            lambda paths: sl.SparseLabel.read(paths[0], 'lh', roi_fname))
         return native_output
 
-    elif from_space == 'MNI' and to_space == 'native':
+    elif (from_space, to_space) in (('MNI', 'native'), ('native', 'MNI')):
         if t1_fname is None or roi_fname is None:
             raise ValueError("Paths for T1 file and ROI file must be provided.")
-        
-        native_output = pl.MNI_label_2_native(t1_fname, sub_id, calc_brain_mask, roi_fname, save_coreg, out_dir)
-        return native_output
-    
-    elif from_space == 'native' and to_space == 'MNI':
-        if t1_fname is None or roi_fname is None:
-            raise ValueError("Paths for T1 file and ROI file must be provided.")
-            
-        mni_output = pl.native_label_2_mni(t1_fname, sub_id, calc_brain_mask, roi_fname, save_coreg, out_fname)
-        return mni_output
+
+        warp = pl.MNI_label_2_native if from_space == 'MNI' else pl.native_label_2_mni
+        batched = isinstance(roi_fname, (list, tuple))
+        roi_fnames = list(roi_fname) if batched else [roi_fname]
+        out_fnames = (list(out_dir) if batched else [out_dir]) if save_coreg else []
+
+        def load_coreg(paths):
+            images = [ants.image_read(p) for p in paths]
+            return images if batched else images[0]
+
+        vol_output = _stored(
+            result_store, f'{from_space}->{to_space}',
+            [getattr(t1_fname, 'fspath', t1_fname), pl.template_image('mni')[0]] + roi_fnames,
+            # restrict_to_roi only enters the key when set, so existing entries stay valid
+            dict({'calc_brain_mask': bool(calc_brain_mask)}, **({'restrict_to_roi': True} if restrict_to_roi else {})),
+            out_fnames,
+            lambda: warp(t1_fname, sub_id, calc_brain_mask, roi_fname, save_coreg, out_dir,
+                         transform_cache, restrict_to_roi=restrict_to_roi),
+            load_coreg)
+        return vol_output
     
+    elif {from_space, to_space} <= set(sr.SPACES + tuple(sr.ALIASES)):
+        # Any other pair is planned over the space graph and run in memory
+        return _routed(sub_id, label, fs_dir, out_dir, from_space, to_space, fsnative_path,
+                       fsaverage_path, t1_fname, roi_fname, calc_brain_mask, transform_cache)
+
+    else:
+        raise ValueError("Unsupported space conversion requested.")
+
+
+def _routed(sub_id, label, fs_dir, out_dir, from_space, to_space, fsnative_path, fsaverage_path,
+            t1_fname, roi_fname, calc_brain_mask, transform_cache):
+    """
+    Multi-hop projection through space_router, e.g. MNI -> fsnative or fsaverage -> native.
+
+    The input is label, or roi_fname for volumetric inputs given as a file. Only the
+    final result is written: a NIfTI volume, or one .label file per hemisphere and
+    label id.
+    """
+    subject = sr.SubjectSpace(fsnative_path or f'{fs_dir}{sub_id}/', t1_fname, calc_brain_mask)
+    source = label if label is not None else roi_fname
+    result = sr.route_label(source, from_space, to_space, subject, fsaverage_path=fsaverage_path,
+                            transform_cache=transform_cache)
+    if out_dir is None:
+        return result
+
+    name = 'label'
+    if isinstance(roi_fname, str):
+        name = os.path.basename(roi_fname).replace('.nii.gz', '').replace('.nii', '')
+    if isinstance(result, dict):
+        for h, ids in result.items():
+            label_ids = np.unique(ids[ids != 0])
+            for label_id in label_ids:
+                suffix = '' if len(label_ids) == 1 else f'_{label_id}'
+                lio.write_label(lio.label_fname(f'{out_dir}{h}_{sub_id}_{name}{suffix}', h),
+                                np.flatnonzero(ids == label_id))
     else:
-        raise ValueError("Unsupported space conversion requested.")
\ No newline at end of file
+        nio.write_ants(result, f'{out_dir}{sub_id}_{name}_{to_space}.nii.gz')
+    return result
\ No newline at end of file
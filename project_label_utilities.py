@@ -2,93 +2,360 @@ import numpy as np
 import neuropythy as ny
 import ants
 import nibabel as nib
-import mne
+import label_io as lio
+import nifti_io as nio
+import sparse_label as sl
+import subject_cache as sc
+import surface_interpolation as si
+import transform_cache as tc
+import roi_warp as rw
+import instrumentation as ins
+
+def resolve_label_overlap(label_vertices, label_ids, vertex_count, overlap='smallest'):
+    '''
+    Combine many surface labels into a single integer vertex map.
+
+    Parameters:
+    label_vertices (list of array or SparseLabel): Vertex indices of every label.
+    label_ids (array): Integer value written for every label (0 is background).
+    vertex_count (int): Number of vertices of the hemisphere.
+    overlap (str): Which label keeps a vertex claimed by several labels: 'smallest'
+                   (the label with the fewest vertices, so small ROIs are not swallowed),
+                   'first' or 'last' (by position in label_vertices).
+
+    Returns:
+    np.ndarray: Integer array of length vertex_count holding the winning label id per vertex.
+    '''
+    vertex_map = np.zeros(vertex_count, dtype=np.int32)
+    if len(label_vertices) == 0:
+        return vertex_map
+
+    sizes = np.array([len(v) for v in label_vertices])
+    if overlap == 'smallest':
+        priority = sizes
+    elif overlap == 'first':
+        priority = np.arange(len(label_vertices))
+    elif overlap == 'last':
+        priority = -np.arange(len(label_vertices))
+    else:
+        raise ValueError("overlap needs to be 'smallest', 'first' or 'last'.")
+
+    vertices = np.concatenate([np.asarray(getattr(v, 'vertices', v), dtype=np.int64)
+                               for v in label_vertices])
+    ids = np.repeat(np.asarray(label_ids, dtype=np.int32), sizes)
+    order = np.argsort(np.repeat(priority, sizes), kind='stable')
+
+    # The first occurrence of every vertex in priority order wins
+    winners, first = np.unique(vertices[order], return_index=True)
+    vertex_map[winners] = ids[order][first]
+    return vertex_map
+
+
+def group_vertices_by_label(vertex_labels):
+    '''
+    Group vertex indices by their label value with a single sort.
+
+    Parameters:
+    vertex_labels (array): Integer label value per vertex.
+
+    Returns:
+    dict: Label value -> sorted array of the vertex indices carrying it.
+    '''
+    vertex_labels = np.asarray(vertex_labels)
+    order = np.argsort(vertex_labels, kind='stable')
+    values, starts = np.unique(vertex_labels[order], return_index=True)
+    return dict(zip(values.tolist(), np.split(order, starts[1:])))
+
+
+def read_atlas_vertices(sub_dir, labels, annot, hemis):
+    '''
+    Collect per-hemisphere label vertices and a shared name -> id lookup table.
+
+    Parameters:
+    sub_dir (str): Path to the FreeSurfer subject, ending in '/'.
+    labels (list of str or SparseLabel, or None): Label names (label/<hemi>.<name>.label) or
+                                                 in-memory labels; ignored if annot is given.
+    annot (str or None): Annotation name (label/<hemi>.<annot>.annot) to use instead of label files.
+    hemis (list of str): Hemispheres to read, 'lh' and/or 'rh'.
+
+    Returns:
+    per_hemi (dict): {hemi: {name: vertex indices}} for every hemisphere in hemis.
+    lut (dict): Label name -> integer id, numbered from 1 in reading order.
+    '''
+    lut = {}
+    per_hemi = {}
+    for h in hemis:
+        if annot is not None:
+            vertex_labels, _, names = nib.freesurfer.read_annot(f'{sub_dir}label/{h}.{annot}.annot')
+            names = [n.decode() if isinstance(n, bytes) else n for n in names]
+            hemi_labels = {names[e]: g for e, g in group_vertices_by_label(vertex_labels).items()
+                           if e >= 0 and names[e] not in ('unknown', '???')}
+        else:
+            # In-memory SparseLabels are used as they are, names are read from label/
+            hemi_labels = {}
+            for label in labels:
+                if isinstance(label, sl.SparseLabel):
+                    if label.hemi == h:
+                        hemi_labels[label.name] = label.vertices
+                else:
+                    hemi_labels[label] = lio.read_label(f'{sub_dir}label/{h}.{label}.label').vertices
+        for name in hemi_labels:
+            lut.setdefault(name, len(lut) + 1)
+        per_hemi[h] = hemi_labels
+    return per_hemi, lut
+
+
+def _write_volume(vol, fname, writer=None):
+    # Compressed in parallel blocks and renamed into place, see nifti_io
+    if writer is not None:
+        writer.submit(vol, fname)
+    else:
+        nio.write_nifti(vol, fname)
+
+
+def surf_atlas_2_vol(sub_id, labels, fs_dir, out_dir=None, hemi='both', annot=None,
+                     overlap='smallest', atlas_name=None, writer=None):
+    '''
+    Rasterize many surface labels, or an annotation, into a single integer label volume.
+
+    All labels are merged into one integer vertex map per hemisphere, which is projected
+    to the volume with a single nearest-neighbour cortex_to_image pass.
+
+    Parameters:
+    sub_id (str): A single subject ID.
+    labels (list of str or SparseLabel, or None): Label names (label/<hemi>.<name>.label) or
+                                                 in-memory labels; ignored if annot is given.
+    fs_dir (str): Directory containing FreeSurfer subjects.
+    out_dir (str or None): Directory to save the label volume and its lookup table. If None, nothing is saved.
+    hemi (str): Specify 'lh', 'rh', or 'both' to determine which hemispheres to process. Default is 'both'.
+    annot (str or None): Annotation name (label/<hemi>.<annot>.annot) to use instead of label files.
+    overlap (str): How vertices shared by several labels are resolved, see resolve_label_overlap.
+    atlas_name (str or None): Name used in the output filenames. Defaults to annot or 'atlas'.
+    writer (nifti_io.AsyncWriter or None): Queue the volume on this writer instead of writing it
+                                           before returning, e.g. when rasterizing many subjects.
+
+    Returns:
+    vol: The integer label volume.
+    lut (dict): Mapping from label id in the volume to label name.
+    '''
+    sub_dir = f'{fs_dir}{sub_id}/'
+    sub = sc.load_subject(sub_dir)
+    hemis = ['lh', 'rh'] if hemi == 'both' else [hemi]
+
+    per_hemi, lut = read_atlas_vertices(sub_dir, labels, annot, hemis)
+
+    vertex_maps = []
+    for h in ('lh', 'rh'):
+        hemi_labels = per_hemi.get(h, {})
+        vertex_maps.append(resolve_label_overlap(list(hemi_labels.values()),
+                                                 [lut[name] for name in hemi_labels],
+                                                 getattr(sub, h).vertex_count, overlap))
+
+    # Create a template volume to fill with labels
+    template = ny.image_clear(sub.images['ribbon'])
+    vol = sub.cortex_to_image(tuple(vertex_maps), im=template, method='nearest', dtype=np.int32)
+
+    lut = {label_id: name for name, label_id in lut.items()}
+    if out_dir is not None:
+        atlas_name = atlas_name or annot or 'atlas'
+        _write_volume(vol, f'{out_dir}{sub_id}_{atlas_name}_vol.nii.gz', writer)
+        with open(f'{out_dir}{sub_id}_{atlas_name}_lut.tsv', 'w') as f:
+            f.write('index\tname\n')
+            f.writelines(f'{label_id}\t{name}\n' for label_id, name in lut.items())
+
+    return vol, lut
+
 
-def surf_label_2_vol(sub_id, label, fs_dir, out_dir=None, hemi='both'):
+def surf_label_2_vol(sub_id, label, fs_dir, out_dir=None, hemi='both', annot=None,
+                     overlap='smallest', atlas_name=None, writer=None):
     '''
     Convert surface labels to volumetric NIfTI images for specified subjects and ROIs.
 
+    Passing a list of labels, or an annotation, rasterizes them all at once into a
+    single integer label volume (see surf_atlas_2_vol).
+
     Parameters:
     sub_id (str): A list of subject IDs or a single subject ID.
-    labels (str): A list of labels or a single label.
+    labels (str, SparseLabel or list): A list of labels or a single label, by name or as a SparseLabel.
     fs_dir (str): Directory containing FreeSurfer subjects.
     out_dir (str or None): Directory to save the output NIfTI volumes. If None, volumes are not saved. Default is None.
     hemi (str): Specify 'lh', 'rh', or 'both' to determine which hemispheres to process. Default is 'both'.
+    annot (str or None): Annotation name to rasterize instead of label files.
+    overlap (str): Atlas mode only; how vertices shared by several labels are resolved.
+    atlas_name (str or None): Atlas mode only; name used in the output filenames.
+    writer (nifti_io.AsyncWriter or None): Queue the volume on this writer instead of writing it
+                                           before returning.
 
     Returns:
     np.ndarray: An array of shape (number of subjects, number of ROIs) containing the generated volumes.
+    In atlas mode, a (volume, lookup table) tuple as returned by surf_atlas_2_vol.
     '''
+    if annot is not None or isinstance(label, (list, tuple)):
+        return surf_atlas_2_vol(sub_id, label, fs_dir, out_dir, hemi, annot, overlap, atlas_name, writer)
   
     # Make sure that the ny module is ready to be used
-    sub = ny.freesurfer_subject(f'{fs_dir}{sub_id}/')
+    sub = sc.load_subject(f'{fs_dir}{sub_id}/')
 
     # Create a template volume to fill with labels
     template = sub.images['ribbon']
     template = ny.image_clear(template)
     
-    # Initialize masks for both hemispheres
-    label_lh_mask = np.zeros(sub.lh.vertex_count)
-    label_rh_mask = np.zeros(sub.rh.vertex_count)
-
-    # Process left hemisphere if needed
-    if hemi in ['lh', 'both']:
-        label_lh = sub.load(f'label/lh.{label}.label')
-        label_lh_mask[label_lh[0]] = True
+    # Sparse labels of the processed hemispheres
+    if isinstance(label, sl.SparseLabel):
+        hemi_labels = {label.hemi: label} if hemi in (label.hemi, 'both') else {}
+        label_name = label.name
+    else:
+        hemi_labels = {h: sl.SparseLabel.read(f'{fs_dir}{sub_id}/label/{h}.{label}.label', h, label)
+                       for h in ('lh', 'rh') if hemi in (h, 'both')}
+        label_name = label
 
-    # Process right hemisphere if needed
-    if hemi in ['rh', 'both']:
-        label_rh = sub.load(f'label/rh.{label}.label')
-        label_rh_mask[label_rh[0]] = True
+    # Dense masks are only built here, as cortex_to_image needs them
+    masks = tuple(hemi_labels[h].to_mask(getattr(sub, h).vertex_count, dtype=float) if h in hemi_labels
+                  else np.zeros(getattr(sub, h).vertex_count) for h in ('lh', 'rh'))
 
     # Convert masks to NIfTI object
-    vol = sub.cortex_to_image((label_lh_mask, label_rh_mask), im=template)
+    vol = sub.cortex_to_image(masks, im=template)
 
     # Save volume if out_dir is provided
     if out_dir is not None:
-        vol.to_filename(f'{out_dir}{sub_id}_{label}_vol.nii.gz')
+        _write_volume(vol, f'{out_dir}{sub_id}_{label_name}_vol.nii.gz', writer)
     
     return vol
 
 
-def vol_label_2_surf(sub_id, label, fs_dir, roi_fname, out_dir=None,hemi='both'):
+def read_lut(lut_fname):
+    '''
+    Read a label id -> name lookup table as written by surf_atlas_2_vol (index<TAB>name).
+    '''
+    lut = {}
+    with open(lut_fname) as f:
+        next(f)
+        for line in f:
+            if line.strip():
+                label_id, name = line.rstrip('\n').split('\t', 1)
+                lut[int(label_id)] = name
+    return lut
+
+
+def vol_atlas_2_surf(sub_id, atlas_img, fs_dir, out_dir=None, hemi='both', lut=None,
+                     annot_name=None):
+    '''
+    Project an integer label volume (atlas) to the cortical surface in a single pass.
+
+    The volume is sampled once per hemisphere with nearest-neighbour image_to_cortex and
+    the vertices are grouped by label id with one sort, instead of projecting every
+    label as its own binary volume.
+
+    Parameters:
+    sub_id (str): A single subject ID.
+    atlas_img (nii object): A nifti object holding integer labels per voxel (0 is background).
+    fs_dir (str): Directory containing FreeSurfer subjects.
+    out_dir (str or None): Directory to save the output labels. If None, labels are not saved.
+    hemi (str): Specify 'lh', 'rh', or 'both' to determine which hemispheres to process. Default is 'both'.
+    lut (dict, str or None): Label id -> name mapping, or the path of a lookup table
+                             written by surf_atlas_2_vol. Unnamed ids are called 'label_<id>'.
+    annot_name (str or None): If given (and out_dir is set), write one <hemi>.<sub_id>_<annot_name>.annot
+                              per hemisphere instead of one .label file per label.
+
+    Returns:
+    dict: {'lh': {name: SparseLabel}, 'rh': {name: SparseLabel}} for the processed hemispheres.
+    '''
+    if isinstance(lut, str):
+        lut = read_lut(lut)
+    lut = lut or {}
+
+    with ins.span('subject_load', sub_id=sub_id):
+        sub = sc.load_subject(f'{fs_dir}/{sub_id}/')
+    with ins.span('cortex_sampling', sub_id=sub_id, method='nearest'):
+        lh_ids, rh_ids = sub.image_to_cortex(atlas_img, method='nearest')
+    hemis = ['lh', 'rh'] if hemi == 'both' else [hemi]
+
+    labels = {}
+    for h, vertex_ids in zip(('lh', 'rh'), (lh_ids, rh_ids)):
+        if h not in hemis:
+            continue
+        vertex_ids = np.round(np.nan_to_num(vertex_ids)).astype(np.int64)
+        groups = {label_id: vertices
+                  for label_id, vertices in group_vertices_by_label(vertex_ids).items()
+                  if label_id != 0}
+        names = {label_id: lut.get(label_id, f'label_{label_id}') for label_id in groups}
+        labels[h] = {names[label_id]: sl.SparseLabel(vertices, hemi=h, name=names[label_id])
+                     for label_id, vertices in groups.items()}
+
+        if out_dir is None:
+            continue
+        with ins.span('file_write', sub_id=sub_id, hemi=h, labels=len(groups)):
+            if annot_name is not None:
+                # Annotation values index the colour table; -1 marks unlabeled vertices
+                ids = np.array(sorted(groups), dtype=np.int64)
+                annot = np.full(len(vertex_ids), -1, dtype=np.int32)
+                labeled = np.isin(vertex_ids, ids)
+                annot[labeled] = np.searchsorted(ids, vertex_ids[labeled])
+                rng = np.random.default_rng(0)
+                ctab = np.zeros((len(ids), 5), dtype=np.int32)
+                ctab[:, :3] = rng.integers(0, 256, size=(len(ids), 3))
+                nib.freesurfer.write_annot(f'{out_dir}{h}.{sub_id}_{annot_name}.annot', annot, ctab,
+                                           [names[label_id] for label_id in ids], fill_ctab=True)
+            else:
+                for name, label in labels[h].items():
+                    lio.save_mne_label(label, f'{out_dir}{h}_{sub_id}_{name}')
+
+    return labels
+
+
+def vol_label_2_surf(sub_id, label, fs_dir, roi_fname, out_dir=None,hemi='both', atlas=False,
+                     lut=None, annot_name=None):
     '''
     Convert surface labels to volumetric NIfTI images for specified subjects and ROIs.
 
+    With atlas=True the volume is treated as an integer atlas and every label in it
+    is projected at once (see vol_atlas_2_surf).
+
     Parameters:
     sub_id (str): A single subject ID.
     labels (nii object): A nifti object for a single label.
     fs_dir (str): Directory containing FreeSurfer subjects.
     out_dir (str or None): Directory to save the output NIfTI volumes. If None, volumes are not saved. Default is None.
     hemi (str): Specify 'lh', 'rh', or 'both' to determine which hemispheres to process. Default is 'both'.
+    atlas (bool): Project every label of an integer atlas volume instead of a single binary ROI.
+    lut (dict, str or None): Atlas mode only; label id -> name mapping or lookup table path.
+    annot_name (str or None): Atlas mode only; write .annot files under this name instead of .label files.
 
     Returns:
-    np.ndarray: An array of shape (number of subjects, number of ROIs) containing the generated volumes.
+    dict: {'lh_label': SparseLabel, 'rh_label': SparseLabel} for the hemispheres the label reaches.
+    In atlas mode, the per-hemisphere label dictionaries returned by vol_atlas_2_surf.
     '''
+    if atlas:
+        return vol_atlas_2_surf(sub_id, label, fs_dir, out_dir, hemi, lut, annot_name)
 
     labels = {}
     
     # Make sure that the ny module is ready to be used
-    sub = ny.freesurfer_subject(f'{fs_dir}/{sub_id}/')
+    with ins.span('subject_load', sub_id=sub_id):
+        sub = sc.load_subject(f'{fs_dir}/{sub_id}/')
 
     # Convert masks to NIfTI object
-    lh_label, rh_label = sub.image_to_cortex(label)
+    with ins.span('cortex_sampling', sub_id=sub_id):
+        lh_label, rh_label = sub.image_to_cortex(label)
 
     lh_label_indices = np.where(lh_label > 0)[0]
     if len(lh_label_indices) > 0:
-        left_label = mne.Label(lh_label_indices, hemi='lh', name=roi_fname)
+        left_label = sl.SparseLabel(lh_label_indices, hemi='lh', name=roi_fname)
         labels['lh_label'] = left_label
         if out_dir is not None:
             print(f'saveing file lh: {out_dir}lh_{sub_id}_{roi_fname}')
-            left_label.save(f'{out_dir}lh_{sub_id}_{roi_fname}')    
+            with ins.span('file_write', sub_id=sub_id, hemi='lh'):
+                lio.save_mne_label(left_label, f'{out_dir}lh_{sub_id}_{roi_fname}')
     else:
         print('no vertices in left hemisphere')
 
     rh_label_indices = np.where(rh_label > 0)[0]
     if len(rh_label_indices) > 0:
-        right_label = mne.Label(rh_label_indices, hemi='rh', name=roi_fname)
+        right_label = sl.SparseLabel(rh_label_indices, hemi='rh', name=roi_fname)
         labels['rh_label'] = right_label
         if out_dir is not None:
-                    right_label.save(f'{out_dir}rh_{sub_id}_{roi_fname}')    
+            with ins.span('file_write', sub_id=sub_id, hemi='rh'):
+                lio.save_mne_label(right_label, f'{out_dir}rh_{sub_id}_{roi_fname}')
         else:
             print('no vertices in right hemisphere')
             
@@ -96,7 +363,8 @@ def vol_label_2_surf(sub_id, label, fs_dir, roi_fname, out_dir=None,hemi='both')
 
     
 def fsnative_label_2_fsaverage(fsnative_path, fsaverage_path, fsnative_label,
-                                hemisphere, roi_fname, output_filename=None):
+                                hemisphere, roi_fname, output_filename=None,
+                                method='nearest', operator_cache_dir=None):
     '''
     Interpolate a surface label from a native FreeSurfer subject to the fsaverage surface.
 
@@ -106,53 +374,37 @@ def fsnative_label_2_fsaverage(fsnative_path, fsaverage_path, fsnative_label,
     Parameters:
     fsnative_path (str): The file path to the native surface mesh (e.g., `.pial`).
     fsaverage_path (str): The file path to the fsaverage surface mesh (e.g., `.pial`).
-    fsnative_label (array): The array contains the vertices of the native surface label.
+    fsnative_label (array or SparseLabel): The vertices of the native surface label.
     hemisphere (str): The hemisphere to process ('lh' for left hemisphere or 'rh' for right hemisphere).
     output_filename (str or None): The filename to save the label. 
                                     If provided, the label will be saved; if None, it will not be saved.
+    method (str): Resampling method, 'nearest' or 'linear'. Default is 'nearest'.
+    operator_cache_dir (str or None): Directory in which the resampling operator is saved
+                                      and reused across calls. If None, it is only cached in memory.
 
     Returns:
-    mne.Label: The interpolated label for the specified hemisphere.
+    SparseLabel: The interpolated label for the specified hemisphere.
     '''
     
-    # Load FreeSurfer subjects
-    fsn_sub = ny.freesurfer_subject(fsnative_path)
-    fsa_sub = ny.freesurfer_subject(fsaverage_path)
-
-    # Interpolate the label to the fsaverage surface
-    if hemisphere == 'lh':
-        # Create a boolean array for the label with the same vertex count as the subject's surface
-        fsn_label = np.zeros(fsn_sub.lh.vertex_count, dtype=bool)
-    
-        # Set the specified indices to True
-        fsn_label[fsnative_label] = True
-        
-        fsa_label = fsn_sub.lh.interpolate(fsa_sub.lh, fsn_label)
-    elif hemisphere == 'rh':
-        # Create a boolean array for the label with the same vertex count as the subject's surface
-        fsn_label = np.zeros(fsn_sub.rh.vertex_count, dtype=bool)
-    
-        # Set the specified indices to True
-        fsn_label[fsnative_label] = True
-        
-        fsa_label = fsn_sub.rh.interpolate(fsa_sub.rh, fsn_label)
-    else:
-        raise ValueError("Hemisphere needs to be specified as 'lh' or 'rh'.")
+    # Load (or build once) the sparse resampling operator between the two subjects
+    operator = si.interpolation_operator(fsnative_path, fsaverage_path, hemisphere, method, operator_cache_dir)
 
-    # Find the indices of the interpolated labels that are True
-    fsa_label_indices = np.where(fsa_label == True)[0]
+    # Interpolate the label with a single sparse product
+    fsnative_label = sl.as_sparse_label(fsnative_label, hemisphere)
+    fsa_label_indices = si.project_labels(operator, [fsnative_label.vertices])[0]
 
-    # Create an MNE Label object using the interpolated indices
-    label = mne.Label(fsa_label_indices, hemi=hemisphere, name=roi_fname)
+    # Build the label straight from the projected indices, without a dense mask
+    label = sl.SparseLabel(fsa_label_indices, hemi=hemisphere, name=roi_fname)
 
     # Save the label if an output filename is provided
     if output_filename is not None:
-        label.save(output_filename)
+        lio.save_mne_label(label, output_filename)
 
     return label
 
 def fsaverage_label_2_fsnative(fsaverage_path, fsnative_path, fsaverage_label,
-                                hemisphere, roi_fname, output_filename=None):
+                                hemisphere, roi_fname, output_filename=None,
+                                method='nearest', operator_cache_dir=None):
     '''
     Interpolate a surface label from a native FreeSurfer subject to the fsaverage surface.
 
@@ -162,215 +414,306 @@ def fsaverage_label_2_fsnative(fsaverage_path, fsnative_path, fsaverage_label,
     Parameters:
     fsaverage_path (str): The file path to the fsaverage surface mesh (e.g., `.pial`).
     fsnative_path (str): The file path to the native surface mesh (e.g., `.pial`).
-    fsaverage_label (array): The array contains the vertices of the average surface label.
+    fsaverage_label (array or SparseLabel): The vertices of the average surface label.
     hemisphere (str): The hemisphere to process ('lh' for left hemisphere or 'rh' for right hemisphere).
     output_filename (str or None): The filename to save the label. 
                                     If provided, the label will be saved; if None, it will not be saved.
+    method (str): Resampling method, 'nearest' or 'linear'. Default is 'nearest'.
+    operator_cache_dir (str or None): Directory in which the resampling operator is saved
+                                      and reused across calls. If None, it is only cached in memory.
 
     Returns:
-    mne.Label: The interpolated label for the specified hemisphere.
+    SparseLabel: The interpolated label for the specified hemisphere.
     '''
     
-    # Load FreeSurfer subjects
-    fsa_sub = ny.freesurfer_subject(fsaverage_path)
-    fsn_sub = ny.freesurfer_subject(fsnative_path)
-
-    # Interpolate the label to the fsaverage surface
-    if hemisphere == 'lh':
-        # Create a boolean array for the label with the same vertex count as the subject's surface
-        fsa_label = np.zeros(fsa_sub.lh.vertex_count, dtype=bool)
-    
-        # Set the specified indices to True
-        fsa_label[fsaverage_label] = True
-        
-        fsn_label = fsa_sub.lh.interpolate(fsn_sub.lh, fsa_label)
-    elif hemisphere == 'rh':
-        # Create a boolean array for the label with the same vertex count as the subject's surface
-        fsa_label = np.zeros(fsa_sub.rh.vertex_count, dtype=bool)
-    
-        # Set the specified indices to True
-        fsa_label[fsaverage_label] = True
-        
-        fsn_label = fsa_sub.rh.interpolate(fsn_sub.rh, fsa_label)
-    else:
-        raise ValueError("Hemisphere needs to be specified as 'lh' or 'rh'.")
+    # Load (or build once) the sparse resampling operator between the two subjects
+    operator = si.interpolation_operator(fsaverage_path, fsnative_path, hemisphere, method, operator_cache_dir)
 
-    # Find the indices of the interpolated labels that are True
-    fsn_label_indices = np.where(fsn_label == True)[0]
+    # Interpolate the label with a single sparse product
+    fsaverage_label = sl.as_sparse_label(fsaverage_label, hemisphere)
+    fsn_label_indices = si.project_labels(operator, [fsaverage_label.vertices])[0]
 
-    # Create an MNE Label object using the interpolated indices
-    label = mne.Label(fsn_label_indices, hemi=hemisphere, name=roi_fname)
+    # Build the label straight from the projected indices, without a dense mask
+    label = sl.SparseLabel(fsn_label_indices, hemi=hemisphere, name=roi_fname)
 
     # Save the label if an output filename is provided
     if output_filename is not None:
-        label.save(output_filename)
+        lio.save_mne_label(label, output_filename)
 
     return label
 
 
+# Template name -> (path, ANTsImage), loaded once per process
+_templates = {}
+
+
+def template_image(name='mni'):
+    '''
+    Return the path and image of an ANTs bundled template, reading it at most once per process.
+
+    The image is shared between callers and must not be modified in place.
+    '''
+    if name not in _templates:
+        fname = ants.get_data(name)
+        _templates[name] = (fname, ants.image_read(fname))
+    return _templates[name]
+
+
+def _read_image(fname):
+    # Accept plain paths as well as neuropythy/pimms path objects exposing .fspath
+    try:
+        return ants.image_read(fname)
+    except:
+        return ants.image_read(fname.fspath)
+
+
+def _load_t1(t1_fname, calc_brain_mask):
+    '''
+    Load the T1 image, brain-masking it when calc_brain_mask is True.
+    '''
+    with ins.span('t1_load'):
+        t1_img = _read_image(t1_fname)
+
+    # Calculating the brain mask if needed
+    if calc_brain_mask == True: 
+        with ins.span('brain_mask'):
+            t1_brain_mask = ants.get_mask(image = t1_img, 
+                                          low_thresh = 500, high_thresh = 2000, 
+                                          cleanup = 2)
+            # Applying mask to T1 image
+            return ants.mask_image(t1_img, t1_brain_mask)
+    return ants.clone(t1_img)
+
+
+def subject_mni_registration(t1_fname, calc_brain_mask: bool, direction: str,
+                             transform_cache: tc.TransformCache = None):
+    '''
+    Compute the composite Affine + SyN registration between a subject's T1 and the MNI template.
+
+    The registration only depends on the anatomical images, so it is computed once
+    per subject and direction and can then be applied to any number of ROIs.
+
+    Parameters: 
+    -----------
+    t1_fname (str): The path to the T1 file.
+    calc_brain_mask (bool): Whether the function should calculate a new brain mask.
+    direction (str): 'mni2native' (template moved onto the T1) or 'native2mni' (T1 moved onto the template).
+    transform_cache (TransformCache or None): Cache to reuse the transforms from.
+
+    Returns: 
+    --------
+    fixed: The fixed image of the registration (masked T1 or MNI template) as an ANTsImage.
+    registration (dict): The 'fwdtransforms' and 'invtransforms' transform file lists.
+    '''
+    t1_masked = _load_t1(t1_fname, calc_brain_mask)
+
+    # Loading the mni template
+    mni_fname, mni_template = template_image('mni')
+
+    if direction == 'mni2native':
+        fixed, moving = t1_masked, mni_template
+    elif direction == 'native2mni':
+        fixed, moving = mni_template, t1_masked
+    else:
+        raise ValueError("direction needs to be 'mni2native' or 'native2mni'.")
+
+    print('Calculating Affine + SyN Transformation')
+    # ANTs 'SyN' runs the affine stage first and returns the composite transform
+    with ins.span('affine_syn_registration', direction=direction) as attrs:
+        if transform_cache is None:
+            registration = ants.registration(fixed = fixed, moving = moving,
+                                             type_of_transform = 'SyN')
+        else:
+            key = tc.mni_registration_key(getattr(t1_fname, 'fspath', t1_fname), mni_fname,
+                                          calc_brain_mask, 'SyN', direction)
+            hits = transform_cache.hits
+            registration = transform_cache.registration(key, fixed, moving, 'SyN')
+            if attrs is not None:
+                attrs['cache_hit'] = transform_cache.hits > hits
+
+    return fixed, registration
+
+
+def apply_label_transforms(fixed, roi_img, transformlist, interpolator='genericLabel',
+                           invtransforms=None, cropped=False):
+    '''
+    Warp a 3D ROI image, or every volume of a 4D label stack, onto the fixed image grid.
+
+    Given the inverse transforms, a 3D ROI is warped in bounding-box mode: only the
+    padded region of the fixed grid that its non-zero voxels map to is resampled
+    (see roi_warp.warp_roi), which makes small ROIs far cheaper to warp.
+
+    Parameters: 
+    -----------
+    fixed: The reference ANTsImage defining the output grid.
+    roi_img: The 3D or 4D ANTsImage holding the ROI labels.
+    transformlist (list): Transform files, e.g. registration['fwdtransforms'].
+    interpolator (str): 'genericLabel' or 'nearestNeighbor' keep label values intact.
+    invtransforms (list or None): registration['invtransforms']; enables bounding-box mode for 3D ROIs.
+    cropped (bool): Bounding-box mode only; return the cropped region (with its own origin)
+                    instead of a full-size image.
+
+    Returns: 
+    --------
+    The warped ANTsImage; a 4D input gives a 4D output on the fixed grid.
+    '''
+    if roi_img.dimension < 4 and invtransforms is not None:
+        return rw.warp_roi(fixed, roi_img, transformlist, invtransforms, interpolator,
+                           cropped=cropped)
+    if roi_img.dimension < 4:
+        return ants.apply_transforms(fixed = fixed, moving = roi_img,
+                                     transformlist = transformlist,
+                                     interpolator = interpolator)
+
+    volumes = [ants.apply_transforms(fixed = fixed, moving = vol,
+                                     transformlist = transformlist,
+                                     interpolator = interpolator)
+               for vol in ants.ndimage_to_list(roi_img)]
+    direction = np.eye(4)
+    direction[:3, :3] = fixed.direction
+    return ants.from_numpy(np.stack([vol.numpy() for vol in volumes], axis=-1),
+                           origin = tuple(fixed.origin) + (0.0,),
+                           spacing = tuple(fixed.spacing) + (1.0,),
+                           direction = direction)
+
+
+def _warp_rois(fixed, registration, roi_fname, moving_template, save_coreg, out_fname,
+               interpolator, restrict_to_roi=False, cropped_output=False):
+    '''
+    Apply one registration to a single ROI, a list of ROIs, or (roi_fname=None) the template.
+    '''
+    transformlist = registration['fwdtransforms']
+    invtransforms = registration['invtransforms'] if restrict_to_roi else None
+
+    if not roi_fname:
+        with ins.span('apply_transforms', images=1):
+            coreg = ants.apply_transforms(fixed = fixed, moving = moving_template,
+                                          transformlist = transformlist)
+        if save_coreg:
+            with ins.span('file_write'):
+                nio.write_ants(coreg, out_fname)
+        return coreg
+
+    batched = isinstance(roi_fname, (list, tuple))
+    roi_fnames = list(roi_fname) if batched else [roi_fname]
+    out_fnames = list(out_fname) if batched and save_coreg else [out_fname]
+    if save_coreg and len(out_fnames) != len(roi_fnames):
+        raise ValueError("out_fname needs one filename per ROI file.")
+
+    print(f'Applying transformation to {len(roi_fnames)} ROI image(s)')
+    coregs = []
+    # The next ROI is read, and the previous warped ROIs written, on background threads
+    with nio.AsyncWriter() as writer:
+        for i, (fname, roi_img) in enumerate(nio.prefetch(roi_fnames, _read_image)):
+            roi_img = roi_img.result()
+            with ins.span('apply_transforms', interpolator=interpolator, dimension=roi_img.dimension):
+                coreg = apply_label_transforms(fixed, roi_img, transformlist, interpolator,
+                                               invtransforms, cropped_output)
+            if save_coreg:
+                with ins.span('file_write'):
+                    nio.write_ants(coreg, out_fnames[i], writer=writer)
+            coregs.append(coreg)
+
+    return coregs if batched else coregs[0]
+
+
 def MNI_label_2_native(t1_fname:str, sub_id: str, calc_brain_mask: bool, 
-                       roi_fname: str, save_coreg:bool, out_fname:str):
+                       roi_fname, save_coreg:bool, out_fname,
+                       transform_cache: tc.TransformCache = None,
+                       interpolator: str = 'genericLabel',
+                       restrict_to_roi: bool = False, cropped_output: bool = False):
 
     '''
     Function to take ROIs from MNI space to Native space. 
 
+    The template-to-T1 registration is computed once and then applied to every ROI,
+    so passing a list of ROI files costs a single registration.
+
     Parameters: 
     -----------
     t1_fname (str): The path to the T1 file.
     sub_id (str): The unique identifier for the subject.
     calc_brain_mask (bool): Whether the function should calculate a new brain mask.
-    roi_fname (str): The path to the ROI file.
+    roi_fname (str or list): The path to the ROI file, a list of ROI files, or a 4D label stack.
     save_coreg (bool): Whether to save the coregistration to file. 
-    out_fname (str): Filename for the coregistration file.
+    out_fname (str or list): Filename for the coregistration file, one per ROI for a list.
+    transform_cache (TransformCache or None): Cache to reuse the registration from;
+        it is recomputed on every call if None.
+    interpolator (str): ANTs interpolator for the ROIs; label-preserving by default.
+    restrict_to_roi (bool): Resample only the part of the output grid each 3D ROI maps to
+        (bounding-box mode), which is much faster for small ROIs.
+    cropped_output (bool): With restrict_to_roi, return (and save) each ROI cropped to that
+        region, with a matching origin, instead of on the full output grid.
 
     Returns: 
     --------
-    mni_coreg: The Volumetric ROIs in Native space as an ANTsImage.  
+    mni_coreg: The Volumetric ROIs in Native space as an ANTsImage (a list for a list of ROIs).  
     
     '''
 
     print(f'Converting MNI ROI labels to Native space for {sub_id}')
-    
-    # Loading the T1 Image
-    try: 
-        t1_img = ants.image_read(t1_fname)
-    except: 
-        t1_img = ants.image_read(t1_fname.fspath)
 
-    # Calculating the brain mask if needed
-    if calc_brain_mask == True: 
-        t1_brain_mask = ants.get_mask(image = t1_img, 
-                                      low_thresh = 500, high_thresh = 2000, 
-                                      cleanup = 2)
-        # Applying mask to T1 image
-        t1_masked = ants.mask_image(t1_img, t1_brain_mask)
-    else: 
-        t1_maske = ants.clone(t1_img)
-
-    del t1_img
-    
-    # Loading the mni template
-    mni_template = ants.image_read(ants.get_data('mni'))
+    t1_masked, registration = subject_mni_registration(t1_fname, calc_brain_mask, 'mni2native',
+                                                       transform_cache)
 
-    # Loading the MNI Space Volumetric ROIs
-    if roi_fname: 
+    if roi_fname:
         print('Using provided MNI ROI Definition')
-        roi_img = ants.image_read(roi_fname)       
-
-    print('Calculating Affine Transformation')
-    # Calculate the Affine Transformation
-    affine_reg = ants.registration(fixed = t1_masked, 
-                                   moving = mni_template, 
-                                   type_of_transform = 'Affine')
-
-    # Apply Affine Transformation 
-    if roi_fname: 
-        mni_affine_trans = ants.apply_transforms(fixed = t1_masked, 
-                                                 moving = roi_img,
-                                                 transformlist=affine_reg['fwdtransforms'])
-    else: 
-        mni_affine_trans = ants.apply_transforms(fixed = t1_masked, 
-                                                 moving = mni_template,
-                                                 transformlist=affine_reg['fwdtransforms'])
-    print('Calculating SyN Transformation')
-    # Calculate SyN Transformation
-    SyN_reg = ants.registration(fixed = t1_masked, 
-                                moving = mni_affine_trans,
-                                type_of_transform = 'SyN')
-
-    # Apply SyN Transformation
-    native_coreg = ants.apply_transforms(fixed = t1_masked, 
-                                          moving = mni_affine_trans, 
-                                          transformlist = SyN_reg['fwdtransforms'])
-
-    if save_coreg: native_coreg.image_write(filename = out_fname)
-    
+        mni_template = None
+    else:
+        mni_template = template_image('mni')[1]
+
+    native_coreg = _warp_rois(t1_masked, registration, roi_fname, mni_template,
+                              save_coreg, out_fname, interpolator, restrict_to_roi, cropped_output)
+
     print(f'{sub_id} Finished.\n')
     
     # Return the native volumetric space
     return native_coreg
 
 def native_label_2_mni(t1_fname:str, sub_id: str, calc_brain_mask: bool, 
-                       roi_fname: str, save_coreg:bool, out_fname:str):
+                       roi_fname, save_coreg:bool, out_fname,
+                       transform_cache: tc.TransformCache = None,
+                       interpolator: str = 'genericLabel',
+                       restrict_to_roi: bool = False, cropped_output: bool = False):
 
     '''
     Function to take ROIs from Native space to MNI space. 
 
+    The T1-to-template registration is computed once and then applied to every ROI,
+    so passing a list of ROI files costs a single registration.
+
     Parameters: 
     -----------
     t1_fname (str): The path to the T1 file.
     sub_id (str): The unique identifier for the subject.
     calc_brain_mask (bool): Whether the function should calculate a new brain mask.
-    roi_fname (str): The path to the ROI file.
+    roi_fname (str or list): The path to the ROI file, a list of ROI files, or a 4D label stack.
     save_coreg (bool): Whether to save the coregistration to file. 
-    out_fname (str): Filename for the coregistration file.
+    out_fname (str or list): Filename for the coregistration file, one per ROI for a list.
+    transform_cache (TransformCache or None): Cache to reuse the registration from;
+        it is recomputed on every call if None.
+    interpolator (str): ANTs interpolator for the ROIs; label-preserving by default.
+    restrict_to_roi (bool): Resample only the part of the output grid each 3D ROI maps to
+        (bounding-box mode), which is much faster for small ROIs.
+    cropped_output (bool): With restrict_to_roi, return (and save) each ROI cropped to that
+        region, with a matching origin, instead of on the full output grid.
 
     Returns: 
     --------
-    mni_coreg: The Volumetric ROIs in MNI space as an ANTsImage.  
+    mni_coreg: The Volumetric ROIs in MNI space as an ANTsImage (a list for a list of ROIs).  
     
     '''
 
     print(f'Converting Native ROI labels to MNI space for {sub_id}')
-    
-    # Retrieve the T1 image from subject freesurfer directory
-    try:
-        t1_img = ants.image_read(t1_fname)
-    except:
-        t1_img = ants.image_read(t1_fname.fspath)
 
-    # Calculating the brain mask if needed
-    if calc_brain_mask == True: 
-        t1_brain_mask = ants.get_mask(image = t1_img, 
-                                      low_thresh = 500, high_thresh = 2000, 
-                                      cleanup = 2)
-        # Applying mask to T1 image
-        t1_masked = ants.mask_image(t1_img, t1_brain_mask)
-    else: 
-        t1_masked = ants.clone(t1_img)
-
-    del t1_img
-    
-    # Loading the mni template
-    mni_template = ants.image_read(ants.get_data('mni'))
-
-    if roi_fname: 
-        # Loading the Native Space Volumetric ROIs
-        try: 
-            ants.image_read(roi_fname)
-        except: 
-            roi_img = ants.image_read(roi_fname.fspath)     
-
-    print('Calculating Affine Transformation')
-        
-    # Calculate the Affine Transformation
-    affine_reg = ants.registration(fixed = mni_template, 
-                                   moving = t1_masked,
-                                   type_of_transform = 'Affine')
-
-    # Apply Affine Transformation 
-    if roi_fname: 
-        mni_affine_trans = ants.apply_transforms(fixed = mni_template, 
-                                                 moving = roi_img,
-                                                 transformlist=affine_reg['fwdtransforms'])
-    else: 
-        mni_affine_trans = ants.apply_transforms(fixed = mni_template, 
-                                                 moving = t1_masked,
-                                                 transformlist=affine_reg['fwdtransforms'])    
-    print('Calculating SyN Transformation')
-    # Calculate SyN Transformation
-    SyN_reg = ants.registration(fixed = mni_template, 
-                                moving = mni_affine_trans,
-                                type_of_transform = 'SyN')
-
-    # Apply SyN Transformation
-    mni_coreg = ants.apply_transforms(fixed = mni_template, 
-                                      moving = mni_affine_trans, 
-                                      transformlist = SyN_reg['fwdtransforms'])
-
-    if save_coreg: mni_coreg.image_write(filename = out_fname)
-    
+    mni_template, registration = subject_mni_registration(t1_fname, calc_brain_mask, 'native2mni',
+                                                          transform_cache)
+
+    t1_masked = None if roi_fname else _load_t1(t1_fname, calc_brain_mask)
+    mni_coreg = _warp_rois(mni_template, registration, roi_fname, t1_masked,
+                           save_coreg, out_fname, interpolator, restrict_to_roi, cropped_output)
+
     print(f'{sub_id} Finished.\n')
     
     # Return the native volumetric space
-    return mni_coreg
\ No newline at end of file
+    return mni_coreg
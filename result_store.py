@@ -0,0 +1,240 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from importlib import metadata
+from pathlib import Path
+
+import nifti_io as nio
+from transform_cache import file_digest
+
+# Libraries whose version changes can change projection outputs
+VERSIONED_PACKAGES = ('numpy', 'nibabel', 'neuropythy', 'antspyx', 'mne', 'nilearn', 'scipy')
+
+
+def library_versions():
+    '''Installed versions of the libraries that produce the stored outputs.'''
+    versions = {}
+    for package in VERSIONED_PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+class ResultStore:
+    '''
+    Content-addressed store of projection outputs.
+
+    An entry is keyed by the route name, the digests of its input files, its
+    parameters and the library versions, and holds copies of the output files the
+    route wrote. Outputs are restored to whatever paths the caller asks for, so the
+    same result is shared across output directories. Least recently used entries are
+    evicted once the store grows beyond max_bytes.
+
+    Parameters:
+    root (str): Directory of the store.
+    max_bytes (int or None): Size limit of the store. None disables eviction.
+    '''
+
+    def __init__(self, root, max_bytes=None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._versions = library_versions()
+
+    def key(self, route, inputs, params=None):
+        '''
+        Key of a route run from its input files and parameters.
+
+        Parameters:
+        route (str): Name of the route, e.g. 'MNI->native'.
+        inputs (list of str): Input files; their contents (not paths) enter the key.
+        params (dict or None): JSON-serialisable parameters of the run.
+        '''
+        blob = json.dumps({'route': route,
+                           'inputs': [file_digest(f) for f in inputs],
+                           'params': params or {},
+                           'versions': self._versions}, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def fetch(self, key, outputs):
+        '''
+        Restore a stored result to the given output paths.
+
+        Parameters:
+        key (str): Entry key.
+        outputs (list of str): Destination of every output, in the order used by put.
+
+        Returns:
+        list or None: The restored paths (None for outputs the route did not write),
+        or None when the entry is not in the store.
+        '''
+        entry = self.root / key
+        # An entry whose files were deleted (by hand or by a concurrent gc) is a miss
+        stored = self._stored_outputs(entry)
+        if stored is None or len(stored) != len(outputs):
+            self.misses += 1
+            return None
+
+        restored = []
+        try:
+            for name, dest in zip(stored, outputs):
+                if name is None:
+                    restored.append(None)
+                    continue
+                os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+                shutil.copyfile(entry / name, dest)
+                restored.append(dest)
+        except FileNotFoundError:
+            # The entry was removed while being restored
+            if all((entry / name).exists() for name in stored if name is not None):
+                raise
+            self.misses += 1
+            return None
+        os.utime(entry)
+        self.hits += 1
+        return restored
+
+    def put(self, key, outputs, route=None):
+        '''
+        Copy the output files of a finished run into the store.
+
+        Outputs that do not exist (a route that legitimately wrote nothing) are
+        recorded as such and restored as None.
+        '''
+        entry = self.root / key
+        for attempt in range(2):
+            try:
+                self._write_entry(entry, outputs, route)
+                break
+            except OSError:
+                # Another process stored the same key first
+                if not entry.exists():
+                    raise
+                if attempt or self._stored_outputs(entry) is not None:
+                    break
+                # A leftover entry that fetch() rejects would otherwise miss forever
+                shutil.rmtree(entry, ignore_errors=True)
+        self.gc()
+
+    @staticmethod
+    def _stored_outputs(entry):
+        # The entry's stored file names, or None unless the manifest and every file exist
+        manifest = entry / 'manifest.json'
+        if not manifest.exists():
+            return None
+        with open(manifest) as f:
+            stored = json.load(f)['outputs']
+        if not all((entry / name).exists() for name in stored if name is not None):
+            return None
+        return stored
+
+    @staticmethod
+    def _write_entry(entry, outputs, route):
+        # Published atomically, see nifti_io.atomic_output
+        with nio.atomic_output(entry) as tmp:
+            tmp = Path(tmp)
+            tmp.mkdir(parents=True)
+            stored = []
+            for i, src in enumerate(outputs):
+                if src is None or not os.path.exists(src):
+                    stored.append(None)
+                    continue
+                name = f'{i}_{os.path.basename(src)}'
+                shutil.copyfile(src, tmp / name)
+                stored.append(name)
+            with open(tmp / 'manifest.json', 'w') as f:
+                json.dump({'route': route, 'outputs': stored, 'created': time.time()}, f)
+
+    def entries(self):
+        '''
+        Describe every entry: key, route, size in bytes and last use time.
+        '''
+        entries = []
+        for entry in self.root.iterdir():
+            manifest = entry / 'manifest.json'
+            if entry.name.startswith('.') or not manifest.exists():
+                continue
+            with open(manifest) as f:
+                route = json.load(f).get('route')
+            size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+            entries.append({'key': entry.name, 'route': route, 'bytes': size,
+                            'last_used': entry.stat().st_mtime})
+        return entries
+
+    def gc(self, max_bytes=None):
+        '''
+        Evict least recently used entries until the store fits in max_bytes
+        (default: the store's own limit), and remove leftovers of interrupted writes.
+
+        Returns:
+        int: Number of entries removed.
+        '''
+        for tmp in self.root.glob('.*.tmp'):
+            if time.time() - tmp.stat().st_mtime > 3600:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return 0
+        entries = sorted(self.entries(), key=lambda e: e['last_used'])
+        total = sum(e['bytes'] for e in entries)
+        removed = 0
+        for e in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(self.root / e['key'], ignore_errors=True)
+            total -= e['bytes']
+            removed += 1
+        return removed
+
+    def cached(self, route, inputs, params, outputs, compute, load):
+        '''
+        Serve a route run from the store, or run it and store its outputs.
+
+        Parameters:
+        route (str): Name of the route.
+        inputs (list of str): Input files of the run.
+        params (dict): Parameters of the run.
+        outputs (list of str): Files the run writes.
+        compute (callable): Runs the route and returns its result.
+        load (callable): Rebuilds the result from the list of restored output paths.
+        '''
+        key = self.key(route, inputs, params)
+        restored = self.fetch(key, outputs)
+        if restored is not None:
+            return load(restored)
+        result = compute()
+        self.put(key, outputs, route)
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or garbage-collect a projection result store.")
+    parser.add_argument('root', help="Result store directory")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('inspect', help="List the stored entries")
+    gc = sub.add_parser('gc', help="Evict least recently used entries")
+    gc.add_argument('--max-bytes', type=int, required=True, help="Size to shrink the store to")
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.root)
+    if args.command == 'inspect':
+        entries = sorted(store.entries(), key=lambda e: e['last_used'], reverse=True)
+        for e in entries:
+            used = time.strftime('%Y-%m-%d %H:%M', time.localtime(e['last_used']))
+            print(f"{e['key'][:16]}  {e['bytes']:>12}  {used}  {e['route']}")
+        print(f"{len(entries)} entries, {sum(e['bytes'] for e in entries)} bytes")
+    else:
+        print(f'Removed {store.gc(args.max_bytes)} entries')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import ants
+
+# Above this fraction of the fixed grid, restricting the warp no longer pays off
+_FULL_WARP_FRACTION = 0.5
+
+
+def _index_to_physical(img, indices):
+    # (n, 3) voxel indices -> (n, 3) ITK physical points
+    matrix = np.asarray(img.direction) * np.asarray(img.spacing)
+    return indices @ matrix.T + np.asarray(img.origin)
+
+
+def _physical_to_index(img, points):
+    matrix = np.asarray(img.direction) * np.asarray(img.spacing)
+    return np.linalg.solve(matrix, (points - np.asarray(img.origin)).T).T
+
+
+def roi_bounding_box(roi_img):
+    '''
+    Voxel index bounds (lower, upper exclusive) of the non-zero voxels of a 3D image,
+    or None if it is empty.
+    '''
+    nonzero = np.nonzero(roi_img.numpy())
+    if len(nonzero[0]) == 0:
+        return None
+    return (np.array([ax.min() for ax in nonzero]), np.array([ax.max() + 1 for ax in nonzero]))
+
+
+def roi_target_region(fixed, roi_img, invtransforms, padding=3):
+    '''
+    Index bounds of the part of the fixed grid that a ROI's non-zero voxels map to.
+
+    Every non-zero voxel centre (plus the corners of the ROI's bounding box) is
+    mapped to fixed space through the inverse transforms, and the bounds of the
+    mapped points are grown by padding voxels to cover the interpolation support
+    and bending of a non-linear warp between the points.
+
+    Parameters:
+    fixed (ants.ANTsImage): Image defining the output grid.
+    roi_img (ants.ANTsImage): 3D ROI image in moving space.
+    invtransforms (list): The registration's 'invtransforms' (moving -> fixed for points).
+    padding (int): Margin in fixed voxels around the mapped ROI.
+
+    Returns:
+    (lower, upper) index arrays (upper exclusive), or None if the ROI is empty.
+    '''
+    box = roi_bounding_box(roi_img)
+    if box is None:
+        return None
+    lower, upper = box
+    corners = np.array(np.meshgrid(*zip(lower - 0.5, upper - 0.5))).reshape(3, -1).T
+    points = _index_to_physical(roi_img, np.vstack([np.argwhere(roi_img.numpy() != 0), corners]))
+
+    # ANTs maps points with the inverse of the image transforms; the affine must be inverted
+    mapped = ants.apply_transforms_to_points(
+        3, pd.DataFrame(points, columns=['x', 'y', 'z']), invtransforms,
+        whichtoinvert=[t.endswith('.mat') for t in invtransforms])
+    indices = _physical_to_index(fixed, mapped[['x', 'y', 'z']].to_numpy())
+
+    lower = np.maximum(np.floor(indices.min(axis=0)).astype(int) - padding, 0)
+    upper = np.minimum(np.ceil(indices.max(axis=0)).astype(int) + padding + 1, fixed.shape[:3])
+    if np.any(upper <= lower):
+        return None
+    return lower, upper
+
+
+def region_grid(fixed, lower, upper):
+    '''
+    Empty image on the voxels [lower, upper) (0-based, upper exclusive) of the fixed grid.
+
+    The sub-grid is built from the fixed image's geometry rather than with
+    ants.crop_indices, whose bounds are 1-based and inclusive.
+    '''
+    lower, upper = np.asarray(lower, dtype=int), np.asarray(upper, dtype=int)
+    origin = _index_to_physical(fixed, lower[None, :].astype(float))[0]
+    return ants.make_image(tuple(int(n) for n in upper - lower), voxval=0, spacing=fixed.spacing,
+                           origin=tuple(origin), direction=np.asarray(fixed.direction))
+
+
+def warp_roi(fixed, roi_img, fwdtransforms, invtransforms, interpolator='genericLabel',
+             padding=3, cropped=False):
+    '''
+    Warp a small 3D ROI by resampling only the region of the fixed grid it maps to.
+
+    Parameters:
+    fixed (ants.ANTsImage): Image defining the output grid.
+    roi_img (ants.ANTsImage): 3D ROI image in moving space.
+    fwdtransforms (list): Transforms resampling moving onto fixed.
+    invtransforms (list): The matching inverse transforms, used to locate the target region.
+    interpolator (str): ANTs interpolator.
+    padding (int): Margin in fixed voxels around the mapped ROI, see roi_target_region.
+    cropped (bool): Return only the cropped region (with its own origin) instead of
+                    pasting it into a full-size image on the fixed grid.
+
+    Returns:
+    ants.ANTsImage: The warped ROI, full size or cropped. Empty ROIs give an empty
+    full-size image, and ROIs covering a large part of the grid are warped in full,
+    as cropping would not save anything.
+    '''
+    region = roi_target_region(fixed, roi_img, invtransforms, padding)
+    if region is None:
+        return fixed.new_image_like(np.zeros(fixed.shape, dtype=np.float32))
+
+    lower, upper = region
+    if np.prod(upper - lower) > _FULL_WARP_FRACTION * np.prod(fixed.shape[:3]):
+        return ants.apply_transforms(fixed=fixed, moving=roi_img, transformlist=fwdtransforms,
+                                     interpolator=interpolator)
+
+    # Only the voxels of the target region are resampled
+    target = region_grid(fixed, lower, upper)
+    warped = ants.apply_transforms(fixed=target, moving=roi_img, transformlist=fwdtransforms,
+                                   interpolator=interpolator)
+    if tuple(warped.shape) != tuple(upper - lower):
+        raise ValueError(f"Warped region has shape {tuple(warped.shape)}, expected "
+                         f"{tuple(upper - lower)} for voxels {tuple(lower)}-{tuple(upper)}.")
+    if cropped:
+        return warped
+
+    data = np.zeros(fixed.shape, dtype=np.float32)
+    data[tuple(slice(lo, hi) for lo, hi in zip(lower, upper))] = warped.numpy()
+    return fixed.new_image_like(data)
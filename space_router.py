@@ -0,0 +1,238 @@
+import heapq
+import itertools
+from collections import namedtuple
+
+import numpy as np
+import nibabel as nib
+import neuropythy as ny
+import ants
+
+import instrumentation as ins
+import nifti_io as nio
+import project_label_utilities as pl
+import sparse_label as sl
+import subject_cache as sc
+import surface_interpolation as si
+
+# Spaces of the routing graph; MNI and fsaverage are shared by all subjects
+SPACES = ('MNI', 'native', 'fsnative', 'fsaverage')
+_SHARED = ('MNI', 'fsaverage')
+# project_label names for the subject's FreeSurfer volume and surface
+ALIASES = {'volumetric': 'native', 'surface': 'fsnative'}
+# Relative cost of each kind of step. Sampling to and from the cortex drops every
+# non-cortical voxel, so volume -> volume routes go through MNI rather than the surface.
+_COSTS = {'warp': 10, 'sample': 11, 'rasterize': 11, 'resample': 1}
+_VOLUME_SPACES = ('MNI', 'native')
+
+# path: FreeSurfer subject directory; t1_fname / calc_brain_mask: MNI registration inputs
+SubjectSpace = namedtuple('SubjectSpace', ['path', 't1_fname', 'calc_brain_mask'],
+                          defaults=(None, False))
+
+# src and trg are (space, SubjectSpace or None) graph nodes
+Step = namedtuple('Step', ['kind', 'src', 'trg'])
+
+def _node(space, subject):
+    space = ALIASES.get(space, space)
+    if space not in SPACES:
+        raise ValueError(f"Unknown space {space!r}; expected one of {SPACES + tuple(ALIASES)}.")
+    return (space, None if space in _SHARED else subject)
+
+
+def _edges(subject):
+    native, fsnative = ('native', subject), ('fsnative', subject)
+    return [Step('warp', ('MNI', None), native), Step('warp', native, ('MNI', None)),
+            Step('sample', native, fsnative), Step('rasterize', fsnative, native),
+            Step('resample', fsnative, ('fsaverage', None)),
+            Step('resample', ('fsaverage', None), fsnative)]
+
+
+def plan_route(from_space, to_space, source, target=None):
+    '''
+    Find the cheapest chain of steps between two spaces.
+
+    The graph holds MNI and fsaverage once and the native volume and fsnative
+    surface of the source subject (and of the target subject, for cross-subject
+    routes), linked by ANTs warps, cortex sampling/rasterisation and spherical
+    resampling.
+
+    Parameters:
+    from_space (str): 'MNI', 'native' (or 'volumetric'), 'fsnative' (or 'surface') or 'fsaverage'.
+    to_space (str): Space to route to, same names.
+    source (SubjectSpace): Subject the label starts in.
+    target (SubjectSpace or None): Subject the label ends in. Defaults to source.
+
+    Returns:
+    list of Step: The route, empty if from_space and to_space are the same node.
+    '''
+    target = target or source
+    start, goal = _node(from_space, source), _node(to_space, target)
+    edges = {}
+    for step in _edges(source) + (_edges(target) if target != source else []):
+        edges.setdefault(step.src, []).append(step)
+
+    # Dijkstra; the counter keeps heap entries comparable
+    counter = itertools.count()
+    queue = [(0, next(counter), start, [])]
+    seen = set()
+    while queue:
+        cost, _, node, route = heapq.heappop(queue)
+        if node == goal:
+            return route
+        if node in seen:
+            continue
+        seen.add(node)
+        for step in edges.get(node, []):
+            if step.trg not in seen:
+                heapq.heappush(queue, (cost + _COSTS[step.kind], next(counter), step.trg, route + [step]))
+    raise ValueError(f'No route from {from_space} to {to_space}.')
+
+
+def fuse_steps(route, fuse=True):
+    '''
+    Group a route into stages that are each executed with a single resampling.
+
+    Consecutive warps (native -> MNI -> other native) are applied as one composite
+    ANTs transform, and consecutive surface resamplings (fsnative -> fsaverage ->
+    other fsnative) as one product of their sparse operators, so the label is
+    interpolated once per stage instead of once per step.
+    '''
+    stages = []
+    for step in route:
+        if fuse and stages and stages[-1][-1].kind == step.kind and step.kind in ('warp', 'resample'):
+            stages[-1].append(step)
+        else:
+            stages.append([step])
+    return stages
+
+
+class _Run:
+    # Per-call state: registrations are computed once even if several stages need them
+    def __init__(self, fsaverage_path, transform_cache, operator_cache_dir, method, interpolator):
+        self.fsaverage_path = fsaverage_path
+        self.transform_cache = transform_cache
+        self.operator_cache_dir = operator_cache_dir
+        self.method = method
+        self.interpolator = interpolator
+        self._registrations = {}
+
+    def registration(self, subject, direction):
+        key = (subject, direction)
+        if key not in self._registrations:
+            if subject.t1_fname is None:
+                raise ValueError('A T1 file is needed to route through MNI space.')
+            self._registrations[key] = pl.subject_mni_registration(
+                subject.t1_fname, subject.calc_brain_mask, direction, self.transform_cache)
+        return self._registrations[key]
+
+    def surface_path(self, node):
+        return self.fsaverage_path if node[0] == 'fsaverage' else node[1].path
+
+    def warp(self, stage, img):
+        # ANTs applies the transform list last to first, so each later step's transforms are
+        # prepended and the final step's transforms end up first
+        transformlist = []
+        for step in stage:
+            if step.src[0] == 'MNI':
+                fixed, registration = self.registration(step.trg[1], 'mni2native')
+            else:
+                fixed, registration = self.registration(step.src[1], 'native2mni')
+            transformlist = registration['fwdtransforms'] + transformlist
+        return pl.apply_label_transforms(fixed, img, transformlist, self.interpolator)
+
+    def sample(self, stage, img):
+        sub = sc.load_subject(stage[0].trg[1].path)
+        lh, rh = sub.image_to_cortex(nio.ants_to_nifti(img), method='nearest')
+        return {h: np.round(np.nan_to_num(ids)).astype(np.int64) for h, ids in (('lh', lh), ('rh', rh))}
+
+    def rasterize(self, stage, surface):
+        sub = sc.load_subject(stage[0].src[1].path)
+        maps = tuple(surface.get(h, np.zeros(getattr(sub, h).vertex_count, dtype=np.int64))
+                     for h in ('lh', 'rh'))
+        vol = sub.cortex_to_image(maps, im=ny.image_clear(sub.images['ribbon']),
+                                  method='nearest', dtype=np.int32)
+        return nio.nifti_to_ants(vol)
+
+    def resample(self, stage, surface):
+        out = {}
+        for h, ids in surface.items():
+            operator = None
+            for step in stage:
+                op = si.interpolation_operator(self.surface_path(step.src), self.surface_path(step.trg),
+                                               h, self.method, self.operator_cache_dir)
+                operator = op if operator is None else op @ operator
+            out[h] = _resample_ids(operator, ids)
+        return out
+
+
+def _resample_ids(operator, ids, threshold=0.5):
+    # One product for every label id; each target vertex takes its heaviest label
+    label_ids = np.unique(ids[ids != 0])
+    if len(label_ids) == 0:
+        return np.zeros(operator.shape[0], dtype=np.int64)
+    weights = (operator @ sl.label_matrix([ids == i for i in label_ids], len(ids))).tocsr()
+    best = np.asarray(weights.argmax(axis=1)).ravel()
+    heaviest = weights.max(axis=1).toarray().ravel()
+    return np.where(heaviest >= threshold, label_ids[best], 0)
+
+
+def _as_input(label, node, hemi, run):
+    # Volumes become ANTsImages and surface labels per-hemisphere vertex id maps
+    if node[0] in _VOLUME_SPACES:
+        if isinstance(label, ants.ANTsImage):
+            return label
+        if isinstance(label, nib.spatialimages.SpatialImage):
+            return nio.nifti_to_ants(label)
+        return pl._read_image(label)
+    if isinstance(label, dict):
+        return {h: np.asarray(ids) for h, ids in label.items()}
+    if isinstance(label, sl.SparseLabel):
+        hemi, label = label.hemi or hemi, label.vertices
+    # An array of vertex indices on one hemisphere
+    sub = sc.load_subject(run.surface_path(node))
+    ids = np.zeros(getattr(sub, hemi).vertex_count, dtype=np.int64)
+    ids[np.asarray(label, dtype=np.int64)] = 1
+    return {hemi: ids}
+
+
+def route_label(label, from_space, to_space, source, target=None, fsaverage_path=None,
+                hemi='lh', fuse=True, transform_cache=None, operator_cache_dir=None,
+                method='nearest', interpolator='genericLabel'):
+    '''
+    Move a label (or integer atlas) between any two spaces in memory.
+
+    The route is planned with plan_route and executed step by step, passing ANTs
+    images and per-vertex arrays between steps instead of writing and re-reading
+    intermediate files. With fuse=True consecutive warps and consecutive surface
+    resamplings are collapsed into one interpolation each (see fuse_steps).
+
+    Parameters:
+    label: A volume (file path, nibabel image or ANTsImage) for 'MNI'/'native',
+        or for surface spaces a {'lh': ids, 'rh': ids} per-vertex label id map, a
+        SparseLabel or an array of vertex indices on hemisphere hemi.
+    from_space (str): Space of the label, see plan_route.
+    to_space (str): Space to move the label to.
+    source (SubjectSpace): Subject the label starts in.
+    target (SubjectSpace or None): Subject to end in, for cross-subject routes. Defaults to source.
+    fsaverage_path (str or None): fsaverage subject directory, needed by routes through fsaverage.
+    hemi (str): Hemisphere of a vertex index array. Default is 'lh'.
+    fuse (bool): Whether to collapse consecutive compatible resampling steps.
+    transform_cache (TransformCache or None): Cache of the MNI registrations.
+    operator_cache_dir (str or None): Directory of the cached surface resampling operators.
+    method (str): Surface resampling method, 'nearest' or 'linear'.
+    interpolator (str): ANTs interpolator of the warps; label-preserving by default.
+
+    Returns:
+    ants.ANTsImage for volumetric target spaces, or a {'lh': ids, 'rh': ids} map of
+    per-vertex label ids (0 outside the label) for surface target spaces.
+    '''
+    route = plan_route(from_space, to_space, source, target)
+    if any('fsaverage' in (step.src[0], step.trg[0]) for step in route) and fsaverage_path is None:
+        raise ValueError('fsaverage_path is needed to route through fsaverage.')
+    run = _Run(fsaverage_path, transform_cache, operator_cache_dir, method, interpolator)
+
+    value = _as_input(label, _node(from_space, source), hemi, run)
+    for stage in fuse_steps(route, fuse):
+        path = ' -> '.join([stage[0].src[0]] + [step.trg[0] for step in stage])
+        with ins.span('route_stage', kind=stage[0].kind, path=path):
+            value = getattr(run, stage[0].kind)(stage, value)
+    return value
@@ -0,0 +1,225 @@
+import numpy as np
+import scipy.sparse as sp
+
+import label_io as lio
+
+
+class SparseLabel:
+    '''
+    Surface label stored as sorted, unique uint32 vertex indices.
+
+    It carries the attributes of mne.Label that this package uses (vertices, hemi,
+    name, values, pos, comment), so it can be saved with label_io and passed where
+    an mne.Label was expected, but it costs 4 bytes per labelled vertex instead of
+    a dense mask per hemisphere. Set operations work on the sorted indices directly;
+    dense masks are only built by to_mask.
+
+    Parameters:
+    vertices (array): Vertex indices, in any order; duplicates are dropped.
+    hemi (str or None): 'lh' or 'rh'.
+    name (str or None): Label name.
+    values (array or None): Per-vertex values aligned with vertices. None means all ones.
+    pos (array or None): (n, 3) vertex positions in metres, aligned with vertices. None means zeros.
+    comment (str): Comment written to the label file header.
+    '''
+    __slots__ = ('vertices', 'hemi', 'name', '_values', '_pos', 'comment')
+
+    def __init__(self, vertices, hemi=None, name=None, values=None, pos=None, comment=''):
+        vertices = np.asarray(vertices)
+        if values is None and pos is None:
+            self.vertices = np.unique(vertices).astype(np.uint32)
+            self._values = self._pos = None
+        else:
+            self.vertices, first = np.unique(vertices, return_index=True)
+            self.vertices = self.vertices.astype(np.uint32)
+            self._values = None if values is None else np.asarray(values, dtype=float)[first]
+            self._pos = None if pos is None else np.asarray(pos, dtype=float)[first]
+        self.hemi = hemi
+        self.name = name
+        self.comment = comment
+
+    @classmethod
+    def _sorted(cls, vertices, hemi, name, values=None):
+        # Skip the sort for indices already known to be sorted and unique
+        label = cls.__new__(cls)
+        label.vertices = vertices.astype(np.uint32, copy=False)
+        label._values = values
+        label._pos = None
+        label.hemi, label.name, label.comment = hemi, name, ''
+        return label
+
+    @classmethod
+    def from_mask(cls, mask, hemi=None, name=None):
+        '''Label of the non-zero entries of a dense per-vertex mask.'''
+        return cls._sorted(np.flatnonzero(mask), hemi, name)
+
+    @classmethod
+    def from_mne(cls, label):
+        '''Convert an mne.Label (or anything with vertices, hemi, name, values and pos).'''
+        return cls(label.vertices, label.hemi, label.name, getattr(label, 'values', None),
+                   getattr(label, 'pos', None), getattr(label, 'comment', '') or '')
+
+    @classmethod
+    def read(cls, fname, hemi, name=None):
+        '''Read a FreeSurfer .label file through label_io.read_label.'''
+        label = lio.read_label(fname)
+        return cls(label.vertices, hemi, name, label.values, label.coords / 1e3, label.comment)
+
+    @property
+    def values(self):
+        return np.ones(len(self.vertices)) if self._values is None else self._values
+
+    @property
+    def pos(self):
+        return np.zeros((len(self.vertices), 3)) if self._pos is None else self._pos
+
+    def __len__(self):
+        return len(self.vertices)
+
+    def __repr__(self):
+        return f'<SparseLabel {self.name!r} {self.hemi}, {len(self)} vertices>'
+
+    def __eq__(self, other):
+        return (isinstance(other, SparseLabel) and self.hemi == other.hemi
+                and np.array_equal(self.vertices, other.vertices))
+
+    __hash__ = None
+
+    def _check_hemi(self, other):
+        if self.hemi is not None and other.hemi is not None and self.hemi != other.hemi:
+            raise ValueError(f'Cannot combine labels of hemispheres {self.hemi} and {other.hemi}.')
+        return self.hemi or other.hemi
+
+    def _subset_values(self, vertices):
+        if self._values is None:
+            return None
+        return self._values[np.searchsorted(self.vertices, vertices)]
+
+    def union(self, other):
+        '''Vertices in either label; values come from self where both have a vertex.'''
+        hemi = self._check_hemi(other)
+        vertices = np.union1d(self.vertices, other.vertices)
+        values = None
+        if self._values is not None or other._values is not None:
+            values = np.ones(len(vertices))
+            values[np.searchsorted(vertices, other.vertices)] = other.values
+            values[np.searchsorted(vertices, self.vertices)] = self.values
+        return SparseLabel._sorted(vertices, hemi, self.name, values)
+
+    def intersection(self, other):
+        '''Vertices in both labels, with the values of self.'''
+        hemi = self._check_hemi(other)
+        vertices = np.intersect1d(self.vertices, other.vertices, assume_unique=True)
+        return SparseLabel._sorted(vertices, hemi, self.name, self._subset_values(vertices))
+
+    def difference(self, other):
+        '''Vertices of self that are not in other.'''
+        hemi = self._check_hemi(other)
+        vertices = np.setdiff1d(self.vertices, other.vertices, assume_unique=True)
+        return SparseLabel._sorted(vertices, hemi, self.name, self._subset_values(vertices))
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def dilate(self, adjacency, steps=1):
+        '''
+        Grow the label by steps rings of neighbouring vertices.
+
+        Parameters:
+        adjacency (scipy.sparse.csr_matrix): Vertex adjacency of the surface, see adjacency_matrix.
+        steps (int): Number of rings to add.
+        '''
+        vertices = self.vertices
+        for _ in range(steps):
+            start, stop = adjacency.indptr[vertices], adjacency.indptr[vertices + 1]
+            # Neighbours of every vertex in one gather over the CSR index array
+            lengths = stop - start
+            offsets = np.repeat(start - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            vertices = np.union1d(vertices, adjacency.indices[offsets])
+        return SparseLabel._sorted(vertices, self.hemi, self.name)
+
+    def to_mask(self, vertex_count, dtype=bool):
+        '''Dense per-vertex mask of the label.'''
+        mask = np.zeros(vertex_count, dtype=dtype)
+        mask[self.vertices] = 1
+        return mask
+
+    def to_mne(self):
+        '''Convert to an mne.Label.'''
+        import mne
+        return mne.Label(self.vertices.astype(np.int64), pos=self.pos, values=self.values,
+                         hemi=self.hemi, name=self.name, comment=self.comment)
+
+    def save(self, fname):
+        '''Save as a FreeSurfer .label file, named like mne.Label.save would; returns the path.'''
+        return lio.save_mne_label(self, fname)
+
+
+def as_sparse_label(label, hemi=None, name=None):
+    '''
+    Coerce a SparseLabel, an mne.Label, a vertex index array or a boolean mask to a SparseLabel.
+    '''
+    if isinstance(label, SparseLabel):
+        return label
+    if hasattr(label, 'vertices') and hasattr(label, 'hemi'):
+        return SparseLabel.from_mne(label)
+    label = np.asarray(label)
+    if label.dtype == bool:
+        return SparseLabel.from_mask(label, hemi, name)
+    return SparseLabel(label, hemi, name)
+
+
+def adjacency_matrix(faces, vertex_count):
+    '''
+    Symmetric vertex adjacency of a triangle mesh as a boolean CSR matrix.
+    '''
+    faces = np.asarray(faces)
+    rows = np.concatenate([faces[:, 0], faces[:, 1], faces[:, 2]])
+    cols = np.concatenate([faces[:, 1], faces[:, 2], faces[:, 0]])
+    adjacency = sp.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                              shape=(vertex_count, vertex_count))
+    return (adjacency + adjacency.T).tocsr()
+
+
+def label_matrix(labels, vertex_count):
+    '''
+    Stack labels into a sparse (vertex_count, n_labels) indicator matrix.
+
+    Labels can be SparseLabels, vertex index arrays or boolean vertex masks.
+    '''
+    labels = [label.vertices if isinstance(label, SparseLabel)
+              else np.flatnonzero(label) if np.asarray(label).dtype == bool else np.asarray(label)
+              for label in labels]
+    rows = np.concatenate(labels).astype(np.int64) if labels else np.empty(0, np.int64)
+    cols = np.repeat(np.arange(len(labels)), [len(label) for label in labels])
+    return sp.csc_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                         shape=(vertex_count, len(labels)))
+
+
+def union_all(labels, hemi=None, name=None):
+    '''Union of many labels with a single sort.'''
+    vertices = np.unique(np.concatenate([label.vertices for label in labels])) if labels else []
+    return SparseLabel._sorted(np.asarray(vertices, dtype=np.uint32), hemi, name)
+
+
+def overlap_counts(labels, others=None, vertex_count=None):
+    '''
+    Number of shared vertices between every pair of labels with one sparse product.
+
+    Parameters:
+    labels (list of SparseLabel): First set of labels.
+    others (list of SparseLabel or None): Second set of labels. Defaults to labels.
+    vertex_count (int or None): Number of surface vertices. Defaults to the largest index + 1.
+
+    Returns:
+    np.ndarray: (len(labels), len(others)) intersection sizes; union sizes follow as
+    len(a) + len(b) - intersection.
+    '''
+    others = labels if others is None else others
+    if vertex_count is None:
+        vertex_count = 1 + max((int(label.vertices[-1]) for label in list(labels) + list(others)
+                                if len(label)), default=0)
+    a = label_matrix(labels, vertex_count)
+    b = a if others is labels else label_matrix(others, vertex_count)
+    return (a.T @ b).toarray().astype(np.int64)
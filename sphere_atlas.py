@@ -0,0 +1,199 @@
+import argparse
+import os
+import re
+
+import numpy as np
+import nibabel as nib
+import pandas as pd
+
+import nifti_io as nio
+
+OVERLAP_MODES = ('nearest', 'smallest', 'first', 'last', 'exclude')
+
+# Per-ROI coordinate atlases name their files e.g.
+# Seitzman300_roi001_coord-56.16_-44.76_-24.23_net-unassigned.nii.gz
+_ROI_FNAME = re.compile(r'roi(?P<index>\d+)_coord-(?P<x>-?[\d.]+)_(?P<y>-?[\d.]+)_(?P<z>-?[\d.]+)'
+                        r'(?:_net-(?P<network>[^.]+))?')
+
+
+def read_coordinates(fname):
+    '''
+    Read a table of sphere centres.
+
+    The table is a CSV (or TSV, by extension) with 'x', 'y' and 'z' columns holding
+    world (e.g. MNI) coordinates in mm, and optionally 'radius' (mm), 'name' and
+    'network' columns.
+    '''
+    sep = '\t' if os.path.splitext(fname)[1] in ('.tsv', '.txt') else ','
+    coordinates = pd.read_csv(fname, sep=sep)
+    missing = {'x', 'y', 'z'} - set(coordinates.columns)
+    if missing:
+        raise ValueError(f"Coordinate table is missing required columns: {sorted(missing)}")
+    return coordinates
+
+
+def _file_centre(fname, named):
+    # The filename coordinate is exact but its axes may be mirrored (Seitzman300 names give
+    # x with the opposite sign); the centroid of the file's voxels decides the sign of each axis
+    img = nib.load(fname)
+    voxels = np.argwhere(np.asanyarray(img.dataobj) != 0)
+    if len(voxels) == 0:
+        return named
+    centroid = nib.affines.apply_affine(img.affine, voxels.mean(axis=0))
+    centre = np.where(np.abs(named - centroid) <= np.abs(-named - centroid), named, -named)
+    # Discretisation moves the centroid by a fraction of a voxel; more means another ROI
+    if np.linalg.norm(centre - centroid) > np.linalg.norm(img.header.get_zooms()[:3]):
+        print(f"{fname}: filename coordinate does not match the ROI, using its centroid")
+        return centroid
+    return centre
+
+
+def coordinates_from_filenames(fnames):
+    '''
+    Recover the coordinate table of an atlas stored as one NIfTI file per ROI, with the
+    centre (and network) encoded in the filenames, e.g. ..._roi001_coord-x_y_z_net-<network>.nii.gz.
+
+    The centres are world (RAS) coordinates of the ROI files. Filenames do not agree on
+    the sign of their axes (the Seitzman300 names give x mirrored), so every file is read
+    and each filename axis takes the sign that matches the centroid of the file's
+    non-zero voxels. A filename that does not match its ROI at all is replaced by the
+    centroid.
+
+    Returns:
+    pd.DataFrame: One row per file, sorted by ROI number, with columns name, x, y, z, network and fname.
+    '''
+    rows = []
+    for fname in fnames:
+        match = _ROI_FNAME.search(os.path.basename(fname))
+        if match is None:
+            raise ValueError(f"No ROI number and coordinate in filename {fname}")
+        named = np.array([float(match['x']), float(match['y']), float(match['z'])])
+        x, y, z = _file_centre(fname, named)
+        rows.append({'index': int(match['index']), 'name': f"roi{match['index']}",
+                     'x': x, 'y': y, 'z': z, 'network': match['network'], 'fname': fname})
+    coordinates = pd.DataFrame(rows, columns=['index', 'name', 'x', 'y', 'z', 'network', 'fname'])
+    return coordinates.sort_values('index').drop(columns='index').reset_index(drop=True)
+
+
+def _sphere_voxels(centres, radii, affine, shape):
+    '''
+    Voxels inside every sphere, found for all spheres at once.
+
+    Every sphere is tested against the same box of voxel offsets around its rounded
+    centre, large enough for the largest sphere, so the candidate voxels of all spheres
+    form one (n_spheres, n_offsets) array instead of a loop over spheres.
+
+    Returns:
+    (sphere, voxel, distance): Sphere position, linear voxel index and distance (mm)
+    to the centre of every (sphere, voxel) pair inside a sphere.
+    '''
+    inverse = np.linalg.inv(affine)
+    centres_vox = nib.affines.apply_affine(inverse, centres)
+    # Half-width in voxels of the index-space bounding box of a sphere of the largest radius
+    reach = np.ceil(radii.max() * np.linalg.norm(inverse[:3, :3], axis=1) + 0.5).astype(int)
+    offsets = np.stack(np.meshgrid(*[np.arange(-r, r + 1) for r in reach], indexing='ij'), -1).reshape(-1, 3)
+
+    candidates = np.round(centres_vox).astype(np.int64)[:, None, :] + offsets[None, :, :]
+    distance = np.linalg.norm(candidates @ affine[:3, :3].T + affine[:3, 3] - centres[:, None, :], axis=-1)
+    inside = (distance <= radii[:, None]) & np.all((candidates >= 0) & (candidates < shape), axis=-1)
+
+    sphere = np.nonzero(inside)[0]
+    voxel = np.ravel_multi_index(tuple(candidates[inside].T), shape)
+    return sphere, voxel, distance[inside]
+
+
+def sphere_atlas(coordinates, reference, radius=5.0, overlap='nearest', out_fname=None):
+    '''
+    Build spheres around a table of coordinates into a single integer label volume.
+
+    Replaces the one-file-per-ROI layout of coordinate atlases such as Seitzman300:
+    the returned volume can be warped (project_label, MNI -> volumetric) or summarised
+    (extract_roi_metrics.extract_metrics_from_roi) once for all ROIs.
+
+    Parameters:
+    coordinates (pd.DataFrame or str): Table of sphere centres, or its path, see read_coordinates.
+                                       Rows are numbered 1..n in the output volume.
+    reference (nii object or str): Image defining the output grid, e.g. the MNI template.
+    radius (float): Sphere radius in mm, used for rows without a 'radius' value. Default is 5.
+    overlap (str): Which sphere keeps a voxel inside several spheres: 'nearest' (closest centre),
+                   'smallest' (smallest radius), 'first' or 'last' (by row), or 'exclude' to
+                   leave shared voxels unlabeled.
+    out_fname (str or None): If given, save the volume there and its lookup table next to it
+                             as <stem>_lut.tsv (readable with project_label_utilities.read_lut).
+
+    Returns:
+    vol: The integer label volume on the reference grid.
+    lut (dict): Mapping from label id to ROI name ('<name>_net-<network>' when networks are given).
+    '''
+    if overlap not in OVERLAP_MODES:
+        raise ValueError(f"overlap needs to be one of {OVERLAP_MODES}.")
+    if isinstance(coordinates, str):
+        coordinates = read_coordinates(coordinates)
+    if isinstance(reference, str):
+        reference = nib.load(reference)
+    shape = reference.shape[:3]
+
+    n_rois = len(coordinates)
+    centres = coordinates[['x', 'y', 'z']].to_numpy(dtype=float)
+    radii = np.full(n_rois, float(radius))
+    if 'radius' in coordinates:
+        radii = coordinates['radius'].fillna(radius).to_numpy(dtype=float)
+
+    names = coordinates['name'].astype(str).tolist() if 'name' in coordinates \
+        else [f'roi{i:03d}' for i in range(1, n_rois + 1)]
+    if 'network' in coordinates:
+        names = [name if pd.isna(network) else f'{name}_net-{network}'
+                 for name, network in zip(names, coordinates['network'])]
+    lut = dict(zip(range(1, n_rois + 1), names))
+
+    data = np.zeros(int(np.prod(shape)), dtype=np.int16 if n_rois < 2 ** 15 else np.int32)
+    if n_rois:
+        sphere, voxel, distance = _sphere_voxels(centres, radii, reference.affine, shape)
+        if overlap == 'exclude':
+            voxels, counts = np.unique(voxel, return_counts=True)
+            keep = np.isin(voxel, voxels[counts == 1])
+            data[voxel[keep]] = sphere[keep] + 1
+        else:
+            priority = {'nearest': distance, 'smallest': radii[sphere],
+                        'first': sphere, 'last': -sphere}[overlap]
+            # The first occurrence of every voxel in priority order (ties by row) wins
+            order = np.lexsort((sphere, priority))
+            winners, first = np.unique(voxel[order], return_index=True)
+            data[winners] = sphere[order][first] + 1
+
+    vol = nib.Nifti1Image(data.reshape(shape), reference.affine)
+    vol.set_qform(reference.affine, code=1)
+    vol.set_sform(reference.affine, code=1)
+    if out_fname is not None:
+        nio.write_nifti(vol, out_fname)
+        stem = out_fname[:-len('.nii.gz')] if out_fname.endswith('.nii.gz') else os.path.splitext(out_fname)[0]
+        with open(f'{stem}_lut.tsv', 'w') as f:
+            f.write('index\tname\n')
+            f.writelines(f'{label_id}\t{name}\n' for label_id, name in lut.items())
+
+    return vol, lut
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build spheres around coordinates into one integer label volume and lookup table.")
+    parser.add_argument('coordinates', nargs='+',
+                        help="CSV/TSV with x, y, z (and optional radius, name, network) columns, "
+                             "or per-ROI NIfTI files named ..._roi<N>_coord-x_y_z_net-<network>.nii.gz")
+    parser.add_argument('--reference', required=True, help="Image defining the output grid")
+    parser.add_argument('--out', required=True, help="Output label volume (.nii.gz)")
+    parser.add_argument('--radius', type=float, default=5.0, help="Sphere radius in mm (default: 5)")
+    parser.add_argument('--overlap', default='nearest', choices=OVERLAP_MODES)
+    args = parser.parse_args(argv)
+
+    if len(args.coordinates) == 1 and not args.coordinates[0].endswith(('.nii', '.nii.gz')):
+        coordinates = read_coordinates(args.coordinates[0])
+    else:
+        coordinates = coordinates_from_filenames(args.coordinates)
+    vol, lut = sphere_atlas(coordinates, args.reference, args.radius, args.overlap, args.out)
+    print(f'{len(lut)} spheres, {np.count_nonzero(np.asanyarray(vol.dataobj))} voxels -> {args.out}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,117 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+import neuropythy as ny
+
+# Files whose modification invalidates a cached subject
+_SURFACES = ('white', 'pial', 'sphere', 'sphere.reg', 'inflated')
+_VOLUMES = ('ribbon.mgz',)
+
+# path -> (stamp, estimated bytes, neuropythy subject), least recently used first
+_subjects = OrderedDict()
+_lock = threading.Lock()
+_budget = 4 * 1024 ** 3
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+
+def subject_files(path):
+    '''Surface and volume files of a FreeSurfer subject that the cache depends on.'''
+    files = [os.path.join(path, 'surf', f'{hemi}.{surf}')
+             for hemi in ('lh', 'rh') for surf in _SURFACES]
+    files += [os.path.join(path, 'mri', vol) for vol in _VOLUMES]
+    return [f for f in files if os.path.exists(f)]
+
+
+def _stamp_and_size(path):
+    '''
+    Modification stamp and estimated in-memory size of a FreeSurfer subject.
+
+    The size counts the surface files as stored and the volumes uncompressed
+    (read from their headers only), which is what neuropythy keeps loaded.
+    '''
+    stamp = []
+    size = 0
+    for fname in subject_files(path):
+        st = os.stat(fname)
+        stamp.append((fname, st.st_mtime_ns))
+        if fname.endswith('.mgz'):
+            img = nib.load(fname)
+            size += int(np.prod(img.shape)) * img.get_data_dtype().itemsize
+        else:
+            size += st.st_size
+    return tuple(stamp), size
+
+
+def load_subject(path):
+    '''
+    Return the neuropythy FreeSurfer subject at path, loading it at most once per process.
+
+    Subjects are kept in a least-recently-used cache bounded by the budget set with
+    set_cache_budget. An entry is reloaded when any of its surfaces or its ribbon
+    image changed on disk since it was cached.
+
+    Parameters:
+    path (str): Path to the FreeSurfer subject directory.
+
+    Returns:
+    The neuropythy FreeSurfer subject.
+    '''
+    key = os.path.normpath(os.path.abspath(os.fspath(path)))
+    stamp, size = _stamp_and_size(key)
+
+    with _lock:
+        entry = _subjects.get(key)
+        if entry is not None:
+            if entry[0] == stamp:
+                _subjects.move_to_end(key)
+                _stats['hits'] += 1
+                return entry[2]
+            del _subjects[key]
+            _stats['invalidations'] += 1
+        _stats['misses'] += 1
+
+    # Load outside the lock so workers loading different subjects do not serialise
+    sub = ny.freesurfer_subject(path)
+
+    with _lock:
+        _subjects[key] = (stamp, size, sub)
+        _subjects.move_to_end(key)
+        _evict()
+    return sub
+
+
+def _evict():
+    # Always keep the most recent entry, even if it alone exceeds the budget
+    total = sum(entry[1] for entry in _subjects.values())
+    while total > _budget and len(_subjects) > 1:
+        _, (_, size, _) = _subjects.popitem(last=False)
+        total -= size
+        _stats['evictions'] += 1
+
+
+def set_cache_budget(max_bytes):
+    '''
+    Set the memory budget of the subject cache in bytes, evicting entries if needed.
+    '''
+    global _budget
+    with _lock:
+        _budget = max_bytes
+        _evict()
+
+
+def clear_subject_cache():
+    '''Drop every cached subject.'''
+    with _lock:
+        _subjects.clear()
+
+
+def subject_cache_info():
+    '''
+    Return the cache counters, the cached subject paths and their estimated size.
+    '''
+    with _lock:
+        return dict(_stats, budget=_budget, subjects=list(_subjects),
+                    bytes=sum(entry[1] for entry in _subjects.values()))
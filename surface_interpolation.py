@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
+
+import nifti_io as nio
+import sparse_label as sl
+import subject_cache as sc
+
+# Operators built in this process, keyed like the on-disk files
+_operators = {}
+
+
+def _sphere_reg_stamp(subject_path, hemisphere):
+    # mtime of the registration sphere, so a re-run recon-all invalidates stale operators
+    fname = os.path.join(os.fspath(subject_path), 'surf', f'{hemisphere}.sphere.reg')
+    return os.stat(fname).st_mtime_ns if os.path.exists(fname) else None
+
+
+def operator_key(src_path, trg_path, hemisphere, method, registration='fsaverage'):
+    '''
+    Key identifying the resampling operator between two subjects' hemispheres.
+    '''
+    parts = [os.path.abspath(os.fspath(src_path)), os.path.abspath(os.fspath(trg_path)),
+             hemisphere, method, registration,
+             _sphere_reg_stamp(src_path, hemisphere), _sphere_reg_stamp(trg_path, hemisphere)]
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+
+def build_interpolation_operator(src_hemi, trg_hemi, method='nearest', registration='fsaverage'):
+    '''
+    Build the sparse matrix that resamples per-vertex data from one hemisphere onto another.
+
+    Both hemispheres are compared on their shared spherical registration (sphere.reg
+    for 'fsaverage'). Row i of the operator holds the weights of the source vertices
+    contributing to target vertex i, so target_data = operator @ source_data.
+
+    Parameters:
+    src_hemi (neuropythy Cortex): The hemisphere the data is defined on.
+    trg_hemi (neuropythy Cortex): The hemisphere to resample onto.
+    method (str): 'nearest' (nearest source vertex, as used for labels) or 'linear'
+                  (barycentric weights of the enclosing source triangle).
+    registration (str): Name of the registration shared by both hemispheres.
+
+    Returns:
+    scipy.sparse.csr_matrix: Operator of shape (target vertex count, source vertex count).
+    '''
+    src_reg = src_hemi.registrations[registration]
+    trg_reg = trg_hemi.registrations[registration]
+    n_src = src_hemi.vertex_count
+    n_trg = trg_hemi.vertex_count
+
+    if method == 'nearest':
+        _, nearest = cKDTree(src_reg.coordinates.T).query(trg_reg.coordinates.T)
+        return sp.csr_matrix((np.ones(n_trg), (np.arange(n_trg), nearest)), shape=(n_trg, n_src))
+
+    if method == 'linear':
+        addr = src_reg.address(trg_reg.coordinates)
+        faces = src_reg.tess.index(addr['faces'])
+        bc = np.asarray(addr['coordinates'])
+        weights = np.vstack([bc, 1 - bc.sum(axis=0)])
+        # Targets outside every source triangle get an empty row
+        inside = np.all(np.isfinite(weights), axis=0) & np.all(faces >= 0, axis=0)
+        rows = np.tile(np.arange(n_trg)[inside], 3)
+        cols = faces[:, inside].ravel()
+        return sp.csr_matrix((weights[:, inside].ravel(), (rows, cols)), shape=(n_trg, n_src))
+
+    raise ValueError("method needs to be 'nearest' or 'linear'.")
+
+
+def interpolation_operator(src_path, trg_path, hemisphere, method='nearest', cache_dir=None):
+    '''
+    Load (or build once and save) the resampling operator between two FreeSurfer subjects.
+
+    Parameters:
+    src_path (str): Path to the source FreeSurfer subject.
+    trg_path (str): Path to the target FreeSurfer subject.
+    hemisphere (str): 'lh' or 'rh'.
+    method (str): 'nearest' or 'linear', see build_interpolation_operator.
+    cache_dir (str or None): Directory to persist operators in as .npz files.
+                             If None, operators are only kept for the lifetime of the process.
+
+    Returns:
+    scipy.sparse.csr_matrix: Operator of shape (target vertex count, source vertex count).
+    '''
+    if hemisphere not in ('lh', 'rh'):
+        raise ValueError("Hemisphere needs to be specified as 'lh' or 'rh'.")
+
+    key = operator_key(src_path, trg_path, hemisphere, method)
+
+    def build():
+        src_sub = sc.load_subject(src_path)
+        trg_sub = sc.load_subject(trg_path)
+        return build_interpolation_operator(getattr(src_sub, hemisphere),
+                                            getattr(trg_sub, hemisphere), method)
+
+    return cached_operator(key, build, cache_dir, f'{hemisphere}.{method}')
+
+
+def cached_operator(key, build, cache_dir=None, prefix='operator'):
+    '''
+    Return the sparse operator stored under key, calling build() to make it on a miss.
+
+    Operators are kept for the lifetime of the process and, with cache_dir, saved there
+    as <prefix>.<key>.npz so that later processes (and concurrent workers) load them
+    instead of rebuilding them.
+
+    Parameters:
+    key (str): Hash identifying the operator and everything it was built from.
+    build (callable): Function returning the operator as a scipy.sparse matrix.
+    cache_dir (str or None): Directory of the .npz files; None keeps operators in memory only.
+    prefix (str): Start of the file name, e.g. '<hemisphere>.<method>'.
+
+    Returns:
+    scipy.sparse.csr_matrix: The operator.
+    '''
+    if key in _operators:
+        return _operators[key]
+
+    fname = None
+    if cache_dir is not None:
+        fname = Path(cache_dir) / f'{prefix}.{key}.npz'
+        if fname.exists():
+            _operators[key] = sp.load_npz(fname).tocsr()
+            return _operators[key]
+
+    operator = sp.csr_matrix(build())
+    if fname is not None:
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        with nio.atomic_output(fname, suffix='.npz') as tmp:
+            sp.save_npz(tmp, operator)
+
+    _operators[key] = operator
+    return operator
+
+
+def project_labels(operator, labels, threshold=0.5):
+    '''
+    Resample many labels at once with a single sparse matrix-matrix product.
+
+    Parameters:
+    operator (scipy.sparse matrix): Operator from interpolation_operator.
+    labels (list of array): Vertex indices of every label on the source surface.
+    threshold (float): Minimum interpolated weight for a target vertex to be in the label.
+
+    Returns:
+    list of np.ndarray: Sorted target vertex indices of every label.
+    '''
+    projected = (operator @ sl.label_matrix(labels, operator.shape[1])).tocsc()
+    projected.eliminate_zeros()
+    result = []
+    for i in range(projected.shape[1]):
+        start, stop = projected.indptr[i], projected.indptr[i + 1]
+        rows = projected.indices[start:stop]
+        result.append(np.sort(rows[projected.data[start:stop] >= threshold]))
+    return result
+
+
+def project_data(operator, data):
+    '''
+    Resample per-vertex data (a vector, or one column per map) with one sparse product.
+    '''
+    return operator @ data
@@ -0,0 +1,27 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+import compute_r1_map as cr
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32])
+def test_streamed_matches_in_memory(tmp_path, dtype):
+    rng = np.random.default_rng(0)
+    shape = (10, 9, 12)
+    paths = {}
+    for name, data in [('t1', rng.integers(100, 1000, shape)), ('t2', rng.integers(50, 500, shape)),
+                       ('mask', rng.integers(0, 2, shape))]:
+        paths[name] = str(tmp_path / f'{name}.nii.gz')
+        nib.save(nib.Nifti1Image(data.astype(dtype), np.eye(4)), paths[name])
+
+    full = cr.compute_approx_r1(paths['t1'], paths['t2'], paths['mask'], str(tmp_path / 'full.nii.gz'))
+    # Two slices per slab
+    streamed = cr.compute_approx_r1(paths['t1'], paths['t2'], paths['mask'],
+                                    str(tmp_path / 'streamed.nii.gz'), max_memory=2 * 10 * 9 * 18)
+    np.testing.assert_array_equal(nib.load(streamed).get_fdata(), nib.load(full).get_fdata())
+
+    t1, t2, mask = (nib.load(paths[name]).get_fdata() for name in ('t1', 't2', 'mask'))
+    st2 = t2 * np.median(t1[mask > 0]) / np.median(t2[mask > 0])
+    np.testing.assert_allclose(nib.load(full).get_fdata(), (t1 - st2) / (t1 + st2),
+                               rtol=1e-5, atol=1e-6)
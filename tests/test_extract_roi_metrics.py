@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+import signal
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+import extract_roi_metrics as erm
+
+
+def test_std_with_large_offset():
+    rng = np.random.default_rng(0)
+    labels = np.ones(100_000, dtype=np.int64)
+    values = 3e4 + rng.normal(0, 1e-2, labels.size)
+    for dtype in (np.float64, np.float32):
+        data = values.astype(dtype)
+        _, results = erm.reduce_by_label(labels, [data], ('mean', 'std'))
+        np.testing.assert_allclose(results['std'][0, 0], data.astype(np.float64).std(), rtol=1e-6)
+        np.testing.assert_allclose(results['mean'][0, 0], data.astype(np.float64).mean(), rtol=1e-12)
+
+
+def test_blocks_merge_like_one_pass():
+    rng = np.random.default_rng(1)
+    region_index = rng.integers(0, 4, 10_000)
+    values = 1e3 + rng.normal(0, 1, (10_000, 2))
+    acc = erm.init_accumulators(2, 4)
+    for block in np.array_split(np.arange(10_000), 7):
+        erm.update_accumulators(acc, region_index[block], values[block])
+    results = erm.finalize_accumulators(acc, ('mean', 'std'))
+    for region in range(4):
+        np.testing.assert_allclose(results['std'][:, region], values[region_index == region].std(axis=0))
+        np.testing.assert_allclose(results['mean'][:, region], values[region_index == region].mean(axis=0))
+
+
+def test_streamed_matches_in_memory(tmp_path):
+    rng = np.random.default_rng(2)
+    shape = (12, 10, 16)
+    labels = rng.integers(0, 6, shape).astype(np.int16)
+    metrics = [rng.normal(100, 10, shape).astype(np.float32), rng.normal(0, 1, shape + (3,))]
+    metrics[0][0, 0, :4] = np.nan
+    paths = []
+    for i, data in enumerate([labels] + metrics):
+        paths.append(str(tmp_path / f'img{i}.nii.gz'))
+        nib.save(nib.Nifti1Image(data, np.eye(4)), paths[-1])
+
+    stats = ('mean', 'std', 'count', 'nan_count', 'min', 'max', 'median')
+    expected = erm.extract_metrics_from_roi(paths[0], paths[1:], ['T1', 'bold'], 'sub-01', stats)
+    # A few slices per slab, so every statistic is merged across slabs
+    streamed = erm.extract_metrics_from_roi(paths[0], paths[1:], ['T1', 'bold'], 'sub-01', stats,
+                                            max_memory=3 * 12 * 10 * 40)
+    assert list(streamed.columns) == list(expected.columns)
+    assert {'bold_vol2', 'bold_vol2_median', 'T1_median'} <= set(expected.columns)
+    pd.testing.assert_frame_equal(streamed, expected, check_dtype=False, rtol=1e-10)
+
+
+def _crash_on_subject(label_img, metric_imgs, metric_names, subject_id, *args):
+    if subject_id == 'crash':
+        os.kill(os.getpid(), signal.SIGKILL)
+    return _extract_metrics_from_roi(label_img, metric_imgs, metric_names, subject_id, *args)
+
+
+_extract_metrics_from_roi = erm.extract_metrics_from_roi
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason="the patched worker function only reaches forked workers")
+@pytest.mark.parametrize('chunk_size', [1, 2])
+def test_batch_survives_killed_worker(tmp_path, monkeypatch, chunk_size):
+    rng = np.random.default_rng(3)
+    shape = (6, 5, 4)
+    nib.save(nib.Nifti1Image(rng.integers(0, 3, shape).astype(np.int16), np.eye(4)), tmp_path / 'label.nii.gz')
+    nib.save(nib.Nifti1Image(rng.normal(size=shape), np.eye(4)), tmp_path / 'FA.nii.gz')
+    subjects = ['01', 'crash', '03', '04']
+    manifest = pd.DataFrame({'subject': subjects, 'label': str(tmp_path / 'label.nii.gz'),
+                             'FA': str(tmp_path / 'FA.nii.gz')})
+    monkeypatch.setattr(erm, 'extract_metrics_from_roi', _crash_on_subject)
+
+    out_dir = tmp_path / 'out'
+    failures = erm.extract_metrics_batch(manifest, out_dir, max_workers=1, max_pending=1,
+                                         chunk_size=chunk_size)
+    assert failures['subject'].tolist() == ['crash']
+    assert pd.read_csv(out_dir / '_failures.csv', dtype=str)['subject'].tolist() == ['crash']
+    assert sorted(pd.read_parquet(out_dir)['subject'].unique()) == ['01', '03', '04']
@@ -0,0 +1,47 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import label_io as lio
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LABELS = sorted(glob.glob(os.path.join(TESTS_DIR, '*', '*.label')))
+
+
+@pytest.mark.parametrize('fname', LABELS, ids=os.path.basename)
+def test_parse_format_round_trip(fname):
+    with open(fname) as f:
+        text = f.read()
+    label = lio.parse_label(text)
+    assert len(label.vertices) == int(text.split('\n')[1])
+
+    again = lio.parse_label(lio.format_label(*label))
+    np.testing.assert_array_equal(again.vertices, label.vertices)
+    np.testing.assert_array_equal(again.coords, label.coords)
+    np.testing.assert_array_equal(again.values, label.values)
+    assert again.comment == label.comment
+
+
+def test_format_matches_mne_output():
+    # Written by mne.Label.save, whose row format format_label reproduces
+    fname = os.path.join(TESTS_DIR, 'transformed_labels', 'lh_Seittzmann300_01.label')
+    with open(fname) as f:
+        text = f.read()
+    assert lio.format_label(*lio.parse_label(text)) == text
+
+
+@pytest.mark.parametrize('setting', ['', '0', '1', 'cache'])
+def test_sidecar_follows_environment(tmp_path, monkeypatch, setting):
+    fname = tmp_path / 'lh.roi.label'
+    lio.write_label(fname, [5, 1, 3], comment='roi')
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv(lio.CACHE_ENV_VAR, str(cache_dir) if setting == 'cache' else setting)
+
+    for _ in range(2):
+        label = lio.read_label(fname)
+        np.testing.assert_array_equal(label.vertices, [5, 1, 3])
+        assert label.comment == 'roi'
+    sidecars = {'1': tmp_path / '.lh.roi.label.npz', 'cache': cache_dir / '.lh.roi.label.npz'}
+    assert sorted(tmp_path.rglob('*.npz')) == ([sidecars[setting]] if setting in sidecars else [])
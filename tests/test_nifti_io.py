@@ -0,0 +1,57 @@
+import gzip
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import nifti_io as nio
+
+
+@pytest.mark.parametrize('compresslevel', [0, 1, 6])
+@pytest.mark.parametrize('size', [0, 1, 1000, 10_000])
+def test_gzip_compress_round_trip(compresslevel, size):
+    data = np.random.default_rng(size).integers(0, 4, size, dtype=np.uint8).tobytes()
+    # Small blocks, so every non-trivial input spans several of them
+    compressed = nio.gzip_compress(data, compresslevel, max_workers=3, block_size=512)
+    assert gzip.decompress(compressed) == data
+
+
+@pytest.mark.parametrize('compresslevel', [0, 1, 6])
+@pytest.mark.parametrize('suffix', ['.nii', '.nii.gz'])
+def test_write_nifti_round_trip(tmp_path, compresslevel, suffix):
+    # Just over one BLOCK_SIZE of voxel data, so the gzip stream has two blocks
+    data = np.random.default_rng(0).normal(size=(128, 128, 33, 2)).astype(np.float32)
+    affine = np.diag([2.0, 2.0, 3.0, 1.0])
+    fname = tmp_path / f'img{suffix}'
+    nio.write_nifti(nib.Nifti1Image(data, affine), fname, compresslevel)
+
+    img = nib.load(fname)
+    np.testing.assert_array_equal(img.get_fdata(dtype=np.float32), data)
+    np.testing.assert_array_equal(img.affine, affine)
+    assert [p.name for p in tmp_path.iterdir()] == [fname.name]
+
+
+def test_async_writer_reports_errors(tmp_path):
+    img = nib.Nifti1Image(np.zeros((2, 2, 2), dtype=np.int16), np.eye(4))
+    with pytest.raises(FileNotFoundError):
+        with nio.AsyncWriter(max_pending=1) as writer:
+            for i in range(3):
+                writer.submit(img, tmp_path / f'{i}.nii.gz')
+            writer.submit(img, tmp_path / 'missing' / 'x.nii.gz')
+            written = writer.wait()
+    assert [written[str(tmp_path / f'{i}.nii.gz')] for i in range(3)] == [None] * 3
+    assert all(nib.load(tmp_path / f'{i}.nii.gz').shape == (2, 2, 2) for i in range(3))
+
+
+def test_write_ants_round_trip(tmp_path):
+    ants = pytest.importorskip('ants')
+    direction = np.array([[0.0, 1.0, 0.0], [-1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+    img = ants.from_numpy(np.random.default_rng(0).random((5, 6, 7)).astype(np.float32),
+                          origin=(1.0, 2.0, 3.0), spacing=(1.5, 2.0, 2.5), direction=direction)
+    fname = nio.write_ants(img, tmp_path / 'img.nii.gz')
+
+    read = ants.image_read(fname)
+    np.testing.assert_allclose(read.origin, img.origin)
+    np.testing.assert_allclose(read.spacing, img.spacing)
+    np.testing.assert_allclose(read.direction, img.direction, atol=1e-12)
+    np.testing.assert_array_equal(read.numpy(), img.numpy())
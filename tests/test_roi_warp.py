@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+ants = pytest.importorskip('ants')
+
+import roi_warp as rw
+
+
+def _identity(tmp_path):
+    fname = str(tmp_path / 'identity.mat')
+    ants.write_transform(ants.create_ants_transform(transform_type='AffineTransform', dimension=3), fname)
+    return [fname]
+
+
+def _affine_and_warp(tmp_path, fixed):
+    # A rotation about z plus a translation, and a constant displacement field with its inverse
+    transform = ants.create_ants_transform(transform_type='AffineTransform', dimension=3)
+    c, s = np.cos(0.2), np.sin(0.2)
+    transform.set_parameters(np.array([c, -s, 0, s, c, 0, 0, 0, 1, 6.0, -4.0, 3.0]))
+    affine = str(tmp_path / 'affine.mat')
+    ants.write_transform(transform, affine)
+    displacement = np.zeros(fixed.shape + (3,), dtype=np.float32)
+    displacement[..., 0], displacement[..., 2] = 2.0, -1.5
+    warps = []
+    for name, sign in (('warp', 1), ('inverse_warp', -1)):
+        warps.append(str(tmp_path / f'{name}.nii.gz'))
+        ants.image_write(ants.from_numpy(sign * displacement, origin=fixed.origin, spacing=fixed.spacing,
+                                         has_components=True), warps[-1])
+    return affine, warps
+
+
+def _images():
+    fixed = ants.from_numpy(np.random.default_rng(0).random((40, 48, 36)).astype(np.float32),
+                            origin=(-20.0, -30.0, -10.0), spacing=(1.0, 1.0, 1.0))
+    data = np.zeros((20, 24, 18), dtype=np.float32)
+    data[3:6, 10:13, 7:9] = 1
+    roi = ants.from_numpy(data, origin=(-19.0, -29.0, -9.0), spacing=(2.0, 2.0, 2.0))
+    return fixed, roi
+
+
+def test_region_grid_covers_lower_to_upper():
+    fixed, _ = _images()
+    grid = rw.region_grid(fixed, np.array([3, 4, 5]), np.array([10, 12, 9]))
+    assert grid.shape == (7, 8, 4)
+    np.testing.assert_allclose(grid.origin, np.asarray(fixed.origin) + [3, 4, 5])
+
+
+@pytest.mark.parametrize('cropped', [False, True])
+def test_restricted_warp_matches_full_warp(tmp_path, cropped):
+    fixed, roi = _images()
+    transforms = _identity(tmp_path)
+    full = ants.apply_transforms(fixed=fixed, moving=roi, transformlist=transforms,
+                                 interpolator='genericLabel').numpy()
+    warped = rw.warp_roi(fixed, roi, transforms, transforms, cropped=cropped)
+    if cropped:
+        lower, upper = rw.roi_target_region(fixed, roi, transforms)
+        assert warped.shape == tuple(upper - lower)
+        full = full[tuple(slice(lo, hi) for lo, hi in zip(lower, upper))]
+    assert full.sum() > 0
+    np.testing.assert_array_equal(warped.numpy(), full)
+
+
+@pytest.mark.parametrize('syn', [False, True])
+def test_restricted_warp_follows_the_transform(tmp_path, syn):
+    fixed, roi = _images()
+    affine, (warp, inverse_warp) = _affine_and_warp(tmp_path, fixed)
+    # Laid out like ants.registration's fwdtransforms / invtransforms
+    fwdtransforms, invtransforms = ([warp, affine], [affine, inverse_warp]) if syn else ([affine], [affine])
+    # apply_label_transforms warps 3D ROIs without inverse transforms in full like this
+    full = ants.apply_transforms(fixed=fixed, moving=roi, transformlist=fwdtransforms,
+                                 interpolator='genericLabel').numpy()
+    warped = rw.warp_roi(fixed, roi, fwdtransforms, invtransforms)
+    assert full.sum() > 0
+    np.testing.assert_array_equal(warped.numpy(), full)
@@ -0,0 +1,34 @@
+import glob
+import os
+
+import numpy as np
+import nibabel as nib
+import pandas as pd
+
+import sphere_atlas as sa
+
+ROI_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'orig_labels', '*_roi*_coord-*.nii.gz')))
+
+
+def test_rebuilds_bundled_roi_files():
+    assert ROI_FILES
+    coordinates = sa.coordinates_from_filenames(ROI_FILES)
+    for i, fname in enumerate(ROI_FILES):
+        roi = nib.load(fname)
+        vol, lut = sa.sphere_atlas(coordinates.iloc[[i]], roi, radius=5.0)
+        np.testing.assert_array_equal(np.asanyarray(vol.dataobj) != 0, np.asanyarray(roi.dataobj) != 0)
+
+
+def test_filename_x_is_mirrored_to_the_roi():
+    coordinates = sa.coordinates_from_filenames(ROI_FILES[:1])
+    np.testing.assert_allclose(coordinates[['x', 'y', 'z']].to_numpy()[0], [-56.16, -44.76, -24.23])
+
+
+def test_overlap_nearest_centre_wins():
+    reference = nib.Nifti1Image(np.zeros((20, 20, 20), dtype=np.int16), np.eye(4))
+    coordinates = {'x': [8.0, 12.0], 'y': [10.0, 10.0], 'z': [10.0, 10.0]}
+    vol, _ = sa.sphere_atlas(pd.DataFrame(coordinates), reference, radius=3.0)
+    data = np.asanyarray(vol.dataobj)
+    assert data[9, 10, 10] == 1 and data[11, 10, 10] == 2
+    # Equidistant voxels go to the first row
+    assert data[10, 10, 10] == 1
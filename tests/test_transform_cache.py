@@ -0,0 +1,20 @@
+import transform_cache as tc
+
+
+def _registration(tmp_path):
+    fnames = []
+    for name in ('affine.mat', 'warp.nii.gz'):
+        fnames.append(str(tmp_path / name))
+        (tmp_path / name).write_text(name)
+    return {'fwdtransforms': fnames, 'invtransforms': fnames[:1]}
+
+
+def test_put_replaces_a_leftover_entry(tmp_path):
+    cache = tc.TransformCache(tmp_path / 'cache')
+    # A directory left behind without a manifest, e.g. by a crashed run
+    (tmp_path / 'cache' / 'key').mkdir()
+    (tmp_path / 'cache' / 'key' / '0.mat').write_text('stale')
+
+    stored = cache.put('key', _registration(tmp_path))
+    assert cache.get('key') == stored
+    assert [open(f).read() for f in stored['fwdtransforms']] == ['affine.mat', 'warp.nii.gz']
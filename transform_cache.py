@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import nifti_io as nio
+
+
+def file_digest(path, chunk_size=1 << 20):
+    '''
+    SHA-256 hex digest of a file's contents, read in chunks.
+
+    Parameters:
+    path (str or Path): The file to hash.
+    chunk_size (int): Bytes read per chunk.
+
+    Returns:
+    str: The hex digest.
+    '''
+    digest = hashlib.sha256()
+    with open(os.fspath(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def registration_key(**parts):
+    '''
+    Build a cache key from named parts (file digests, mask settings, transform type).
+
+    The parts are serialised as sorted JSON so the key does not depend on argument order.
+    '''
+    blob = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha256(blob).hexdigest()
+
+
+class TransformCache:
+    '''
+    Content-addressed on-disk cache of ANTs registration transforms.
+
+    Each entry is a directory named after its key holding the forward and inverse
+    transform files of one ants.registration call plus a manifest.json that keeps
+    their order. The least recently used entries are evicted once the cache grows
+    beyond max_bytes.
+
+    Parameters:
+    cache_dir (str): Directory holding the cache entries.
+    max_bytes (int or None): Size limit of the cache. None disables eviction.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        '''Return the hit/miss/eviction counters and current size of the cache.'''
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries()), 'bytes': self.size()}
+
+    def get(self, key):
+        '''
+        Look up a registration by key.
+
+        Returns:
+        dict or None: {'fwdtransforms': [...], 'invtransforms': [...]} with paths
+        inside the cache, or None on a miss.
+        '''
+        entry = self.cache_dir / key
+        manifest = entry / 'manifest.json'
+        if not manifest.exists():
+            return None
+        with open(manifest) as f:
+            transforms = json.load(f)
+        paths = transforms['fwdtransforms'] + transforms['invtransforms']
+        if not all((entry / name).exists() for name in paths):
+            return None
+        # Refresh the entry so LRU eviction sees it as recently used
+        os.utime(entry)
+        return {kind: [str(entry / name) for name in names]
+                for kind, names in transforms.items()}
+
+    def put(self, key, registration):
+        '''
+        Copy the transforms of an ants.registration result into the cache.
+
+        Returns:
+        dict: The cached {'fwdtransforms', 'invtransforms'} paths.
+        '''
+        entry = self.cache_dir / key
+        for attempt in range(2):
+            try:
+                self._write_entry(entry, registration)
+                break
+            except OSError:
+                # A concurrent writer with the same key wins harmlessly
+                if not entry.exists():
+                    raise
+                if attempt or self.get(key) is not None:
+                    break
+                # A leftover directory that get() rejects would otherwise miss forever
+                shutil.rmtree(entry, ignore_errors=True)
+
+        self.evict()
+        stored = self.get(key)
+        return stored if stored is not None else {k: list(registration[k])
+                                                  for k in ('fwdtransforms', 'invtransforms')}
+
+    def _write_entry(self, entry, registration):
+        names = {}
+        transforms = {}
+        # Published atomically, see nifti_io.atomic_output
+        with nio.atomic_output(entry) as tmp:
+            tmp = Path(tmp)
+            tmp.mkdir(parents=True)
+            for kind in ('fwdtransforms', 'invtransforms'):
+                transforms[kind] = []
+                for src in registration[kind]:
+                    if src not in names:
+                        # Keep the extension(s) ANTs relies on to pick the transform reader
+                        base = os.path.basename(src)
+                        suffix = base[base.index('.'):] if '.' in base else ''
+                        names[src] = f'{len(names)}{suffix}'
+                        shutil.copyfile(src, tmp / names[src])
+                    transforms[kind].append(names[src])
+            with open(tmp / 'manifest.json', 'w') as f:
+                json.dump(transforms, f)
+
+    def registration(self, key, fixed, moving, type_of_transform, **kwargs):
+        '''
+        Return the cached registration for key, running ants.registration on a miss.
+
+        Parameters:
+        key (str): Cache key, see registration_key.
+        fixed (ants.ANTsImage): Fixed image.
+        moving (ants.ANTsImage): Moving image.
+        type_of_transform (str): ANTs transform type, e.g. 'Affine' or 'SyN'.
+        **kwargs: Passed to ants.registration.
+
+        Returns:
+        dict: {'fwdtransforms': [...], 'invtransforms': [...]} transform paths.
+        '''
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        # Imported on first use so key and store helpers do not load ANTs
+        import ants
+        reg = ants.registration(fixed=fixed, moving=moving,
+                                type_of_transform=type_of_transform, **kwargs)
+        return self.put(key, reg)
+
+    def size(self):
+        '''Total size of all cache entries in bytes.'''
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits in max_bytes.'''
+        if self.max_bytes is None:
+            return
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        for entry, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        '''Remove every cache entry.'''
+        for entry, _, _ in self._entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def _entries(self):
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            if entry.is_dir() and not entry.name.startswith('.'):
+                size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+                entries.append((entry, entry.stat().st_mtime, size))
+        return entries
+
+
+def mni_registration_key(t1_fname, template_fname, calc_brain_mask, type_of_transform,
+                         direction, moving_fname=None):
+    '''
+    Cache key for the MNI <-> native registrations of project_label_utilities.
+
+    Parameters:
+    t1_fname (str): The path to the T1 file.
+    template_fname (str): The path to the MNI template.
+    calc_brain_mask (bool): Whether the T1 was brain-masked before registration.
+    type_of_transform (str): ANTs transform type.
+    direction (str): 'mni2native' or 'native2mni'.
+    moving_fname (str or None): Extra input the moving image was derived from, if any.
+    '''
+    return registration_key(
+        t1=file_digest(t1_fname),
+        template=file_digest(template_fname),
+        brain_mask={'low_thresh': 500, 'high_thresh': 2000, 'cleanup': 2} if calc_brain_mask else None,
+        moving=file_digest(moving_fname) if moving_fname else None,
+        type_of_transform=type_of_transform,
+        direction=direction)
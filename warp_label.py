@@ -1,9 +1,35 @@
 import ants
 
-def warp_to_mni(native_img_path, mni_template_path, output_path):
-    native = ants.image_read(native_img_path)
-    mni = ants.image_read(mni_template_path)
-    reg = ants.registration(fixed=mni, moving=native, type_of_transform='Affine')
-    warped = ants.apply_transforms(fixed=mni, moving=native, transformlist=reg['fwdtransforms'])
-    ants.image_write(warped, output_path)
-    return output_path
+import nifti_io as nio
+import roi_warp as rw
+
+def warp_to_mni(native_img_path, mni_template_path, output_path, result_store=None,
+                restrict_to_roi=False, compresslevel=nio.DEFAULT_COMPRESSLEVEL):
+    """
+    Affinely register an image to an MNI template and write the warped image.
+
+    If a ResultStore is given, a previous run with identical inputs is restored
+    from it instead of being recomputed. With restrict_to_roi only the part of the
+    template grid that the image's non-zero voxels map to is resampled, which is
+    much faster for small ROI images. NIfTI outputs are written through nifti_io
+    (block-parallel gzip at compresslevel, 0 for none).
+    """
+    def compute():
+        native = ants.image_read(native_img_path)
+        mni = ants.image_read(mni_template_path)
+        reg = ants.registration(fixed=mni, moving=native, type_of_transform='Affine')
+        if restrict_to_roi:
+            warped = rw.warp_roi(mni, native, reg['fwdtransforms'], reg['invtransforms'], 'linear')
+        else:
+            warped = ants.apply_transforms(fixed=mni, moving=native, transformlist=reg['fwdtransforms'])
+        nio.write_ants(warped, output_path, compresslevel)
+        return output_path
+
+    if result_store is None:
+        return compute()
+    # restrict_to_roi only enters the key when set, so existing entries stay valid
+    params = {'type_of_transform': 'Affine'}
+    if restrict_to_roi:
+        params['restrict_to_roi'] = True
+    return result_store.cached('warp_to_mni', [native_img_path, mni_template_path], params,
+                               [output_path], compute, lambda paths: paths[0])
@@ -0,0 +1,132 @@
+# Thin client of worker_service; standard library only so that it starts instantly
+import argparse
+import json
+import os
+import socket
+
+SOCKET_ENV_VAR = 'PROJECT_LABEL_SOCKET'
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+                              f'project_label-{os.getuid()}.sock')
+
+
+class WorkerError(RuntimeError):
+    '''A job failed inside the worker; the worker's traceback is kept on .remote_traceback.'''
+
+    def __init__(self, message, remote_traceback=None):
+        super().__init__(message)
+        self.remote_traceback = remote_traceback
+
+
+class WorkerClient:
+    '''
+    Connection to a running worker_service.
+
+    Parameters:
+    socket_path (str or None): Worker socket. Default is $PROJECT_LABEL_SOCKET or DEFAULT_SOCKET.
+    timeout (float or None): Seconds to wait for a response; None waits for as long as the job runs.
+    '''
+
+    def __init__(self, socket_path=None, timeout=None):
+        self.socket_path = socket_path or os.environ.get(SOCKET_ENV_VAR, DEFAULT_SOCKET)
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._next_id = 0
+
+    def connect(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(self.timeout)
+            self._sock.connect(self.socket_path)
+            self._file = self._sock.makefile('rwb')
+        return self
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def call(self, op, **kwargs):
+        '''
+        Run one job in the worker and return its (JSON) result.
+
+        Raises:
+        WorkerError: If the job failed in the worker.
+        '''
+        self.connect()
+        self._next_id += 1
+        request = {'id': self._next_id, 'op': op, 'kwargs': kwargs}
+        self._file.write((json.dumps(request) + '\n').encode())
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            self.close()
+            raise ConnectionError(f'Worker at {self.socket_path} closed the connection')
+        response = json.loads(line)
+        if not response['ok']:
+            raise WorkerError(response['error'], response.get('traceback'))
+        return response['result']
+
+    def project_label(self, **kwargs):
+        '''project_label.project_label in the worker; returns a JSON description of the result.'''
+        return self.call('project_label', **kwargs)
+
+    def extract_metrics(self, **kwargs):
+        '''extract_roi_metrics.extract_metrics_from_roi in the worker; returns the rows as dicts.'''
+        return self.call('extract_metrics', **kwargs)
+
+    def compute_r1(self, **kwargs):
+        '''compute_r1_map.compute_approx_r1 in the worker; returns the output path.'''
+        return self.call('compute_r1', **kwargs)
+
+    def load_subject(self, path):
+        '''Load a FreeSurfer subject into the worker's subject cache.'''
+        return self.call('load_subject', path=path)
+
+    def ping(self):
+        return self.call('ping')
+
+    def stats(self):
+        return self.call('stats')
+
+    def shutdown(self):
+        return self.call('shutdown')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Send a job to a running worker_service. Arguments are key=value; "
+                    "values are parsed as JSON when possible, e.g. calc_brain_mask=true.")
+    parser.add_argument('op', help="project_label, extract_metrics, compute_r1, load_subject, "
+                                   "stats, ping or shutdown")
+    parser.add_argument('kwargs', nargs='*', metavar='key=value')
+    parser.add_argument('--socket', default=None, help="Socket path (default: $PROJECT_LABEL_SOCKET)")
+    args = parser.parse_args(argv)
+
+    kwargs = {}
+    for item in args.kwargs:
+        key, _, value = item.partition('=')
+        try:
+            kwargs[key] = json.loads(value)
+        except ValueError:
+            kwargs[key] = value
+
+    with WorkerClient(args.socket) as client:
+        try:
+            result = client.call(args.op, **kwargs)
+        except WorkerError as err:
+            print(err.remote_traceback or err)
+            return 1
+    print(json.dumps(result, indent=1))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
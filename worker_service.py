@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+from worker_client import DEFAULT_SOCKET, SOCKET_ENV_VAR
+
+
+def _jsonable(result):
+    '''
+    Describe a job result with JSON types: labels by their vertices, images by
+    their shape and affine, data frames as records.
+    '''
+    if result is None or isinstance(result, (str, int, float, bool)):
+        return result
+    if isinstance(result, dict):
+        return {str(k): _jsonable(v) for k, v in result.items()}
+    if isinstance(result, (list, tuple)):
+        return [_jsonable(v) for v in result]
+    if hasattr(result, 'to_dict') and hasattr(result, 'columns'):
+        return result.to_dict(orient='records')
+    if hasattr(result, 'vertices') and hasattr(result, 'hemi'):
+        return {'type': 'label', 'name': result.name, 'hemi': result.hemi,
+                'vertices': [int(v) for v in result.vertices]}
+    if hasattr(result, 'tolist') and hasattr(result, 'dtype'):
+        return result.tolist()
+    if hasattr(result, 'affine') and hasattr(result, 'shape'):
+        affine = result.affine
+        return {'type': 'image', 'shape': list(result.shape),
+                'affine': affine.tolist() if hasattr(affine, 'tolist') else affine}
+    if hasattr(result, 'origin') and hasattr(result, 'spacing'):
+        return {'type': 'image', 'shape': list(result.shape), 'origin': list(result.origin),
+                'spacing': list(result.spacing)}
+    return repr(result)
+
+
+# Ops answered without waiting for a job slot (shutdown is handled by the server itself)
+_CONTROL_OPS = ('ping', 'stats')
+
+
+class ProjectionService:
+    '''
+    Keeps the projection libraries, the MNI template and recently used subjects
+    loaded, and runs jobs sent by worker_client against them.
+
+    Jobs run one at a time by default (max_concurrent), since a single ANTs
+    registration already uses every ITK thread.
+
+    Parameters:
+    transform_cache_dir (str or None): TransformCache directory used by project_label jobs.
+    result_store_dir (str or None): ResultStore directory used by project_label jobs.
+    max_concurrent (int): Number of jobs allowed to run at the same time.
+    '''
+
+    def __init__(self, transform_cache_dir=None, result_store_dir=None, max_concurrent=1):
+        self.transform_cache_dir = transform_cache_dir
+        self.result_store_dir = result_store_dir
+        self.transform_cache = None
+        self.result_store = None
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self.started = time.time()
+        self.served = 0
+        self.failed = 0
+        self.busy_s = 0.0
+        self._ops = {'project_label': self._project_label,
+                     'extract_metrics': self._extract_metrics,
+                     'compute_r1': self._compute_r1,
+                     'load_subject': self._load_subject,
+                     'stats': self._stats,
+                     'ping': lambda: 'pong'}
+
+    def warm(self, subjects=()):
+        '''
+        Import the heavy libraries, read the MNI template and preload subjects.
+        '''
+        t0 = time.perf_counter()
+        import project_label
+        import project_label_utilities as pl
+        import subject_cache as sc
+        import extract_roi_metrics
+        import compute_r1_map
+        from transform_cache import TransformCache
+        from result_store import ResultStore
+
+        self.transform_cache = TransformCache(self.transform_cache_dir) if self.transform_cache_dir else None
+        self.result_store = ResultStore(self.result_store_dir) if self.result_store_dir else None
+        pl.template_image('mni')
+        for path in subjects:
+            sc.load_subject(path)
+        print(f'Warm after {time.perf_counter() - t0:.1f}s ({len(subjects)} subject(s) preloaded)')
+
+    def _project_label(self, **kwargs):
+        import project_label
+        kwargs.setdefault('transform_cache', self.transform_cache)
+        kwargs.setdefault('result_store', self.result_store)
+        return project_label.project_label(**kwargs)
+
+    def _extract_metrics(self, **kwargs):
+        import extract_roi_metrics
+        return extract_roi_metrics.extract_metrics_from_roi(**kwargs)
+
+    def _compute_r1(self, **kwargs):
+        import compute_r1_map
+        return compute_r1_map.compute_approx_r1(**kwargs)
+
+    def _load_subject(self, path):
+        import subject_cache as sc
+        sc.load_subject(path)
+        return sc.subject_cache_info()
+
+    def _stats(self):
+        import subject_cache as sc
+        stats = {'uptime_s': time.time() - self.started, 'served': self.served,
+                 'failed': self.failed, 'busy_s': self.busy_s, 'pid': os.getpid(),
+                 'subject_cache': sc.subject_cache_info()}
+        if self.transform_cache is not None:
+            stats['transform_cache'] = self.transform_cache.stats()
+        return stats
+
+    def handle(self, request):
+        '''
+        Run one request {'op': name, 'kwargs': {...}} and return the response dict.
+        '''
+        op = self._ops.get(request.get('op'))
+        if op is None:
+            return {'ok': False, 'error': f"Unknown op {request.get('op')!r}; expected one of {sorted(self._ops)}"}
+        if request['op'] in _CONTROL_OPS:
+            # Answered right away, even while every job slot is taken
+            return {'ok': True, 'result': _jsonable(op(**request.get('kwargs', {})))}
+        with self._slots:
+            t0 = time.perf_counter()
+            try:
+                result = _jsonable(op(**request.get('kwargs', {})))
+            except Exception as err:
+                self.failed += 1
+                return {'ok': False, 'error': repr(err), 'traceback': traceback.format_exc(),
+                        'elapsed_s': time.perf_counter() - t0}
+            finally:
+                self.served += 1
+                self.busy_s += time.perf_counter() - t0
+        return {'ok': True, 'result': result, 'elapsed_s': time.perf_counter() - t0}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # One JSON request per line, answered by one JSON response line
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as err:
+                response = {'ok': False, 'error': f'Invalid request: {err}'}
+            else:
+                if request.get('op') == 'shutdown':
+                    response = {'ok': True, 'result': 'shutting down'}
+                    threading.Thread(target=self.server.shutdown, daemon=True).start()
+                else:
+                    response = self.server.service.handle(request)
+                if 'id' in request:
+                    response['id'] = request['id']
+            self.wfile.write((json.dumps(response, default=str) + '\n').encode())
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _remove_stale_socket(socket_path):
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(socket_path)
+    else:
+        raise RuntimeError(f'A worker is already listening on {socket_path}')
+    finally:
+        probe.close()
+
+
+def serve(socket_path=None, transform_cache_dir=None, result_store_dir=None, max_concurrent=1,
+          subjects=()):
+    '''
+    Run the warm projection worker on a Unix socket until it receives a shutdown request.
+
+    Parameters:
+    socket_path (str or None): Socket to listen on. Default is $PROJECT_LABEL_SOCKET or DEFAULT_SOCKET.
+    transform_cache_dir (str or None): TransformCache directory for project_label jobs.
+    result_store_dir (str or None): ResultStore directory for project_label jobs.
+    max_concurrent (int): Number of jobs allowed to run at the same time.
+    subjects (list of str): FreeSurfer subject directories to load before accepting jobs.
+    '''
+    socket_path = socket_path or os.environ.get(SOCKET_ENV_VAR, DEFAULT_SOCKET)
+    service = ProjectionService(transform_cache_dir, result_store_dir, max_concurrent)
+    service.warm(subjects)
+
+    _remove_stale_socket(socket_path)
+    # Only the owner may connect: jobs read and write files with the owner's rights
+    old_umask = os.umask(0o177)
+    try:
+        server = _Server(socket_path, _Handler)
+    finally:
+        os.umask(old_umask)
+    server.service = service
+    print(f'Listening on {socket_path}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    print(f'Served {service.served} request(s)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warm projection worker listening on a Unix socket.")
+    parser.add_argument('--socket', default=None, help="Socket path (default: $PROJECT_LABEL_SOCKET)")
+    parser.add_argument('--transform-cache', default=None,
+                        help="Directory caching the MNI <-> native registrations")
+    parser.add_argument('--result-store', default=None, help="Result store directory")
+    parser.add_argument('--max-concurrent', type=int, default=1, help="Jobs running at the same time")
+    parser.add_argument('--preload', nargs='*', default=[], help="FreeSurfer subject directories to load at start")
+    args = parser.parse_args(argv)
+    serve(args.socket, args.transform_cache, args.result_store, args.max_concurrent, args.preload)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())